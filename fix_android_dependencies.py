@@ -1,6 +1,19 @@
+import argparse
+import contextlib
 import json
 import os
 import re
+import shutil
+import sys
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import tomllib
+except ModuleNotFoundError:
+    # Python < 3.11
+    import tomli as tomllib
 
 # These will have to be updated manually over time, there's not an
 # easy way to determine the latest version.
@@ -13,10 +26,6 @@ COMPILE_SDK_RE = r'compileSdk(?:Version)?\s*=?\s*[\w]+'
 TARGET_SDK_RE = r'targetSdk(?:Version)?\s*=?\s*[\w]+'
 BUILD_TOOLS_RE = r'buildTools(?:Version)?\s*=?\s*[\'\"\w\.]+'
 
-# *.versions.toml files
-VERSION_RE = r'(.*)\s*=\s*"(.*)"'
-DEPENDENCY_RE = r'(group|module|name|version|version.ref|id)\s*='
-
 # Depends on https://github.com/ben-manes/gradle-versions-plugin
 #
 # Must run this command:
@@ -25,16 +34,345 @@ RELATIVE_PATH_TO_JSON_REPORT = 'build/dependencyUpdates/report.json'
 # Default Gradle Version Catalog location
 RELATIVE_PATH_TO_TOML = 'gradle/libs.versions.toml'
 
+CONFIG_FILE_SUFFIXES = ('build.gradle', 'build.gradle.kts', 'versions.toml')
+# Directories that never hold configuration files worth updating
+PRUNED_DIRS = {'build', '.gradle', '.git', 'node_modules'}
 
-def find_configuration_files():
-    """Finds all build configuration files, recursively."""
-    gradle_files = []
-    for root, dirs, files in os.walk('.'):
+
+def index_configuration_files(root='.'):
+    """Finds all build configuration files in a single pass, grouped by the
+    first-level sub-project that contains them ('.' for files at the root)."""
+    index = {}
+    for dirpath, dirs, files in os.walk(root):
+        # Don't descend into build outputs, caches or VCS metadata
+        dirs[:] = sorted(d for d in dirs if d not in PRUNED_DIRS)
         for filename in files:
-            if filename.endswith(('build.gradle', 'build.gradle.kts', 'versions.toml')):
-                gradle_files.append(os.path.join(root, filename))
+            if filename.endswith(CONFIG_FILE_SUFFIXES):
+                path = os.path.join(dirpath, filename)
+                parts = os.path.relpath(path, root).split(os.sep)
+                project = parts[0] if len(parts) > 1 else '.'
+                index.setdefault(project, []).append(path)
 
-    return gradle_files
+    return index
+
+
+def find_configuration_files(root='.'):
+    """Finds all build configuration files, recursively."""
+    return [path for paths in index_configuration_files(root).values() for path in paths]
+
+
+class Rewriter:
+    """Applies many replacements to a text in a single scan.
+
+    All keys are compiled into one alternation. Literal keys (e.g. Maven
+    coordinates) are escaped and tried longest first, so the most specific
+    key wins where several start at the same place. Pattern keys are regular
+    expressions; their replacements are inserted as-is, without expanding
+    backreferences.
+    """
+
+    def __init__(self, literals=None, patterns=None):
+        self.replacements = {}
+        alternatives = []
+        for i, key in enumerate(sorted(literals or {}, key=len, reverse=True)):
+            self.replacements[f'l{i}'] = (key, literals[key])
+            alternatives.append(f'(?P<l{i}>{re.escape(key)})')
+        for i, (key, value) in enumerate((patterns or {}).items()):
+            self.replacements[f'p{i}'] = (key, value)
+            alternatives.append(f'(?P<p{i}>{key})')
+
+        self.regex = re.compile('|'.join(alternatives)) if alternatives else None
+
+    def items(self):
+        """Yields each (key, replacement) pair."""
+        return iter(self.replacements.values())
+
+    def rewrite(self, text):
+        """Returns the rewritten text and a list of (line number, matched
+        text, replacement) for every replacement made."""
+        if self.regex is None:
+            return text, []
+
+        matches = []
+        line = 1
+        last = 0
+
+        def replace(match):
+            nonlocal line, last
+            line += text.count('\n', last, match.start())
+            last = match.start()
+            new = self.replacements[match.lastgroup][1]
+            matches.append((line, match.group(), new))
+            return new
+
+        return self.regex.sub(replace, text), matches
+
+
+# A version's location in a catalog: the offsets of a string's contents and
+# the key path it was found at
+Span = namedtuple('Span', ['start', 'end', 'label'])
+
+TOML_TOKEN_RE = re.compile(r'''
+    (?P<newline>\r?\n)
+  | (?P<space>[ \t]+)
+  | (?P<comment>\#[^\n]*)
+  | (?P<string>"""(?:\\.|[^\\])*?"""|\'\'\'.*?\'\'\'|"(?:\\.|[^"\\\n])*"|'[^'\n]*')
+  | (?P<punct>[=.,{}\[\]])
+  | (?P<bare>[\w:+-]+)
+''', re.VERBOSE | re.DOTALL)
+
+# Version table keys that hold a version string, in rich version declarations
+RICH_VERSION_KEYS = ('strictly', 'require', 'prefer')
+
+
+class TomlSpanScanner:
+    """Finds the position of every string value in a TOML document.
+
+    tomllib only returns values, so this walks the document's tokens to map
+    each string's key path (e.g. ('libraries', 'material', 'version')) to the
+    offsets of its contents. Array items are keyed by their index.
+    """
+
+    def __init__(self, text):
+        self.tokens = [m for m in TOML_TOKEN_RE.finditer(text)
+                       if m.lastgroup not in ('space', 'comment')]
+        self.pos = 0
+        self.spans = {}
+
+    def scan(self):
+        table = ()
+        while self.peek() is not None:
+            if self.skip_newlines():
+                continue
+            if self.accept('['):
+                # Table header; arrays of tables aren't used by catalogs
+                array_table = self.accept('[')
+                table = self.key()
+                self.expect(']')
+                if array_table:
+                    self.expect(']')
+            else:
+                self.key_value(table)
+
+        return self.spans
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError('Unexpected end of TOML document')
+        self.pos += 1
+        return token
+
+    def accept(self, value):
+        token = self.peek()
+        if token is not None and token.lastgroup == 'punct' and token.group() == value:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value):
+        token = self.next()
+        if token.group() != value:
+            raise ValueError(f"Expected '{value}' at offset {token.start()}, found '{token.group()}'")
+
+    def skip_newlines(self):
+        skipped = False
+        while self.peek() is not None and self.peek().lastgroup == 'newline':
+            self.pos += 1
+            skipped = True
+        return skipped
+
+    def key(self):
+        parts = [self.key_part()]
+        while self.accept('.'):
+            parts.append(self.key_part())
+        return tuple(parts)
+
+    def key_part(self):
+        token = self.next()
+        if token.lastgroup == 'bare':
+            return token.group()
+        if token.lastgroup == 'string':
+            return tomllib.loads(f"k = {token.group()}")['k']
+        raise ValueError(f"Expected a key at offset {token.start()}, found '{token.group()}'")
+
+    def key_value(self, path):
+        key = path + self.key()
+        self.expect('=')
+        self.value(key)
+
+    def value(self, path):
+        token = self.next()
+        if token.lastgroup == 'string':
+            quotes = 3 if token.group()[:3] in ('"""', "'''") else 1
+            self.spans[path] = (token.start() + quotes, token.end() - quotes)
+        elif token.group() == '{':
+            if not self.accept('}'):
+                self.key_value(path)
+                while self.accept(','):
+                    self.key_value(path)
+                self.expect('}')
+        elif token.group() == '[':
+            index = 0
+            self.skip_newlines()
+            while not self.accept(']'):
+                self.value(path + (index,))
+                index += 1
+                self.skip_newlines()
+                if not self.accept(','):
+                    self.expect(']')
+                    break
+                self.skip_newlines()
+        else:
+            # Numbers, booleans, dates and times hold no versions. Skip them
+            # whole, as they can span several tokens (e.g. '1979-05-27
+            # 07:32:00.999Z'), as well as any form not known here
+            self.skip_value()
+
+    def skip_value(self):
+        """Skips to the end of the current value: the end of the line, or of
+        the item in an array or inline table."""
+        token = self.peek()
+        while token is not None and token.lastgroup != 'newline' and token.group() not in (',', ']', '}'):
+            self.pos += 1
+            token = self.peek()
+
+
+class VersionCatalog:
+    """A Gradle Version Catalog, indexed for updating versions in place.
+
+    The catalog is parsed with tomllib and every version is located in the
+    source text, so updates are applied at those offsets in a single pass
+    and the rest of the file is left exactly as it was.
+
+    dependencies maps 'group:name' (for plugins, 'id:id.gradle.plugin', as in
+    the dependency report) to the spans holding its version. versions maps
+    each [versions] entry to its spans, and refs maps it to the dependencies
+    that refer to it. bundles is the [bundles] table, as parsed.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        # Parse first, so invalid documents fail with tomllib's errors
+        data = tomllib.loads(text)
+        self.spans = TomlSpanScanner(text).scan()
+        self.updates = []
+        self.versions = {}
+        self.refs = {}
+        self.dependencies = {}
+
+        self.bundles = data.get('bundles', {})
+
+        for ref, version in data.get('versions', {}).items():
+            self.versions[ref] = self.version_spans(('versions', ref), version)
+
+        for section in ('libraries', 'plugins'):
+            for alias, dep in data.get(section, {}).items():
+                self.add_dependency(section, alias, dep)
+
+    @classmethod
+    def load(cls, toml_file):
+        """Reads a catalog, or returns None if the project doesn't have one."""
+        try:
+            with open(toml_file, 'r', newline='') as f:
+                return cls(f.read())
+        except FileNotFoundError:
+            print('This project does not contain a ' + RELATIVE_PATH_TO_TOML + ' file.')
+            return None
+
+    def span(self, path, skip=0):
+        """Gets the span of the string at path, less its first skip
+        characters, or None if there's no string there."""
+        if path not in self.spans:
+            return None
+        (start, end) = self.spans[path]
+        return Span(start + skip, end, '.'.join(str(part) for part in path))
+
+    def version_spans(self, path, version):
+        """Gets the spans of a version given as a string or a rich version table."""
+        if isinstance(version, str):
+            paths = [path]
+        elif isinstance(version, dict):
+            paths = [path + (key,) for key in RICH_VERSION_KEYS if isinstance(version.get(key), str)]
+        else:
+            paths = []
+        return [span for span in map(self.span, paths) if span is not None]
+
+    def add_dependency(self, section, alias, dep):
+        path = (section, alias)
+        if isinstance(dep, str):
+            # "group:name:version", or "id:version" for plugins
+            (coordinates, _, version) = dep.rpartition(':')
+            if not coordinates:
+                return
+            span = self.span(path, skip=len(coordinates) + 1)
+            # Skip strings written with escapes, where offsets don't match
+            spans = [span] if span and self.text[span.start:span.end] == version else []
+            dep = {'module' if section == 'libraries' else 'id': coordinates}
+        elif isinstance(dep.get('version'), dict) and 'ref' in dep['version']:
+            spans = self.versions.get(dep['version']['ref'], [])
+        else:
+            spans = self.version_spans(path + ('version',), dep.get('version'))
+
+        if section == 'plugins':
+            group = dep['id']
+            name = group + '.gradle.plugin'
+        elif 'module' in dep:
+            (group, _, name) = dep['module'].partition(':')
+        else:
+            group = dep.get('group')
+            name = dep.get('name')
+
+        module = f"{group}:{name}"
+        self.dependencies.setdefault(module, []).extend(spans)
+        if isinstance(dep.get('version'), dict) and 'ref' in dep['version']:
+            self.refs.setdefault(dep['version']['ref'], []).append(module)
+
+    def update(self, module, curr_version, new_version):
+        """Plans an update of a dependency's version, wherever it's set to
+        curr_version."""
+        self.updates.append((module, curr_version, new_version))
+
+    def edits(self):
+        """Gets the planned edits, in order, as (span, old, new) tuples. A
+        version shared through a ref takes its last planned update."""
+        edits = {}
+        for (module, curr_version, new_version) in self.updates:
+            for span in self.dependencies.get(module, []):
+                if self.text[span.start:span.end] == curr_version:
+                    edits[span.start] = (span, curr_version, new_version)
+        return [edits[start] for start in sorted(edits)]
+
+    def items(self):
+        """Yields each planned (old, new) version assignment."""
+        for (span, old, new) in self.edits():
+            yield (f'{span.label} = "{old}"', f'{span.label} = "{new}"')
+
+    def rewrite(self, text):
+        """Returns the text with the planned updates applied, and a list of
+        (line number, old, new) for every replacement made."""
+        catalog = self
+        if text != self.text:
+            # The file changed since it was read, so locate the versions again
+            catalog = VersionCatalog(text)
+            catalog.updates = self.updates
+
+        pieces = []
+        matches = []
+        line = 1
+        last = 0
+        for (span, old, new) in catalog.edits():
+            line += text.count('\n', last, span.start)
+            pieces.append(text[last:span.start])
+            pieces.append(new)
+            matches.append((line, f'{span.label} = "{old}"', f'{span.label} = "{new}"'))
+            last = span.end
+        pieces.append(text[last:])
+
+        return ''.join(pieces), matches
 
 
 def get_android_replacements():
@@ -60,73 +398,239 @@ def is_major_update(old_version, new_version):
     return old_major != new_major
 
 
-def get_dep_replacements(json_file, toml_deps):
-    """Gets a dictionary of all dependency replacements to be made."""
-    replacements = {}
+def iter_outdated_dependencies(json_file):
+    """Yields the outdated dependencies listed in a report."""
+    # Reports are a few MB at most, so they are read whole
     with open(json_file, 'r') as f:
-        json_data = json.loads(f.read())
-
-        outdated_deps = json_data['outdated']['dependencies']
-        for dep in outdated_deps:
+        report = json.load(f)
+    yield from report.get('outdated', {}).get('dependencies', [])
+
+
+# Qualifiers that mark a prerelease, ranked from the least to the most mature
+PRERELEASE_RANKS = {
+    'dev': 0, 'snapshot': 0,
+    'alpha': 1, 'a': 1,
+    'beta': 2, 'b': 2,
+    'milestone': 3, 'm': 3, 'eap': 3, 'pre': 3, 'preview': 3,
+    'rc': 4, 'cr': 4,
+}
+PRERELEASE_RE = re.compile(r'(?P<name>[a-z]+?)(?P<number>\d*)', re.IGNORECASE)
+
+
+def version_parts(version):
+    return re.split(r'[.\-+_]', version)
+
+
+def prerelease_rank(part):
+    """Gets a prerelease qualifier's (rank, number), or None for other parts."""
+    match = PRERELEASE_RE.fullmatch(part)
+    if match is None or match.group('name').lower() not in PRERELEASE_RANKS:
+        return None
+    return (PRERELEASE_RANKS[match.group('name').lower()], int(match.group('number') or 0))
+
+
+def version_key(version):
+    """Gets a sort key for a version string. Numeric parts compare as numbers,
+    and prereleases (e.g. 2.0.0-alpha01) sort below their release."""
+    key = []
+    for part in version_parts(version):
+        rank = prerelease_rank(part)
+        if part.isdigit():
+            key.append((2, int(part), 0))
+        elif rank is not None:
+            key.append((0,) + rank)
+        else:
+            key.append((1, 0, part))
+    # Marks the end, so a release sorts above its prereleases and below versions with more parts
+    key.append((1, 0, ''))
+    return key
+
+
+def version_flavor(version):
+    """Gets the qualifiers that pick a variant of a release rather than a
+    prerelease, e.g. 'jre' in 33.0.0-jre. Versions of different flavors are
+    never updated to one another."""
+    return '-'.join(part for part in version_parts(version)
+                    if not part.isdigit() and prerelease_rank(part) is None)
+
+
+def merge_reports(json_files):
+    """Merges the outdated dependencies of all reports into one update plan.
+
+    The plan maps 'group:name' to the dependency's updates across all
+    reports: each current version maps to the highest version any report
+    offers of the same flavor (see version_flavor)."""
+    plan = {}
+    # The flavor offered for each current version, and the highest offer of
+    # each flavor, by module
+    offered = {}
+    highest = {}
+    for json_file in json_files:
+        for dep in iter_outdated_dependencies(json_file):
             group = dep['group']
             name = dep['name']
-
             curr_version = dep['version']
             new_version = dep['available']['release']
 
+            module = f"{group}:{name}"
+            entry = plan.setdefault(module, {
+                'group': group,
+                'name': name,
+                'updates': {},
+                'reports': [],
+            })
+            flavor = version_flavor(new_version)
+            offered.setdefault(module, {}).setdefault(curr_version, flavor)
+            best = highest.setdefault(module, {})
+            if flavor not in best or version_key(new_version) > version_key(best[flavor]):
+                best[flavor] = new_version
+            if json_file not in entry['reports']:
+                entry['reports'].append(json_file)
+
+    for (module, entry) in plan.items():
+        for (curr_version, flavor) in offered[module].items():
+            entry['updates'][curr_version] = highest[module][flavor]
+
+    return plan
+
+
+def get_dep_replacements(plan, catalogs=()):
+    """Gets a dictionary of all dependency replacements to be made for an
+    update plan. Keys are matched literally. Updates to Version Catalogs are
+    planned on the catalogs themselves."""
+    replacements = {}
+    for (module, entry) in plan.items():
+        group = entry['group']
+        name = entry['name']
+
+        for (curr_version, new_version) in entry['updates'].items():
+            if curr_version == new_version:
+                continue
+
             # For dependencies and classhpaths
             curr_dep = f"{group}:{name}:{curr_version}"
             new_dep = f"{group}:{name}:{new_version}"
             replacements[curr_dep] = new_dep
 
             # For the plugins block in .kts files
-            curr_plugin = f'\("{group}"\) version "{curr_version}"'
+            curr_plugin = f'("{group}") version "{curr_version}"'
             new_plugin = f'("{group}") version "{new_version}"'
             replacements[curr_plugin] = new_plugin
 
             # For the TOML dependencies
-            module = group + ':' + name
-            if module not in toml_deps:
-                continue
-            curr_dep = toml_deps[module]
-            if 'original_line' in curr_dep:
-                original_line = curr_dep['original_line']
-                new_line = original_line.replace(curr_version, new_version)
-                replacements[original_line] = new_line
+            for catalog in catalogs:
+                catalog.update(module, curr_version, new_version)
 
     return replacements
 
 
-def update_project(project_path, toml_path):
-    """Runs through all build configuration files and performs replacements for individual android project."""
-    replacements = {}
-    replacements.update(get_android_replacements())
-    # Open the Gradle Version Catalog file and fetch its dependencies
-    toml_dependencies = get_toml_dependencies(toml_path)
-    replacements.update(get_dep_replacements(project_path, toml_dependencies))
+def write_atomically(path, data):
+    """Replaces a file's contents without ever leaving it half-written."""
+    directory, filename = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory or '.', prefix=f".{filename}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', newline='') as f:
+            f.write(data)
+        shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def rewrite_file(config_file, rewriters):
+    """Applies each rewriter to a file in turn, writing it only if it changed.
+
+    Returns the list of replacements made."""
+    # Keep line endings as they are
+    with open(config_file, 'r', newline='') as f:
+        old_data = f.read()
+
+    new_data = old_data
+    matches = []
+    for rewriter in rewriters:
+        new_data, found = rewriter.rewrite(new_data)
+        matches.extend(found)
 
-    # Print all updates found
+    # Leave unchanged files alone so Gradle still sees them as up-to-date
+    if new_data != old_data:
+        write_atomically(config_file, new_data)
+
+    return matches
+
+
+def get_project_jobs(config_files, rewriter, catalog, toml_path):
+    """Maps each of a project's files to its rewriters. The catalog only
+    applies to its own file."""
+    jobs = {}
+    for config_file in config_files:
+        jobs[config_file] = [rewriter]
+        if catalog is not None and os.path.abspath(config_file) == os.path.abspath(toml_path):
+            jobs[config_file].insert(0, catalog)
+    return jobs
+
+
+def print_updates(rewriter, catalogs):
     print("Dependency updates:")
-    for (k, v) in iter(replacements.items()):
+    for (k, v) in rewriter.items():
         print(f"{k} --> {v}")
+    for (toml_path, catalog) in catalogs.items():
+        for (k, v) in catalog.items():
+            print(f"{toml_path}: {k} --> {v}")
+
 
-    # Iterate through each file and replace it
-    for config_file in find_configuration_files():
+def update_files(executor, jobs):
+    """Applies the rewriters to each build configuration file, one file per
+    task. jobs maps each file to its list of rewriters."""
+    config_files = list(jobs)
+    results = executor.map(
+        rewrite_file, config_files, [jobs[f] for f in config_files],
+        chunksize=max(1, len(config_files) // (4 * (os.cpu_count() or 1))))
+
+    for config_file, matches in zip(config_files, results):
         print(f"Updating dependencies for: {config_file}")
+        for (line, old, new) in matches:
+            print(f"\t{config_file}:{line}: {old.strip()} --> {new.strip()}")
+
+
+def update_projects(projects, dry_run=False):
+    """Merges the reports of the given (report, Version Catalog path, config
+    files) projects into one update plan and applies it to all of them.
+    Returns the plan; with dry_run, nothing is changed."""
+    plan = merge_reports([report for (report, _, _) in projects])
+    if dry_run:
+        return plan
+
+    # Open the Gradle Version Catalog files and index their dependencies
+    catalogs = {}
+    for (_, toml_path, _) in projects:
+        catalog = VersionCatalog.load(toml_path)
+        if catalog is not None:
+            catalogs[toml_path] = catalog
+
+    rewriter = Rewriter(
+        literals=get_dep_replacements(plan, catalogs.values()),
+        patterns=get_android_replacements())
+    print_updates(rewriter, catalogs)
 
-        new_data = ''
-        with open(config_file, 'r') as f:
-            # Perform each replacement
-            new_data = f.read()
-            for (k, v) in iter(replacements.items()):
-                new_data = re.sub(k, v, new_data)
+    jobs = {}
+    for (_, toml_path, config_files) in projects:
+        jobs.update(get_project_jobs(config_files, rewriter, catalogs.get(toml_path), toml_path))
 
-        # Write the file
-        with open(config_file, 'w') as f:
-            f.write(new_data)
+    with ProcessPoolExecutor() as executor:
+        update_files(executor, jobs)
 
+    return plan
 
-def update_all():
+
+def update_project(project_path, toml_path, config_files=None, dry_run=False):
+    """Runs through the project's build configuration files (all of them by default) and performs replacements for individual android project."""
+    if config_files is None:
+        config_files = find_configuration_files()
+    return update_projects([(project_path, toml_path, config_files)], dry_run=dry_run)
+
+
+def update_all(dry_run=False):
     """Runs through all build configuration files and performs replacements."""
 
     project_root = os.getcwd()
@@ -137,90 +641,28 @@ def update_all():
 
     if os.path.exists(top_level_report):
         print("Update dependencies via top-level report")
-        update_project(top_level_report, toml_path)
-    else:
-        print("Update dependencies via child-level report(s)")
-        first_level_subdirectories = get_immediate_subdirectories(project_root)
-        print(f"List of subdirectories: {first_level_subdirectories}")
+        return update_project(top_level_report, toml_path, dry_run=dry_run)
+
+    print("Update dependencies via child-level report(s)")
+    first_level_subdirectories = get_immediate_subdirectories(project_root)
+    print(f"List of subdirectories: {first_level_subdirectories}")
 
-        for subdirectory in first_level_subdirectories:
-            print(f"subdirectory: {subdirectory}")
-            subdirectory_report = os.path.join(project_root, subdirectory, RELATIVE_PATH_TO_JSON_REPORT)
+    # Scan the tree once; each sub-project's files are only updated if it has a report
+    index = index_configuration_files()
+
+    projects = []
+    for subdirectory in first_level_subdirectories:
+        print(f"subdirectory: {subdirectory}")
+        subdirectory_report = os.path.join(project_root, subdirectory, RELATIVE_PATH_TO_JSON_REPORT)
+
+        if os.path.exists(subdirectory_report):
+            print("\tUpdate dependencies in subdirectory")
             toml_path = os.path.join(project_root, subdirectory, RELATIVE_PATH_TO_TOML)
+            projects.append((subdirectory_report, toml_path, index.get(subdirectory, [])))
+        else:
+            print("\tNo report in subdirectory")
 
-            if os.path.exists(subdirectory_report):
-                print("\tUpdate dependencies in subdirectory")
-                update_project(subdirectory_report, toml_path)
-            else:
-                print("\tNo report in subdirectory")
-
-
-def get_toml_dependency(line, versions):
-    original_line = line
-    # skip dependencies that don't specify a version
-    if 'version' not in line:
-        return {}
-    # Turn it into a valid JSON
-    line = re.sub(DEPENDENCY_RE, r'"\1" =', line)
-    value = line.split("=", 1)[1].replace("=", ":")
-    dep_json = json.loads(value)
-    # unspecified version means it's an internal dependency
-    # we can skip version bumps for those
-    if 'version' in dep_json and dep_json['version'] == 'unspecified':
-        return {}
-    # Fill in the group and name
-    if 'module' in dep_json:
-        module = dep_json.pop('module')
-        [group, name] = module.split(':')
-        dep_json.update({'group': group, 'name': name})
-    if 'id' in dep_json:
-        # 'id' indicates this is a plugin
-        dep_json['group'] = dep_json.pop('id')
-        dep_json['name'] = dep_json['group'] + '.gradle.plugin'
-
-    # Fill in the current version
-    if 'version.ref' in dep_json:
-        dep_json['original_line'] = versions[dep_json.pop('version.ref')]['original_line']
-    # if the version is inlined
-    if 'version' in dep_json:
-        dep_json['original_line'] = original_line
-    key = dep_json.pop('group') + ':' + dep_json.pop('name')
-    return {key: dep_json}
-
-
-def get_toml_dependencies(toml_file):
-    """Gets a dictionary of all TOML dependencies."""
-    # This code assumes the [versions] block will always be first
-    # True = read [versions] block; False = read [libraries] or [plugins] block
-    reading_versions = True
-    versions = {}
-    deps = {}
-    try:
-        with open(toml_file, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
-                # skip empty lines or comments
-                if line.strip() == '' or line.startswith("#"):
-                    continue
-                if '[versions]' in line:
-                    reading_versions = True
-                    continue
-                if '[libraries]' in line or '[plugins]' in line:
-                    reading_versions = False
-                    continue
-                # Versions
-                if reading_versions:
-                    version_match = re.search(VERSION_RE, line)
-                    if version_match:
-                        key = version_match.group(1).strip()
-                        value = version_match.group(2)
-                        versions[key] = {'curr_version': value, 'original_line': line}
-                # Libraries and Plugins
-                else:
-                    deps.update(get_toml_dependency(line, versions))
-    except FileNotFoundError:
-        print('This project does not contain a ' + RELATIVE_PATH_TO_TOML + ' file.')
-    return deps
+    return update_projects(projects, dry_run=dry_run)
 
 
 def get_immediate_subdirectories(directory):
@@ -229,4 +671,14 @@ def get_immediate_subdirectories(directory):
 
 
 if __name__ == '__main__':
-    update_all()
+    parser = argparse.ArgumentParser(description='Updates Android dependencies using the dependencyUpdates report(s).')
+    parser.add_argument('--dry-run', action='store_true', help="print the update plan as JSON and don't change any files")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        # Keep stdout for the plan
+        with contextlib.redirect_stdout(sys.stderr):
+            plan = update_all(dry_run=True)
+        print(json.dumps(plan, indent=2, sort_keys=True))
+    else:
+        update_all()
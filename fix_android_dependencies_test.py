@@ -0,0 +1,381 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import fix_android_dependencies as fad
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fix_android_dependencies.py')
+
+
+def write_report(path, *deps):
+    """Writes a dependencyUpdates report listing (module, current, available) updates."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    outdated = []
+    for (module, current, available) in deps:
+        group, name = module.split(':')
+        outdated.append({
+            'group': group,
+            'name': name,
+            'version': current,
+            'available': {'release': available, 'milestone': None, 'integration': None},
+            'projectUrl': None,
+        })
+    report = {
+        'current': {'dependencies': [], 'count': 0},
+        'exceeded': {'dependencies': [], 'count': 0},
+        'outdated': {'dependencies': outdated, 'count': len(outdated)},
+        'unresolved': {'dependencies': [], 'count': 0},
+        'count': len(outdated),
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f)
+    return str(path)
+
+
+@pytest.mark.parametrize('lower,higher', [
+    ('1.9', '1.10'),
+    ('1.2', '1.2.1'),
+    ('31.1-jre', '32.0-jre'),
+    ('2.0.9', '10.0.0'),
+    ('2.0.0-alpha01', '2.0.0'),
+    ('2.0.0-alpha01', '2.0.0-alpha02'),
+    ('2.0.0-beta01', '2.0.0-rc01'),
+    ('1.9.20-RC', '1.9.20'),
+    ('2.0.0', '2.0.1-alpha01'),
+])
+def test_version_key_compares_numeric_parts_as_numbers(lower, higher):
+    assert fad.version_key(lower) < fad.version_key(higher)
+
+
+@pytest.mark.parametrize('version,flavor', [
+    ('33.0.0-jre', 'jre'),
+    ('31.1-android', 'android'),
+    ('1.10.0', ''),
+    ('2.0.0-alpha01', ''),
+])
+def test_version_flavor(version, flavor):
+    assert fad.version_flavor(version) == flavor
+
+
+def test_merge_reports_takes_the_highest_target(tmp_path):
+    first = write_report(
+        tmp_path / 'app' / 'report.json',
+        ('com.google.android.material:material', '1.9.0', '1.10.0'),
+        ('androidx.core:core-ktx', '1.10.0', '1.12.0'))
+    second = write_report(
+        tmp_path / 'lib' / 'report.json',
+        ('com.google.android.material:material', '1.8.0', '1.9.0'),
+        ('androidx.core:core-ktx', '1.10.0', '1.13.1'))
+
+    plan = fad.merge_reports([first, second])
+
+    assert plan == {
+        'com.google.android.material:material': {
+            'group': 'com.google.android.material',
+            'name': 'material',
+            'updates': {'1.9.0': '1.10.0', '1.8.0': '1.10.0'},
+            'reports': [first, second],
+        },
+        'androidx.core:core-ktx': {
+            'group': 'androidx.core',
+            'name': 'core-ktx',
+            'updates': {'1.10.0': '1.13.1'},
+            'reports': [first, second],
+        },
+    }
+
+
+def test_merge_reports_keeps_each_flavor(tmp_path):
+    first = write_report(tmp_path / 'app.json', ('com.google.guava:guava', '31.1-android', '33.0.0-android'))
+    second = write_report(tmp_path / 'lib.json', ('com.google.guava:guava', '31.1-jre', '33.0.0-jre'))
+
+    plan = fad.merge_reports([first, second])
+    replacements = fad.get_dep_replacements(plan)
+
+    assert plan['com.google.guava:guava']['updates'] == {
+        '31.1-android': '33.0.0-android',
+        '31.1-jre': '33.0.0-jre',
+    }
+    assert replacements['com.google.guava:guava:31.1-android'] == 'com.google.guava:guava:33.0.0-android'
+
+
+def test_merge_reports_prefers_releases_to_prereleases(tmp_path):
+    first = write_report(tmp_path / 'a.json', ('androidx.room:room-runtime', '2.5.0', '2.6.0-alpha01'))
+    second = write_report(tmp_path / 'b.json', ('androidx.room:room-runtime', '2.5.2', '2.6.0'))
+
+    plan = fad.merge_reports([first, second])
+
+    assert plan['androidx.room:room-runtime']['updates'] == {'2.5.0': '2.6.0', '2.5.2': '2.6.0'}
+
+
+def test_merge_reports_without_outdated_dependencies(tmp_path):
+    report = tmp_path / 'report.json'
+    report.write_text('{"current": {"dependencies": []}, "count": 0}')
+
+    assert fad.merge_reports([str(report)]) == {}
+
+
+def test_dep_replacements_move_every_current_version_to_the_target(tmp_path):
+    first = write_report(tmp_path / 'a.json', ('com.squareup:okhttp', '4.9.0', '4.12.0'))
+    second = write_report(tmp_path / 'b.json', ('com.squareup:okhttp', '4.10.0', '4.11.0'))
+
+    replacements = fad.get_dep_replacements(fad.merge_reports([first, second]))
+
+    assert replacements['com.squareup:okhttp:4.9.0'] == 'com.squareup:okhttp:4.12.0'
+    assert replacements['com.squareup:okhttp:4.10.0'] == 'com.squareup:okhttp:4.12.0'
+
+
+def test_dry_run_prints_the_plan_and_changes_nothing(tmp_path):
+    build_files = {}
+    for (project, current, available) in (('app', '1.9.0', '1.11.0'), ('lib', '1.8.0', '1.10.0')):
+        write_report(
+            tmp_path / project / fad.RELATIVE_PATH_TO_JSON_REPORT,
+            ('com.google.android.material:material', current, available))
+        build_file = tmp_path / project / 'build.gradle'
+        build_file.write_text(
+            'dependencies {\n'
+            f'    implementation "com.google.android.material:material:{current}"\n'
+            '}\n')
+        build_files[build_file] = build_file.read_bytes()
+
+    result = subprocess.run(
+        [sys.executable, SCRIPT, '--dry-run'], cwd=tmp_path,
+        capture_output=True, text=True, check=True)
+
+    plan = json.loads(result.stdout)
+    entry = plan['com.google.android.material:material']
+    assert entry['updates'] == {'1.8.0': '1.11.0', '1.9.0': '1.11.0'}
+    for (build_file, data) in build_files.items():
+        assert build_file.read_bytes() == data
+
+
+def test_rewriter_escapes_literal_keys():
+    rewriter = fad.Rewriter(literals={'com.example:lib:1.0+': 'com.example:lib:2.0'})
+
+    (text, _) = rewriter.rewrite('a com.example:lib:1.0+\nb comXexample:lib:1.00\n')
+
+    assert text == 'a com.example:lib:2.0\nb comXexample:lib:1.00\n'
+
+
+def test_rewriter_prefers_the_longest_key():
+    rewriter = fad.Rewriter(literals={
+        'com.example:lib:1.0': 'com.example:lib:1.5',
+        'com.example:lib:1.0.1': 'com.example:lib:2.0.0',
+    })
+
+    (text, _) = rewriter.rewrite('com.example:lib:1.0.1 com.example:lib:1.0')
+
+    assert text == 'com.example:lib:2.0.0 com.example:lib:1.5'
+
+
+def test_rewriter_reports_changed_lines():
+    rewriter = fad.Rewriter(
+        literals={'com.example:lib:1.0': 'com.example:lib:2.0'},
+        patterns={fad.COMPILE_SDK_RE: 'compileSdk 36'})
+
+    (text, matches) = rewriter.rewrite(
+        'android {\n'
+        '    compileSdkVersion 33\n'
+        '}\n'
+        '\n'
+        'implementation "com.example:lib:1.0"\n')
+
+    assert 'compileSdk 36\n' in text
+    assert matches == [
+        (2, 'compileSdkVersion 33', 'compileSdk 36'),
+        (5, 'com.example:lib:1.0', 'com.example:lib:2.0'),
+    ]
+
+
+def test_rewrite_file_leaves_unchanged_files_alone(tmp_path):
+    build_file = tmp_path / 'build.gradle'
+    build_file.write_text('implementation "com.example:other:1.0"\n')
+    before = os.stat(build_file)
+    rewriter = fad.Rewriter(literals={'com.example:lib:1.0': 'com.example:lib:2.0'})
+
+    assert fad.rewrite_file(str(build_file), [rewriter]) == []
+
+    after = os.stat(build_file)
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+
+
+def test_rewrite_file_replaces_changed_files_atomically(tmp_path):
+    build_file = tmp_path / 'build.gradle'
+    build_file.write_bytes(b'implementation "com.example:lib:1.0"\r\n')
+    os.chmod(build_file, 0o640)
+    before = os.stat(build_file)
+    rewriter = fad.Rewriter(literals={'com.example:lib:1.0': 'com.example:lib:2.0'})
+
+    matches = fad.rewrite_file(str(build_file), [rewriter])
+
+    assert matches == [(1, 'com.example:lib:1.0', 'com.example:lib:2.0')]
+    assert build_file.read_bytes() == b'implementation "com.example:lib:2.0"\r\n'
+    after = os.stat(build_file)
+    # A new file was renamed over the old one, keeping its permissions
+    assert after.st_ino != before.st_ino
+    assert after.st_mode == before.st_mode
+    assert os.listdir(tmp_path) == ['build.gradle']
+
+
+CATALOG = '''\
+# Comments and layout are kept as they are
+[versions]
+agp = "8.1.0"   # the Android Gradle Plugin
+kotlin = { strictly = "1.9.0" }
+"compose-bom" = '2023.08.00'
+
+[libraries]
+core = { module = "androidx.core:core-ktx", version = "1.10.0" }
+compose-bom = { group = "androidx.compose", name = "compose-bom", version.ref = "compose-bom" }
+kotlin-stdlib = { module = "org.jetbrains.kotlin:kotlin-stdlib", version.ref = "kotlin" }
+appcompat = "androidx.appcompat:appcompat:1.6.1"
+"okhttp.client" = { module = "com.squareup.okhttp3:okhttp", version = { require = "4.10.0", prefer = "4.10.0" } }
+
+[libraries.material]
+module = "com.google.android.material:material"
+version = "1.9.0"
+
+[plugins]
+android-application = { id = "com.android.application", version.ref = "agp" }
+kotlin-android = "org.jetbrains.kotlin.android:1.9.0"
+
+[bundles]
+androidx = ["core", "appcompat"]
+
+[metadata]
+generated = 1979-05-27 07:32:00.999Z
+dates = [1979-05-27 07:32:00Z, 1979-05-28]
+retries = { count = 3, timeout = 1.5, enabled = true }
+'''
+
+UPDATES = [
+    ('androidx.core:core-ktx', '1.10.0', '1.12.0'),
+    ('androidx.compose:compose-bom', '2023.08.00', '2024.02.00'),
+    ('androidx.appcompat:appcompat', '1.6.1', '1.7.0'),
+    ('com.squareup.okhttp3:okhttp', '4.10.0', '4.12.0'),
+    ('com.google.android.material:material', '1.9.0', '1.11.0'),
+    ('com.android.application:com.android.application.gradle.plugin', '8.1.0', '8.2.0'),
+    ('org.jetbrains.kotlin.android:org.jetbrains.kotlin.android.gradle.plugin', '1.9.0', '1.9.20'),
+    # Not in the catalog
+    ('com.example:missing', '1.0', '2.0'),
+]
+
+UPDATED_CATALOG = CATALOG \
+    .replace('agp = "8.1.0"', 'agp = "8.2.0"') \
+    .replace("'2023.08.00'", "'2024.02.00'") \
+    .replace('version = "1.10.0"', 'version = "1.12.0"') \
+    .replace('appcompat:1.6.1', 'appcompat:1.7.0') \
+    .replace('require = "4.10.0", prefer = "4.10.0"', 'require = "4.12.0", prefer = "4.12.0"') \
+    .replace('version = "1.9.0"', 'version = "1.11.0"') \
+    .replace('android:1.9.0', 'android:1.9.20')
+
+
+def update_catalog(text, updates=UPDATES):
+    catalog = fad.VersionCatalog(text)
+    for update in updates:
+        catalog.update(*update)
+    return catalog.rewrite(text)
+
+
+def test_scanner_finds_strings_by_key_path():
+    spans = fad.TomlSpanScanner(CATALOG).scan()
+
+    def value(*path):
+        (start, end) = spans[path]
+        return CATALOG[start:end]
+
+    assert value('versions', 'compose-bom') == '2023.08.00'
+    assert value('versions', 'kotlin', 'strictly') == '1.9.0'
+    assert value('libraries', 'compose-bom', 'version', 'ref') == 'compose-bom'
+    assert value('libraries', 'okhttp.client', 'version', 'prefer') == '4.10.0'
+    assert value('libraries', 'material', 'version') == '1.9.0'
+    assert value('plugins', 'kotlin-android') == 'org.jetbrains.kotlin.android:1.9.0'
+    assert value('bundles', 'androidx', 1) == 'appcompat'
+
+
+def test_scanner_skips_values_that_are_not_strings():
+    text = (
+        'when = 1979-05-27 07:32:00.999-07:00\n'
+        'times = [07:32:00, 1979-05-27T07:32:00Z, "after"]\n'
+        'flags = { on = true, ratio = 0.5, big = 1_000 }\n'
+        'name = "last"\n')
+    spans = fad.TomlSpanScanner(text).scan()
+
+    assert {path: text[start:end] for (path, (start, end)) in spans.items()} == {
+        ('times', 2): 'after',
+        ('name',): 'last',
+    }
+
+
+def test_catalog_indexes_every_form_of_version():
+    catalog = fad.VersionCatalog(CATALOG)
+
+    def versions(module):
+        return [CATALOG[span.start:span.end] for span in catalog.dependencies[module]]
+
+    assert versions('androidx.compose:compose-bom') == ['2023.08.00']
+    assert versions('org.jetbrains.kotlin:kotlin-stdlib') == ['1.9.0']
+    assert versions('com.squareup.okhttp3:okhttp') == ['4.10.0', '4.10.0']
+    assert versions('com.google.android.material:material') == ['1.9.0']
+    assert versions('com.android.application:com.android.application.gradle.plugin') == ['8.1.0']
+    assert catalog.refs == {
+        'compose-bom': ['androidx.compose:compose-bom'],
+        'kotlin': ['org.jetbrains.kotlin:kotlin-stdlib'],
+        'agp': ['com.android.application:com.android.application.gradle.plugin'],
+    }
+
+
+def test_catalog_rewrite_only_touches_versions():
+    (text, matches) = update_catalog(CATALOG)
+
+    assert text == UPDATED_CATALOG
+    assert [line for (line, _, _) in matches] == [3, 5, 8, 11, 12, 12, 16, 20]
+    assert matches[1] == (5, 'versions.compose-bom = "2023.08.00"', 'versions.compose-bom = "2024.02.00"')
+
+
+def test_catalog_rewrite_keeps_crlf_line_endings():
+    (text, matches) = update_catalog(CATALOG.replace('\n', '\r\n'))
+
+    assert text == UPDATED_CATALOG.replace('\n', '\r\n')
+    assert len(matches) == 8
+
+
+def test_catalog_leaves_other_versions_alone():
+    (text, matches) = update_catalog(CATALOG, [
+        # kotlin-stdlib's version isn't 1.8.0, and the plugin's is separate
+        ('org.jetbrains.kotlin:kotlin-stdlib', '1.8.0', '1.9.20'),
+    ])
+
+    assert text == CATALOG
+    assert matches == []
+
+
+def test_index_groups_files_by_sub_project(tmp_path):
+    for path in [
+        'build.gradle',
+        'settings.gradle.kts',
+        'gradle/libs.versions.toml',
+        'app/build.gradle',
+        'app/src/main/AndroidManifest.xml',
+        'lib/core/build.gradle.kts',
+        'app/build/generated/build.gradle',
+        '.gradle/8.4/build.gradle',
+        '.git/build.gradle',
+        'node_modules/some-package/android/build.gradle',
+        'lib/core/build/build.gradle.kts',
+    ]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text('')
+
+    index = fad.index_configuration_files(str(tmp_path))
+
+    assert {project: sorted(os.path.relpath(path, tmp_path) for path in paths)
+            for (project, paths) in index.items()} == {
+        '.': ['build.gradle'],
+        'gradle': [os.path.join('gradle', 'libs.versions.toml')],
+        'app': [os.path.join('app', 'build.gradle')],
+        'lib': [os.path.join('lib', 'core', 'build.gradle.kts')],
+    }
@@ -61,6 +61,9 @@ update_dependencies () {
     # shellcheck disable=SC1091
     source env/bin/activate
 
+    # tomllib is only in the standard library from Python 3.11
+    pip install tomli==2.0.1
+
     # Run Android fixer script
     python3 "${dir}/fix_android_dependencies.py"
 
@@ -0,0 +1,155 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The webhook app as an ASGI application, for async serving mode.
+
+With WEBHOOK_ASYNC set, gunicorn.conf.py runs uvicorn workers and main.app
+is this application. Deliveries are verified and dispatched on the worker's
+event loop, so one worker can keep many deliveries waiting on the GitHub API
+at once. Listeners without a coroutine version, and the cron jobs, run their
+sync code in threads.
+"""
+
+import asyncio
+import functools
+import json
+import os
+
+from werkzeug.datastructures import Headers
+
+import github_async
+import handlers
+import jobs
+import metrics
+import webhook_helper
+import webhooks
+(jobs, webhooks)
+
+
+def enabled():
+    return os.environ.get('WEBHOOK_ASYNC', '').lower() in ('1', 'true', 'yes')
+
+
+async def _run_in_thread(function, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(function, *args, **kwargs))
+
+
+async def _respond(send, body, status=200,
+                   content_type='text/html; charset=utf-8'):
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type.encode('latin-1')),
+            (b'content-length', str(len(body)).encode('latin-1')),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _respond_json(send, payload, status=200):
+    await _respond(
+        send, json.dumps(payload), status=status,
+        content_type='application/json')
+
+
+async def hello(headers, receive, send):
+    body, status = handlers.hello()
+    await _respond(send, body, status=status)
+
+
+async def metrics_endpoint(headers, receive, send):
+    # Reads every worker's metrics files.
+    output, status = await _run_in_thread(handlers.metrics_output)
+    await _respond(
+        send, output, status=status, content_type=metrics.CONTENT_TYPE)
+
+
+async def webhook(headers, receive, send):
+    # Drop events nothing listens to before reading the body.
+    event = handlers.event_name(headers)
+    if handlers.ignores(event):
+        await _respond_json(send, handlers.IGNORED)
+        return
+
+    body = await webhook_helper.read_verified_body_async(headers, receive)
+    # Recording and queueing write to disk.
+    response = await _run_in_thread(
+        handlers.accept_delivery, event, headers, body)
+    if response is not None:
+        payload, status = response
+        await _respond_json(send, payload, status=status)
+        return
+
+    result = await webhook_helper.process_event_async(
+        event, handlers.parse_payload(body))
+    await _respond_json(send, result)
+
+
+def _cron(name):
+    async def handler(headers, receive, send):
+        body, status = await _run_in_thread(
+            handlers.run_cron_job, name, headers)
+        await _respond(send, body, status=status)
+    return handler
+
+
+_ROUTES = {
+    '/': ('GET', hello),
+    '/metrics': ('GET', metrics_endpoint),
+    '/webhook': ('POST', webhook),
+}
+_ROUTES.update({
+    path: ('GET', _cron(name))
+    for name, path in handlers.cron_paths().items()})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await github_async.close_session()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    route = _ROUTES.get(scope['path'])
+    if route is None:
+        await _respond(send, 'Not Found', status=404)
+        return
+
+    method, handler = route
+    if scope['method'] not in (method, 'HEAD' if method == 'GET' else None):
+        await _respond(send, 'Method Not Allowed', status=405)
+        return
+
+    headers = Headers([
+        (name.decode('latin-1'), value.decode('latin-1'))
+        for name, value in scope['headers']])
+
+    try:
+        await handler(headers, receive, send)
+    except Exception as e:
+        body, status = handlers.error_response(e)
+        await _respond(send, body, status=status)
@@ -0,0 +1,114 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import hashlib
+import hmac
+import json
+
+import httpx
+import pytest
+
+import asgi
+import fake_github
+import webhooks
+
+
+def request(method, path, **kwargs):
+    async def send():
+        async with httpx.AsyncClient(
+                transport=httpx.ASGITransport(app=asgi.app),
+                base_url='http://testserver') as client:
+            return await client.request(method, path, **kwargs)
+    return asyncio.run(send())
+
+
+def signed(body, secret=b'secret'):
+    return 'sha256=' + hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def test_index():
+    r = request('GET', '/')
+    assert r.status_code == 200
+    assert r.text == 'Hello World!'
+
+    assert request('GET', '/nope').status_code == 404
+    assert request('POST', '/').status_code == 405
+
+
+def test_webhook(monkeypatch):
+    monkeypatch.setenv('GITHUB_WEBHOOK_SECRET', 'secret')
+    body = b'{"zen": "Keep it logically awesome."}'
+
+    r = request('POST', '/webhook', content=body, headers={
+        'X-GitHub-Event': 'ping', 'X-Hub-Signature-256': signed(body)})
+    assert r.status_code == 200
+    assert r.json() == {'msg': 'pong'}
+
+    r = request('POST', '/webhook', content=body, headers={
+        'X-GitHub-Event': 'ping', 'X-Hub-Signature-256': signed(b'')})
+    assert r.status_code == 401
+
+    r = request('POST', '/webhook', headers={'X-GitHub-Event': 'workflow_job'})
+    assert r.json() == {'status': 'ignored'}
+
+
+@pytest.fixture
+def api(monkeypatch, tmpdir):
+    api = fake_github.FakeGitHub(latency=0).start()
+    monkeypatch.setenv('GITHUB_API_URL', api.url)
+    monkeypatch.setenv('GITHUB_ACCESS_TOKEN', 'token')
+    monkeypatch.setenv('WEBHOOK_DB_PATH', str(tmpdir.join('test.db')))
+    yield api
+    api.stop()
+
+
+def test_status_event_merges_pull_request(api, monkeypatch):
+    monkeypatch.setenv('GITHUB_WEBHOOK_SECRET', 'secret')
+    api.add_pull('octo', 'repo', 7, 'abc123')
+    body = json.dumps({
+        'state': 'success', 'sha': 'abc123', 'commit': {'sha': 'abc123'},
+        'repository': {
+            'full_name': 'octo/repo', 'name': 'repo',
+            'owner': {'login': 'octo'}},
+    }).encode('utf-8')
+
+    r = request('POST', '/webhook', content=body, headers={
+        'X-GitHub-Event': 'status', 'X-Hub-Signature-256': signed(body)})
+
+    assert r.status_code == 200
+    assert api.calls['PUT /repos/{owner}/{name}/pulls/{number}/merge'] == 1
+
+
+def test_merge_gate_stops_at_first_failed_check(api):
+    api.add_pull('octo', 'repo', 7, 'abc123', labels=())
+
+    async def merge():
+        pull = await webhooks.github_async.get_pull_request('octo', 'repo', 7)
+        await webhooks.merge_pull_request_async('octo', 'repo', pull, 'abc123')
+
+    asyncio.run(merge())
+
+    assert api.calls['PUT /repos/{owner}/{name}/pulls/{number}/merge'] == 0
+    # Only the PR itself was read: the other checks wait for the label.
+    assert sum(api.calls.values()) == 1
+
+
+def test_routes_match_the_flask_app():
+    import main
+
+    flask_paths = {
+        rule.rule for rule in main.app.url_map.iter_rules()
+        if rule.endpoint != 'static'}
+    assert flask_paths == set(asgi._ROUTES)
@@ -0,0 +1,70 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Parses commands addressed to the bot in comments.
+
+A command is addressed to the bot when the comment mentions it, e.g.
+``@dpebot merge when travis passes``. Commands are registered with a name and
+the patterns that trigger them; the patterns are matched, case-insensitively,
+against the rest of the line after the first mention. Patterns are compiled
+once, when they are registered. Most comments never mention the bot, so
+those are rejected with a substring check before any regex runs.
+"""
+
+import re
+
+# Maps command names to their compiled trigger patterns, in registration
+# order.
+_commands = {}
+
+# Compiled mention patterns, by username.
+_mentions = {}
+
+
+def register(name, patterns):
+    """Registers a command triggered by any of the given regexes."""
+    _commands[name] = [re.compile(pattern, re.I) for pattern in patterns]
+
+
+def _mention_pattern(user):
+    pattern = _mentions.get(user)
+    if pattern is None:
+        pattern = _mentions[user] = re.compile(
+            r'@{}\s+\b(.+)'.format(re.escape(user)), re.I)
+    return pattern
+
+
+def get_command_text(text, user):
+    """Returns the text addressed to user, or None if it isn't mentioned."""
+    # Cheap checks first: nearly every comment fails one of these.
+    if '@' not in text or '@' + user.lower() not in text.lower():
+        return None
+
+    mention = _mention_pattern(user).search(text)
+    if not mention:
+        return None
+
+    # Just get the meat of the command
+    return mention.group(1).strip()
+
+
+def parse(text, user):
+    """Returns the names of the commands in text addressed to user."""
+    command_text = get_command_text(text, user)
+    if command_text is None:
+        return []
+
+    return [
+        name for name, patterns in _commands.items()
+        if any(pattern.search(command_text) for pattern in patterns)]
@@ -0,0 +1,106 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmark for the issue comment command parser.
+
+Compares bot_commands against the per-comment regex building it replaced,
+over a corpus of comment bodies typical of the repositories the bot serves.
+Pass a file of comment bodies separated by blank lines to use your own.
+
+    python bot_commands_benchmark.py [comments.txt]
+"""
+
+import os
+import re
+import sys
+import timeit
+
+os.environ.setdefault('GITHUB_USER', 'dpebot')
+
+import webhooks  # noqa: E402
+
+CORPUS = [
+    'LGTM',
+    'Thanks for the fix! Could you also update the README?',
+    'Looks like the Kokoro build failed on an unrelated flaky test. '
+    'Re-running.',
+    'nit: this import is unused',
+    '@dpebot merge when travis passes',
+    'I signed it!',
+    'We found a Contributor License Agreement for you (the sender of this '
+    'pull request), but were unable to find agreements for all the commit '
+    'author(s) or Co-authors.',
+    '@googlebot I fixed it.',
+    'Can you add a region tag around this snippet so it shows up in the '
+    'docs?\n\n```python\n# [START storage_upload_file]\n```',
+    '@dpebot please merge when ci is green',
+    'Closing in favor of #1234.',
+    ':+1: approved',
+    'This sample needs to pin google-cloud-storage to >= 1.13 because of '
+    'the new retry behavior. See '
+    'https://github.com/googleapis/google-cloud-python/issues/5678 for '
+    'details.\n\n' * 3,
+    '@jdoe can you take a look at this one?',
+    'Tests pass locally, merging once CI is happy.',
+    '@dpebot tests pass, merge',
+    'Rebased on master.',
+    '/gcbrun',
+    'Updated per review comments, PTAL.',
+    '@dpebot LGTM',
+]
+
+
+def legacy_check_for_auto_merge_trigger(text):
+    """The parser before bot_commands, for comparison."""
+    comment = re.search(
+        r'@{}\s+\b(.+)'.format(os.environ['GITHUB_USER']), text, re.I)
+    if not comment:
+        return False
+    else:
+        comment = comment.group(1).strip()
+
+    satisfaction = r'\b(pass|passes|green|approv(e|al|es|ed)|happy|satisfied)'
+    ci_tool = r'\b(travis|tests|statuses|kokoro|ci)\b'
+    merge_action = r'\bmerge\b'
+    triggers = (
+        r'{}.+({}.+)?{}'.format(merge_action, ci_tool, satisfaction),
+        r'{}.+{},.+{}'.format(ci_tool, satisfaction, merge_action),
+        'lgtm',
+    )
+
+    return any(re.search(trigger, comment, re.I) for trigger in triggers)
+
+
+def load_corpus(path):
+    with open(path) as f:
+        return [body for body in f.read().split('\n\n') if body.strip()]
+
+
+def run(corpus, number=2000):
+    for text in corpus:
+        assert (webhooks.check_for_auto_merge_trigger(text) ==
+                legacy_check_for_auto_merge_trigger(text)), text
+
+    for name, check in (
+            ('legacy', legacy_check_for_auto_merge_trigger),
+            ('bot_commands', webhooks.check_for_auto_merge_trigger)):
+        seconds = min(timeit.repeat(
+            lambda: [check(text) for text in corpus],
+            number=number, repeat=3))
+        print('{:>14}: {:.2f} us/comment'.format(
+            name, seconds / number / len(corpus) * 1e6))
+
+
+if __name__ == '__main__':
+    run(load_corpus(sys.argv[1]) if len(sys.argv) > 1 else CORPUS)
@@ -0,0 +1,52 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import bot_commands
+import webhooks
+
+
+@pytest.fixture(autouse=True)
+def bot_user(monkeypatch):
+    monkeypatch.setenv('GITHUB_USER', 'dpebot')
+
+
+@pytest.mark.parametrize('text', [
+    '@dpebot merge when travis passes',
+    '@DPEBot please merge when ci is green',
+    'Thanks!\n@dpebot tests pass, merge',
+    '@dpebot LGTM',
+])
+def test_auto_merge_triggers(text):
+    assert webhooks.check_for_auto_merge_trigger(text)
+
+
+@pytest.mark.parametrize('text', [
+    'merge when travis passes',
+    'LGTM',
+    '@dpebot hello there',
+    '@dpebotx merge when travis passes',
+    'ping @someone-else merge when green',
+])
+def test_not_auto_merge_triggers(text):
+    assert not webhooks.check_for_auto_merge_trigger(text)
+
+
+def test_registered_commands(monkeypatch):
+    monkeypatch.setattr(bot_commands, '_commands', {})
+    bot_commands.register('test-rerun', [r'\brerun\b'])
+
+    assert bot_commands.parse('@dpebot rerun', 'dpebot') == ['test-rerun']
+    assert bot_commands.parse('rerun', 'dpebot') == []
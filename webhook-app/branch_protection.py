@@ -0,0 +1,82 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A cache of the status contexts each branch requires before merging.
+
+Branch protection settings hardly ever change, so they're fetched once per
+branch and kept in the local database, shared by all workers, until a
+branch_protection_rule or repository event says they may have changed. As a
+fallback, entries older than BRANCH_PROTECTION_MAX_AGE seconds are refetched.
+"""
+
+import json
+import os
+import time
+
+import local_db
+import metrics
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS branch_protection (
+    repo TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    contexts TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (repo, branch)
+);
+"""
+
+_initialized_paths = set()
+
+
+def _connection(path=None):
+    connection = local_db.get_connection(path)
+    path = path or local_db.database_path()
+    if path not in _initialized_paths:
+        connection.executescript(_SCHEMA)
+        _initialized_paths.add(path)
+    return connection
+
+
+def _max_age():
+    return float(os.environ.get('BRANCH_PROTECTION_MAX_AGE', 24 * 60 * 60))
+
+
+def get(repo_full_name, branch, path=None):
+    """Returns the required contexts cached for a branch, or None."""
+    row = _connection(path).execute(
+        'SELECT contexts, fetched_at FROM branch_protection '
+        'WHERE repo = ? AND branch = ?',
+        (repo_full_name, branch)).fetchone()
+
+    if row is None or row['fetched_at'] < time.time() - _max_age():
+        metrics.CACHE_LOOKUPS.labels('branch_protection', 'miss').inc()
+        return None
+
+    metrics.CACHE_LOOKUPS.labels('branch_protection', 'hit').inc()
+    return json.loads(row['contexts'])
+
+
+def put(repo_full_name, branch, contexts, path=None):
+    """Caches the required contexts of a branch."""
+    _connection(path).execute(
+        'INSERT OR REPLACE INTO branch_protection '
+        '(repo, branch, contexts, fetched_at) VALUES (?, ?, ?, ?)',
+        (repo_full_name, branch, json.dumps(list(contexts)), time.time()))
+
+
+def invalidate(repo_full_name, path=None):
+    """Drops the cached settings of every branch in a repository."""
+    _connection(path).execute(
+        'DELETE FROM branch_protection WHERE repo = ?', (repo_full_name,))
@@ -0,0 +1,42 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import branch_protection
+import webhooks
+
+
+def test_get_put_invalidate(tmpdir, monkeypatch):
+    monkeypatch.setenv('WEBHOOK_DB_PATH', str(tmpdir.join('test.db')))
+
+    assert branch_protection.get('octo/repo', 'master') is None
+
+    branch_protection.put('octo/repo', 'master', ['ci', 'cla'])
+    branch_protection.put('octo/repo', 'release', [])
+    branch_protection.put('octo/other', 'master', ['ci'])
+    assert branch_protection.get('octo/repo', 'master') == ['ci', 'cla']
+    assert branch_protection.get('octo/repo', 'release') == []
+
+    webhooks.invalidate_branch_protection(
+        {'action': 'edited', 'repository': {'full_name': 'octo/repo'}})
+    assert branch_protection.get('octo/repo', 'master') is None
+    assert branch_protection.get('octo/repo', 'release') is None
+    assert branch_protection.get('octo/other', 'master') == ['ci']
+
+
+def test_max_age(tmpdir, monkeypatch):
+    monkeypatch.setenv('WEBHOOK_DB_PATH', str(tmpdir.join('test.db')))
+    monkeypatch.setenv('BRANCH_PROTECTION_MAX_AGE', '-1')
+
+    branch_protection.put('octo/repo', 'master', ['ci'])
+    assert branch_protection.get('octo/repo', 'master') is None
@@ -0,0 +1,53 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Named checkpoints that let periodic jobs pick up where they left off.
+
+Checkpoints live in the local database, so they are shared by the workers on
+a host and survive restarts.
+"""
+
+import local_db
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_initialized_paths = set()
+
+
+def _connection(path=None):
+    connection = local_db.get_connection(path)
+    path = path or local_db.database_path()
+    if path not in _initialized_paths:
+        connection.executescript(_SCHEMA)
+        _initialized_paths.add(path)
+    return connection
+
+
+def load(name, path=None):
+    """Returns the value saved for a checkpoint, or None."""
+    row = _connection(path).execute(
+        'SELECT value FROM checkpoints WHERE name = ?', (name,)).fetchone()
+    return row['value'] if row is not None else None
+
+
+def save(name, value, path=None):
+    """Saves a checkpoint's value."""
+    _connection(path).execute(
+        'INSERT OR REPLACE INTO checkpoints (name, value) VALUES (?, ?)',
+        (name, value))
@@ -0,0 +1,340 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A durable queue of webhook deliveries.
+
+When queueing is enabled the webhook endpoint only verifies the signature and
+stores the delivery in the local database. Background threads in every worker
+process then drain the queue and call the registered listeners, retrying
+failed deliveries with exponential backoff.
+
+Deliveries can be given a coalescing key. A delivery whose key matches one
+that is still waiting to be processed replaces its payload instead of being
+queued again, and a delivery is not claimed while another one with its key
+is being processed. Successful status events are coalesced per repository
+and commit so a CI run reporting many contexts triggers a single merge
+evaluation.
+
+Processed deliveries are kept for a day and dead ones, which ran out of
+attempts, for a week so they can be inspected. Idle workers then purge them.
+"""
+
+from collections import namedtuple
+import json
+import logging
+import os
+import threading
+import time
+
+from prometheus_client.core import GaugeMetricFamily
+
+import local_db
+import webhook_helper
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS deliveries (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    delivery_id TEXT,
+    event TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    leased_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT,
+    dead INTEGER NOT NULL DEFAULT 0,
+    coalesce_key TEXT,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS deliveries_available
+    ON deliveries (dead, available_at);
+"""
+
+_COALESCE_INDEX = """
+CREATE INDEX IF NOT EXISTS deliveries_coalesce_key
+    ON deliveries (coalesce_key);
+"""
+
+Delivery = namedtuple(
+    'Delivery', ['id', 'delivery_id', 'event', 'payload', 'attempts'])
+
+
+def enabled():
+    """True if deliveries should be queued instead of processed inline."""
+    return os.environ.get('WEBHOOK_QUEUE', '').lower() in ('1', 'true', 'yes')
+
+
+def coalesce_window():
+    """Seconds to hold a coalescable delivery for others to merge into."""
+    return float(os.environ.get('WEBHOOK_COALESCE_SECONDS', 5))
+
+
+def coalesce_key(event, payload):
+    """Returns the coalescing key for a delivery, or None.
+
+    Only successful status events are coalesced; every other status is
+    ignored by the listeners anyway.
+    """
+    if event != 'status':
+        return None
+
+    data = json.loads(payload)
+    if data.get('state') != 'success':
+        return None
+
+    return 'status:{}:{}'.format(
+        data['repository']['full_name'], data['sha'])
+
+
+class DeliveryQueue(object):
+    """A queue of webhook deliveries stored in SQLite.
+
+    A claimed delivery is leased to the claiming worker. If the worker dies
+    before completing or failing it, the delivery becomes available again
+    once the lease expires.
+    """
+
+    def __init__(self, path=None, max_attempts=5, lease_seconds=600,
+                 base_backoff=5, max_backoff=600, done_retention=24 * 3600,
+                 dead_retention=7 * 24 * 3600, purge_interval=600):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.done_retention = done_retention
+        self.dead_retention = dead_retention
+        self.purge_interval = purge_interval
+        self._purged_at = 0
+        self._wakeup = threading.Event()
+        connection = self._connection()
+        connection.executescript(_SCHEMA)
+        columns = [
+            row['name'] for row in
+            connection.execute('PRAGMA table_info(deliveries)')]
+        if 'coalesce_key' not in columns:
+            connection.execute(
+                'ALTER TABLE deliveries ADD COLUMN coalesce_key TEXT')
+        if 'finished_at' not in columns:
+            connection.execute(
+                'ALTER TABLE deliveries ADD COLUMN finished_at REAL')
+            # Start the retention period of older dead deliveries now.
+            connection.execute(
+                'UPDATE deliveries SET finished_at = ? WHERE dead = 1',
+                (time.time(),))
+        connection.executescript(_COALESCE_INDEX)
+
+    def _connection(self):
+        return local_db.get_connection(self.path)
+
+    def enqueue(self, event, payload, delivery_id=None, coalesce_key=None,
+                delay=0):
+        """Stores a delivery. payload is the raw request body.
+
+        If a delivery with the same coalesce_key is still waiting, its payload
+        is replaced and no new delivery is added. delay holds the delivery
+        back for that many seconds.
+        """
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = None
+            if coalesce_key is not None:
+                row = connection.execute(
+                    'SELECT id FROM deliveries WHERE coalesce_key = ? '
+                    'AND dead = 0 AND finished_at IS NULL '
+                    'AND leased_until <= ?',
+                    (coalesce_key, now)).fetchone()
+
+            if row is not None:
+                logging.info('Coalescing delivery {} into {}.'.format(
+                    delivery_id, coalesce_key))
+                connection.execute(
+                    'UPDATE deliveries SET delivery_id = ?, payload = ? '
+                    'WHERE id = ?', (delivery_id, payload, row['id']))
+            else:
+                connection.execute(
+                    'INSERT INTO deliveries (delivery_id, event, payload, '
+                    'available_at, coalesce_key) VALUES (?, ?, ?, ?, ?)',
+                    (delivery_id, event, payload, now + delay,
+                     coalesce_key))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        self._wakeup.set()
+
+    def claim(self):
+        """Leases the oldest available delivery, or returns None."""
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Skip deliveries whose key is already being processed.
+            row = connection.execute(
+                'SELECT id, delivery_id, event, payload, attempts '
+                'FROM deliveries AS d WHERE dead = 0 AND available_at <= ? '
+                'AND finished_at IS NULL AND leased_until <= ? '
+                'AND (coalesce_key IS NULL OR '
+                'NOT EXISTS (SELECT 1 FROM deliveries AS running '
+                'WHERE running.coalesce_key = d.coalesce_key '
+                'AND running.leased_until > ?)) ORDER BY id LIMIT 1',
+                (now, now, now)).fetchone()
+            if row is None:
+                connection.execute('COMMIT')
+                return None
+            connection.execute(
+                'UPDATE deliveries SET leased_until = ?, '
+                'attempts = attempts + 1 WHERE id = ?',
+                (now + self.lease_seconds, row['id']))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+
+        return Delivery(
+            row['id'], row['delivery_id'], row['event'], row['payload'],
+            row['attempts'] + 1)
+
+    def complete(self, delivery):
+        """Marks a delivery as successfully processed."""
+        self._connection().execute(
+            'UPDATE deliveries SET finished_at = ?, leased_until = 0 '
+            'WHERE id = ?', (time.time(), delivery.id))
+
+    def fail(self, delivery, error):
+        """Schedules a retry, or gives up after max_attempts."""
+        if delivery.attempts >= self.max_attempts:
+            logging.error('Giving up on delivery {} after {} attempts.'.format(
+                delivery.delivery_id, delivery.attempts))
+            self._connection().execute(
+                'UPDATE deliveries SET dead = 1, leased_until = 0, '
+                'finished_at = ?, last_error = ? WHERE id = ?',
+                (time.time(), error, delivery.id))
+            return
+
+        backoff = min(
+            self.base_backoff * 2 ** (delivery.attempts - 1), self.max_backoff)
+        self._connection().execute(
+            'UPDATE deliveries SET available_at = ?, leased_until = 0, '
+            'last_error = ? WHERE id = ?',
+            (time.time() + backoff, error, delivery.id))
+
+    def depth(self):
+        """Returns the number of deliveries waiting to be processed."""
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM deliveries WHERE dead = 0 '
+            'AND finished_at IS NULL').fetchone()[0]
+
+    def purge(self):
+        """Deletes processed and dead deliveries older than their retention
+        periods. Returns the number deleted."""
+        now = time.time()
+        self._purged_at = now
+        return self._connection().execute(
+            'DELETE FROM deliveries WHERE finished_at < ? - '
+            'CASE dead WHEN 0 THEN ? ELSE ? END',
+            (now, self.done_retention, self.dead_retention)).rowcount
+
+    def process_one(self):
+        """Claims and processes a single delivery.
+
+        Returns False if there was nothing to process.
+        """
+        delivery = self.claim()
+        if delivery is None:
+            return False
+
+        logging.info('Processing queued delivery {} ({}), attempt {}.'.format(
+            delivery.delivery_id, delivery.event, delivery.attempts))
+        try:
+            webhook_helper.process_event(
+                delivery.event, json.loads(delivery.payload))
+        except Exception as e:
+            logging.exception(
+                'Error processing delivery {}.'.format(delivery.delivery_id))
+            self.fail(delivery, repr(e))
+        else:
+            self.complete(delivery)
+        return True
+
+    def work(self, poll_interval=1):
+        """Drains the queue forever. Meant to run in a background thread."""
+        while True:
+            try:
+                if self.process_one():
+                    continue
+            except Exception:
+                logging.exception('Error claiming a queued delivery.')
+
+            if time.time() - self._purged_at >= self.purge_interval:
+                try:
+                    self.purge()
+                except Exception:
+                    logging.exception('Error purging finished deliveries.')
+            self._wakeup.wait(poll_interval)
+            self._wakeup.clear()
+
+
+class DepthCollector(object):
+    """Reports the queue depth when metrics are scraped. The queue is shared
+    by all workers, so any worker can report it."""
+
+    def collect(self):
+        yield GaugeMetricFamily(
+            'webhook_queue_depth', 'Deliveries waiting to be processed.',
+            value=get_queue().depth())
+
+
+_queue = None
+_queue_lock = threading.Lock()
+_workers_pid = None
+
+
+def get_queue():
+    """Returns this process's DeliveryQueue."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = DeliveryQueue(
+                max_attempts=int(
+                    os.environ.get('WEBHOOK_QUEUE_MAX_ATTEMPTS', 5)),
+                done_retention=3600 * float(
+                    os.environ.get('WEBHOOK_QUEUE_DONE_HOURS', 24)),
+                dead_retention=24 * 3600 * float(
+                    os.environ.get('WEBHOOK_QUEUE_DEAD_DAYS', 7)))
+        return _queue
+
+
+def start_workers(count=None):
+    """Starts the background threads that drain the queue.
+
+    Safe to call more than once; threads are only started once per process.
+    """
+    global _workers_pid
+    if count is None:
+        count = int(os.environ.get('WEBHOOK_QUEUE_WORKERS', 4))
+
+    queue = get_queue()
+    with _queue_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers_pid = os.getpid()
+
+    for n in range(count):
+        thread = threading.Thread(
+            target=queue.work, name='delivery-queue-{}'.format(n))
+        thread.daemon = True
+        thread.start()
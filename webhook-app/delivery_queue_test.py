@@ -0,0 +1,121 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import delivery_queue
+import webhook_helper
+
+
+def make_queue(tmp_path, **kwargs):
+    return delivery_queue.DeliveryQueue(
+        path=str(tmp_path / 'test.db'), **kwargs)
+
+
+def test_process_one(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        webhook_helper, 'process_event',
+        lambda event, data: calls.append((event, data)))
+    queue = make_queue(tmp_path)
+
+    queue.enqueue('ping', b'{"zen": "hi"}', delivery_id='abc')
+    assert queue.depth() == 1
+
+    assert queue.process_one()
+    assert calls == [('ping', {'zen': 'hi'})]
+    assert queue.depth() == 0
+    assert not queue.process_one()
+
+
+def test_claim_is_leased(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.enqueue('ping', b'{}')
+
+    assert queue.claim() is not None
+    assert queue.claim() is None
+
+
+def test_failed_delivery_is_retried_then_dropped(tmp_path, monkeypatch):
+    def explode(event, data):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(webhook_helper, 'process_event', explode)
+    queue = make_queue(tmp_path, max_attempts=2, base_backoff=0)
+    queue.enqueue('ping', b'{}')
+
+    assert queue.process_one()
+    assert queue.depth() == 1
+    assert queue.process_one()
+    assert queue.depth() == 0
+    assert not queue.process_one()
+
+
+def test_coalesces_pending_and_in_flight_deliveries(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.enqueue('status', b'{"n": 1}', coalesce_key='status:o/r:abc')
+    queue.enqueue('status', b'{"n": 2}', coalesce_key='status:o/r:abc')
+    assert queue.depth() == 1
+
+    running = queue.claim()
+    assert running.payload == b'{"n": 2}'
+
+    # Arrives while the first evaluation is running: waits for it to finish.
+    queue.enqueue('status', b'{"n": 3}', coalesce_key='status:o/r:abc')
+    assert queue.claim() is None
+
+    queue.complete(running)
+    assert queue.claim().payload == b'{"n": 3}'
+
+
+def test_purges_finished_deliveries_after_retention(tmp_path, monkeypatch):
+    def process_event(event, data):
+        if event == 'bad':
+            raise RuntimeError('boom')
+
+    monkeypatch.setattr(webhook_helper, 'process_event', process_event)
+    queue = make_queue(
+        tmp_path, max_attempts=1, done_retention=3600, dead_retention=86400)
+    queue.enqueue('ping', b'{}')
+    queue.enqueue('bad', b'{}')
+    assert queue.process_one()
+    assert queue.process_one()
+
+    def remaining():
+        return [row['event'] for row in queue._connection().execute(
+            'SELECT event FROM deliveries ORDER BY id')]
+
+    assert queue.depth() == 0
+    assert queue.purge() == 0
+    assert remaining() == ['ping', 'bad']
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 2 * 3600)
+    assert queue.purge() == 1
+    assert remaining() == ['bad']
+
+    monkeypatch.setattr(time, 'time', lambda: now + 2 * 86400)
+    assert queue.purge() == 1
+    assert remaining() == []
+
+
+def test_coalesce_key():
+    payload = (
+        b'{"state": "success", "sha": "abc", '
+        b'"repository": {"full_name": "o/r"}}')
+
+    assert delivery_queue.coalesce_key('status', payload) == 'status:o/r:abc'
+    assert delivery_queue.coalesce_key(
+        'status', payload.replace(b'success', b'pending')) is None
+    assert delivery_queue.coalesce_key('push', payload) is None
@@ -0,0 +1,521 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stand-in for the parts of the GitHub API the bot uses.
+
+Point the bot at it by setting GITHUB_API_URL to FakeGitHub.url. Every
+request is answered after a configurable delay with a well-formed object,
+and counted by endpoint. GET responses carry ETags and honor
+If-None-Match, and rate limit headers are sent, so the bot's caches and
+scheduler behave as they would against GitHub. Set page_size to split
+lists into pages linked by Link headers.
+
+Pull requests are registered with add_pull; seed() registers the ones
+referenced by a set of recorded deliveries. Anything else is assumed to be
+green, approved and administered by the bot.
+"""
+
+from collections import Counter
+import hashlib
+import http.server
+import json
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+def _user(base, login):
+    url = '{}/users/{}'.format(base, login)
+    return {
+        'login': login, 'id': abs(hash(login)) % 100000, 'type': 'User',
+        'site_admin': False, 'gravatar_id': '', 'url': url,
+        'html_url': 'https://github.com/{}'.format(login),
+        'avatar_url': 'https://avatars.githubusercontent.com/{}'.format(
+            login),
+        'events_url': url + '/events{/privacy}',
+        'followers_url': url + '/followers',
+        'following_url': url + '/following{/other_user}',
+        'gists_url': url + '/gists{/gist_id}',
+        'organizations_url': url + '/orgs',
+        'received_events_url': url + '/received_events',
+        'repos_url': url + '/repos',
+        'starred_url': url + '/starred{/owner}{/repo}',
+        'subscriptions_url': url + '/subscriptions',
+    }
+
+
+_REPO_URLS = {
+    'archive_url': '/{archive_format}{/ref}',
+    'assignees_url': '/assignees{/user}',
+    'blobs_url': '/git/blobs{/sha}',
+    'branches_url': '/branches{/branch}',
+    'collaborators_url': '/collaborators{/collaborator}',
+    'comments_url': '/comments{/number}',
+    'commits_url': '/commits{/sha}',
+    'compare_url': '/compare/{base}...{head}',
+    'contents_url': '/contents/{+path}',
+    'contributors_url': '/contributors',
+    'deployments_url': '/deployments',
+    'downloads_url': '/downloads',
+    'events_url': '/events',
+    'forks_url': '/forks',
+    'git_commits_url': '/git/commits{/sha}',
+    'git_refs_url': '/git/refs{/sha}',
+    'git_tags_url': '/git/tags{/sha}',
+    'hooks_url': '/hooks',
+    'issue_comment_url': '/issues/comments{/number}',
+    'issue_events_url': '/issues/events{/number}',
+    'issues_url': '/issues{/number}',
+    'keys_url': '/keys{/key_id}',
+    'labels_url': '/labels{/name}',
+    'languages_url': '/languages',
+    'merges_url': '/merges',
+    'milestones_url': '/milestones{/number}',
+    'notifications_url': '/notifications{?since,all,participating}',
+    'pulls_url': '/pulls{/number}',
+    'releases_url': '/releases{/id}',
+    'stargazers_url': '/stargazers',
+    'statuses_url': '/statuses/{sha}',
+    'subscribers_url': '/subscribers',
+    'subscription_url': '/subscription',
+    'tags_url': '/tags',
+    'teams_url': '/teams',
+    'trees_url': '/git/trees{/sha}',
+}
+
+
+def _repo(base, owner, name):
+    url = '{}/repos/{}/{}'.format(base, owner, name)
+    repo = {
+        'id': abs(hash((owner, name))) % 100000, 'name': name,
+        'full_name': '{}/{}'.format(owner, name),
+        'owner': _user(base, owner), 'private': False, 'fork': False,
+        'description': '', 'url': url,
+        'html_url': 'https://github.com/{}/{}'.format(owner, name),
+        'archived': False, 'default_branch': 'master',
+        'clone_url': 'https://github.com/{}/{}.git'.format(owner, name),
+        'git_url': 'git://github.com/{}/{}.git'.format(owner, name),
+        'ssh_url': 'git@github.com:{}/{}.git'.format(owner, name),
+        'svn_url': 'https://github.com/{}/{}'.format(owner, name),
+        'mirror_url': None, 'homepage': None, 'language': 'Python',
+        'created_at': '2016-01-01T00:00:00Z',
+        'updated_at': '2016-01-01T00:00:00Z',
+        'pushed_at': '2016-01-01T00:00:00Z',
+        'forks_count': 0, 'network_count': 0, 'open_issues_count': 0,
+        'size': 0, 'stargazers_count': 0, 'subscribers_count': 0,
+        'watchers_count': 0, 'has_downloads': True, 'has_issues': True,
+        'has_pages': False, 'has_projects': False, 'has_wiki': False,
+        'permissions': {'admin': True, 'push': True, 'pull': True},
+    }
+    for key, path in _REPO_URLS.items():
+        repo[key] = url + path
+    return repo
+
+
+def _label(base, owner, name, label):
+    return {
+        'id': abs(hash(label)) % 100000, 'name': label, 'color': 'ededed',
+        'default': False, 'description': None,
+        'url': '{}/repos/{}/{}/labels/{}'.format(base, owner, name, label),
+    }
+
+
+def _route_name(pattern):
+    """Turns a route pattern into a readable name for the call counts."""
+    name = re.sub(r'\(\?P<(\w+)>[^)]*\)', r'{\1}', pattern)
+    name = name.replace('[^/]+', '*').replace('.+', '*')
+    return re.sub(r'^/api(/v3)?', '', name)
+
+
+class FakeGitHub(object):
+    """Serves the fake API from a background thread.
+
+    Responses report a rate limit of rate_limit requests an hour, in windows
+    starting when the server is created, like GitHub's.
+    """
+
+    def __init__(self, latency=0.05, user='dpebot', host='127.0.0.1', port=0,
+                 rate_limit=5000):
+        self.latency = latency
+        self.user = user
+        self.rate_limit = rate_limit
+        # The (status, payload) answered for every branch's required
+        # statuses.
+        self.required_statuses = (200, [])
+        # The most items a page of a list holds, or None for no paging.
+        self.page_size = None
+        self.calls = Counter()
+        self._pulls = {}
+        self._lock = threading.Lock()
+        self._remaining = rate_limit
+        self._reset_at = int(time.time()) + 3600
+        self._server = http.server.ThreadingHTTPServer(
+            (host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        """The value to use for GITHUB_API_URL."""
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}/api/v3'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_pull(self, owner, name, number, sha, labels=('automerge',)):
+        """Registers an open pull request whose head is sha."""
+        with self._lock:
+            self._pulls[(owner, name, number)] = {
+                'sha': sha, 'labels': list(labels)}
+
+    def seed(self, deliveries):
+        """Registers the pull requests referenced by recorded deliveries:
+        PRs from pull_request and issue_comment events, and one automerge
+        PR for the commit of each status event."""
+        for event, data in deliveries:
+            repository = data.get('repository')
+            if not repository:
+                continue
+            owner, name = repository['owner']['login'], repository['name']
+
+            if 'pull_request' in data:
+                pull = data['pull_request']
+                self.add_pull(owner, name, pull['number'], pull['head']['sha'])
+            elif event == 'issue_comment' and 'pull_request' in data.get(
+                    'issue', {}):
+                self.add_pull(
+                    owner, name, data['issue']['number'],
+                    hashlib.sha1(str(data['issue']['number']).encode(
+                        'utf-8')).hexdigest())
+            elif event == 'status':
+                with self._lock:
+                    known = any(
+                        key[:2] == (owner, name) and pull['sha'] == data['sha']
+                        for key, pull in self._pulls.items())
+                if not known:
+                    # Numbered well clear of the PRs seen in other events.
+                    self.add_pull(
+                        owner, name, 100000 + len(self._pulls), data['sha'])
+
+    def _count_call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def _charge(self, charged):
+        """Counts a response against the rate limit if charged. Returns the
+        remaining requests and when the window resets."""
+        with self._lock:
+            if time.time() >= self._reset_at:
+                self._remaining = self.rate_limit
+                self._reset_at = int(time.time()) + 3600
+            if charged:
+                self._remaining = max(self._remaining - 1, 0)
+            return self._remaining, self._reset_at
+
+    def _paginate(self, path, items):
+        """Returns the page of items path asks for and the URL of the next
+        page, if there is one."""
+        if self.page_size is None:
+            return items, None
+        parsed = urlparse(path)
+        query = parse_qs(parsed.query)
+        per_page = min(
+            int(query.get('per_page', [self.page_size])[0]), self.page_size)
+        page = int(query.get('page', [1])[0])
+
+        next_url = None
+        if page * per_page < len(items):
+            query['page'] = [page + 1]
+            host, port = self._server.server_address[:2]
+            next_url = 'http://{}:{}{}?{}'.format(
+                host, port, parsed.path, urlencode(query, doseq=True))
+        return items[(page - 1) * per_page:page * per_page], next_url
+
+    def _get_pull(self, owner, name, number):
+        with self._lock:
+            return self._pulls.get((owner, name, number), {
+                'sha': hashlib.sha1(str(number).encode('utf-8')).hexdigest(),
+                'labels': ['automerge']})
+
+    # Objects
+
+    def _pull_json(self, owner, name, number):
+        state = self._get_pull(owner, name, number)
+        base = self.url
+        url = '{}/repos/{}/{}/pulls/{}'.format(base, owner, name, number)
+        issue_url = '{}/repos/{}/{}/issues/{}'.format(
+            base, owner, name, number)
+        repo = _repo(base, owner, name)
+        # Head on a fork so merging doesn't try to delete the branch.
+        head_repo = _repo(base, 'contributor', name)
+        return {
+            'id': number, 'number': number, 'url': url, 'state': 'open',
+            'title': 'Update dependencies', 'body': '', 'body_html': '',
+            'body_text': '', 'locked': False, 'active_lock_reason': None,
+            'user': _user(base, 'contributor'), 'assignee': None,
+            'assignees': [], 'requested_reviewers': [],
+            'requested_teams': [],
+            'labels': [
+                _label(base, owner, name, label)
+                for label in state['labels']],
+            'html_url': 'https://github.com/{}/{}/pull/{}'.format(
+                owner, name, number),
+            'diff_url': url + '.diff', 'patch_url': url + '.patch',
+            'issue_url': issue_url, 'commits_url': url + '/commits',
+            'comments_url': issue_url + '/comments',
+            'review_comments_url': url + '/comments',
+            'review_comment_url': '{}/repos/{}/{}/pulls/comments{{/number}}'
+            .format(base, owner, name),
+            'statuses_url': '{}/repos/{}/{}/statuses/{}'.format(
+                base, owner, name, state['sha']),
+            'created_at': '2016-01-01T00:00:00Z',
+            'updated_at': '2016-01-01T00:00:00Z',
+            'closed_at': None, 'merged_at': None, 'merge_commit_sha': None,
+            'merged': False, 'mergeable': True, 'mergeable_state': 'clean',
+            'merged_by': None, 'draft': False,
+            'author_association': 'CONTRIBUTOR', 'comments': 0,
+            'review_comments': 0, 'commits': 1, 'additions': 1,
+            'deletions': 1,
+            'head': {
+                'label': 'contributor:update', 'ref': 'update',
+                'sha': state['sha'], 'user': _user(base, 'contributor'),
+                'repo': head_repo},
+            'base': {
+                'label': '{}:master'.format(owner), 'ref': 'master',
+                'sha': '0' * 40, 'user': _user(base, owner), 'repo': repo},
+            '_links': {
+                'self': {'href': url}, 'html': {'href': url},
+                'issue': {'href': issue_url},
+                'comments': {'href': issue_url + '/comments'},
+                'review_comments': {'href': url + '/comments'},
+                'commits': {'href': url + '/commits'},
+                'statuses': {'href': url + '/statuses'}},
+        }
+
+    def _issue_json(self, owner, name, number):
+        state = self._get_pull(owner, name, number)
+        base = self.url
+        url = '{}/repos/{}/{}/issues/{}'.format(base, owner, name, number)
+        return {
+            'id': number, 'number': number, 'url': url, 'state': 'open',
+            'title': 'Update dependencies', 'body': '', 'body_html': '',
+            'body_text': '', 'locked': False, 'closed_by': None,
+            'user': _user(base, 'contributor'), 'assignee': None,
+            'assignees': [], 'milestone': None, 'comments': 0,
+            'labels': [
+                _label(base, owner, name, label)
+                for label in state['labels']],
+            'html_url': 'https://github.com/{}/{}/issues/{}'.format(
+                owner, name, number),
+            'comments_url': url + '/comments',
+            'events_url': url + '/events',
+            'labels_url': url + '/labels{/name}',
+            'repository_url': '{}/repos/{}/{}'.format(base, owner, name),
+            'pull_request': {
+                'url': '{}/repos/{}/{}/pulls/{}'.format(
+                    base, owner, name, number)},
+            'created_at': '2016-01-01T00:00:00Z',
+            'updated_at': '2016-01-01T00:00:00Z',
+            'closed_at': None,
+        }
+
+    def _comment_json(self, owner, name, number, body):
+        base = self.url
+        return {
+            'id': 1, 'body': body, 'body_html': '', 'body_text': body,
+            'user': _user(base, self.user),
+            'author_association': 'COLLABORATOR',
+            'url': '{}/repos/{}/{}/issues/comments/1'.format(
+                base, owner, name),
+            'html_url': 'https://github.com/{}/{}/issues/{}'.format(
+                owner, name, number),
+            'issue_url': '{}/repos/{}/{}/issues/{}'.format(
+                base, owner, name, number),
+            'created_at': '2016-01-01T00:00:00Z',
+            'updated_at': '2016-01-01T00:00:00Z',
+        }
+
+    def _ref_json(self, owner, name, ref):
+        url = '{}/repos/{}/{}/git/refs/{}'.format(self.url, owner, name, ref)
+        return {
+            'ref': 'refs/' + ref, 'url': url,
+            'object': {'sha': '0' * 40, 'type': 'commit', 'url': url}}
+
+    # Routes
+
+    def _routes(self):
+        repo = r'/api/v3/repos/(?P<owner>[^/]+)/(?P<name>[^/]+)'
+        number = r'(?P<number>\d+)'
+        return [
+            ('GET', r'/api/v3/user', lambda m, body: (
+                200, _user(self.url, self.user))),
+            ('GET', r'/api/v3/issues', lambda m, body: (200, [])),
+            ('GET', r'/api/v3/user/repository_invitations',
+                lambda m, body: self.required_statuses),
+            ('GET', repo, lambda m, body: (
+                200, _repo(self.url, m['owner'], m['name']))),
+            ('GET', repo + r'/pulls', self._list_pulls),
+            ('GET', repo + r'/pulls/' + number, lambda m, body: (
+                200, self._pull_json(
+                    m['owner'], m['name'], int(m['number'])))),
+            ('GET', repo + r'/pulls/' + number + r'/requested_reviewers',
+                lambda m, body: (200, {'users': [], 'teams': []})),
+            ('GET', repo + r'/pulls/' + number + r'/reviews',
+                lambda m, body: self.required_statuses),
+            ('PUT', repo + r'/pulls/' + number + r'/merge',
+                lambda m, body: (200, {
+                    'merged': True, 'sha': '0' * 40, 'message': 'Merged'})),
+            ('GET', repo + r'/issues/' + number, lambda m, body: (
+                200, self._issue_json(
+                    m['owner'], m['name'], int(m['number'])))),
+            ('PATCH', repo + r'/issues/' + number, lambda m, body: (
+                200, self._issue_json(
+                    m['owner'], m['name'], int(m['number'])))),
+            ('POST', repo + r'/issues/' + number + r'/assignees',
+                lambda m, body: (200, self._issue_json(
+                    m['owner'], m['name'], int(m['number'])))),
+            ('GET', repo + r'/issues/' + number + r'/labels',
+                self._list_labels),
+            ('POST', repo + r'/issues/' + number + r'/labels',
+                self._list_labels),
+            ('POST', repo + r'/issues/' + number + r'/comments',
+                lambda m, body: (201, self._comment_json(
+                    m['owner'], m['name'], int(m['number']),
+                    body.get('body', '')))),
+            ('GET', repo + r'/branches/[^/]+/protection/'
+                r'required_status_checks/contexts',
+                lambda m, body: self.required_statuses),
+            ('GET', repo + r'/commits/[^/]+/statuses', lambda m, body: (
+                200, [{'context': 'ci', 'state': 'success'}])),
+            ('GET', repo + r'/commits/[^/]+/status', lambda m, body: (
+                200, {'state': 'success', 'statuses': []})),
+            ('GET', repo + r'/collaborators/[^/]+/permission',
+                lambda m, body: (200, {'permission': 'admin'})),
+            ('GET', repo + r'/collaborators/[^/]+',
+                lambda m, body: (204, None)),
+            ('GET', repo + r'/git/refs/(?P<ref>.+)', lambda m, body: (
+                200, self._ref_json(m['owner'], m['name'], m['ref']))),
+            ('DELETE', repo + r'/git/refs/.+', lambda m, body: (204, None)),
+            ('GET', repo + r'/hooks', lambda m, body: (200, [])),
+            ('POST', r'/api/graphql', self._graphql),
+        ]
+
+    def _list_pulls(self, match, body):
+        with self._lock:
+            numbers = [
+                number for (owner, name, number) in self._pulls
+                if (owner, name) == (match['owner'], match['name'])]
+        return 200, [
+            self._pull_json(match['owner'], match['name'], number)
+            for number in numbers]
+
+    def _list_labels(self, match, body):
+        state = self._get_pull(
+            match['owner'], match['name'], int(match['number']))
+        return 200, [
+            _label(self.url, match['owner'], match['name'], label)
+            for label in state['labels']]
+
+    def _graphql(self, match, body):
+        variables = body.get('variables', {})
+        state = self._get_pull(
+            variables.get('owner'), variables.get('name'),
+            variables.get('number'))
+        return 200, {'data': {'repository': {
+            'pullRequest': {
+                'labels': {'nodes': [
+                    {'name': label} for label in state['labels']]},
+                'baseRef': {'branchProtectionRule': (
+                    {'requiredStatusCheckContexts':
+                        self.required_statuses[1]}
+                    if self.required_statuses[0] == 200 else None)},
+                'reviewRequests': {'nodes': []},
+                'latestReviews': {'nodes': []},
+            },
+            'object': {'status': {
+                'state': 'SUCCESS', 'contexts': [{'context': 'ci'}]}},
+        }}}
+
+    def _handler_class(self):
+        fake = self
+        routes = [
+            (method, re.compile(pattern + r'$'), handler,
+             _route_name(pattern))
+            for method, pattern, handler in self._routes()]
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self):
+                path = urlparse(self.path).path
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                body = json.loads(raw) if raw else {}
+
+                time.sleep(fake.latency)
+
+                for method, pattern, handler, name in routes:
+                    match = pattern.match(path)
+                    if method == self.command and match:
+                        fake._count_call('{} {}'.format(method, name))
+                        status, payload = handler(match.groupdict(), body)
+                        break
+                else:
+                    fake._count_call('{} (unknown)'.format(self.command))
+                    status, payload = 404, {'message': 'Not Found'}
+
+                next_url = None
+                if self.command == 'GET' and isinstance(payload, list):
+                    payload, next_url = fake._paginate(self.path, payload)
+
+                self._respond(status, payload, next_url)
+
+            def _respond(self, status, payload, next_url=None):
+                data = b'' if payload is None else json.dumps(
+                    payload).encode('utf-8')
+                etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+
+                if (self.command == 'GET' and status == 200 and
+                        self.headers.get('If-None-Match') == etag):
+                    status, data = 304, b''
+                remaining, reset_at = fake._charge(status != 304)
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('ETag', etag)
+                self.send_header('X-RateLimit-Limit', str(fake.rate_limit))
+                self.send_header('X-RateLimit-Remaining', str(remaining))
+                self.send_header('X-RateLimit-Reset', str(reset_at))
+                if next_url:
+                    self.send_header(
+                        'Link', '<{}>; rel="next"'.format(next_url))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,256 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coroutine versions of the github_helper calls on the automerge path.
+
+Used by the listeners in async serving mode (see asgi.py). Requests are sent
+with httpx over a keep-alive pool, one per event loop. They wait on the same
+rate limit scheduler and read through the same conditional-request cache as
+github_helper, and are labeled with the same function names in the metrics,
+so the two modes can be compared directly.
+
+Pull requests are plain API dicts here rather than github3 objects.
+"""
+
+import asyncio
+import os
+import weakref
+
+import httpx
+
+import branch_protection
+import github_helper
+import local_db
+import metrics
+import rate_limiter
+
+
+class _Session(object):
+    """An httpx client whose requests go through the rate limiter, like the
+    sync client's _PooledAdapter."""
+
+    def __init__(self):
+        token = os.environ['GITHUB_ACCESS_TOKEN']
+        pool_size = int(os.environ.get('GITHUB_POOL_SIZE', 16))
+        self.client = httpx.AsyncClient(
+            headers={
+                'Authorization': 'token {}'.format(token),
+                'Accept': 'application/vnd.github.v3.full+json',
+                'User-Agent': 'dpebot',
+            },
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=pool_size),
+            transport=httpx.AsyncHTTPTransport(retries=3),
+            timeout=30)
+        # Keyed by the token like the sync client's, so both modes share
+        # its quota.
+        self.scheduler = rate_limiter.get_scheduler(
+            rate_limiter.token_key(token))
+
+    async def request(self, method, url, **kwargs):
+        await self.scheduler.acquire_async(
+            conditional=rate_limiter.is_conditional(kwargs.get('headers')))
+        response = await self.client.request(method, url, **kwargs)
+        await local_db.run_async(self.scheduler.update, response)
+        metrics.GITHUB_RESPONSES.labels(
+            metrics.current_function(), response.status_code).inc()
+        return response
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+
+# httpx clients can't be shared between event loops.
+_sessions = weakref.WeakKeyDictionary()
+
+
+def get_session():
+    """Returns the session for the running event loop."""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None:
+        session = _sessions[loop] = _Session()
+    return session
+
+
+async def close_session():
+    """Closes the running event loop's session, if it has one."""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.client.aclose()
+
+
+def _repo_url(owner, repo, path=''):
+    return github_helper.api_url() + '/repos/{}/{}{}'.format(owner, repo, path)
+
+
+async def _cached_get(url, headers=None, ttl=github_helper._REVALIDATE):
+    response = await github_helper._read_cache.get_async(
+        get_session(), url, headers=headers, ttl=ttl)
+    response.raise_for_status()
+    return response
+
+
+async def iter_pages(url, headers=None, key=None, cached=False):
+    """Async version of github_helper.iter_pages."""
+    url = '{}{}per_page={}'.format(
+        url, '&' if '?' in url else '?', github_helper._MAX_PER_PAGE)
+
+    while url:
+        if cached:
+            response = await _cached_get(url, headers=headers)
+        else:
+            response = await get_session().get(url, headers=headers)
+            response.raise_for_status()
+
+        items = response.json()
+        if key is not None:
+            items = items.get(key, [])
+
+        for item in items:
+            yield item
+
+        url = response.links.get('next', {}).get('url')
+
+
+@metrics.instrument
+async def get_pull_request(owner, repo, number):
+    response = await _cached_get(
+        _repo_url(owner, repo, '/pulls/{}'.format(number)))
+    return response.json()
+
+
+@metrics.instrument
+async def list_open_pull_requests(owner, repo):
+    return [
+        pull async for pull in iter_pages(
+            _repo_url(owner, repo, '/pulls?state=open'))]
+
+
+@metrics.instrument
+async def get_pr_required_statuses(owner, repo, branch):
+    repo_full_name = '{}/{}'.format(owner, repo)
+    statuses = await local_db.run_async(
+        branch_protection.get, repo_full_name, branch)
+
+    if statuses is None:
+        statuses = github_helper.required_statuses_from_response(
+            await get_session().get(_repo_url(
+                owner, repo,
+                '/branches/{}/protection/required_status_checks/'
+                'contexts'.format(branch))))
+        await local_db.run_async(
+            branch_protection.put, repo_full_name, branch, statuses)
+
+    return statuses
+
+
+@metrics.instrument
+async def has_required_statuses(owner, repo, pull):
+    """Returns True if the PR has all the protected statuses present."""
+    required = await get_pr_required_statuses(
+        owner, repo, pull['base']['ref'])
+
+    if not len(required):
+        return True
+
+    # Stop paging through the statuses once every required one was seen.
+    missing = set(required)
+    statuses = iter_pages(
+        _repo_url(owner, repo, '/commits/{}/statuses'.format(
+            pull['head']['sha'])),
+        cached=True)
+    try:
+        async for status in statuses:
+            missing.discard(status['context'])
+            if not missing:
+                return True
+    finally:
+        await statuses.aclose()
+
+    return False
+
+
+@metrics.instrument
+async def is_pr_approved(owner, repo, number):
+    """True if the PR has been completely approved."""
+    requested_users = [
+        user['login'] async for user in iter_pages(
+            _repo_url(owner, repo, '/pulls/{}/requested_reviewers'.format(
+                number)),
+            key='users', cached=True)]
+
+    if not len(requested_users):
+        return True
+
+    # Required to access the PR review API.
+    headers = {'Accept': 'application/vnd.github.black-cat-preview+json'}
+    approved_users = [
+        review['user']['login'] async for review in iter_pages(
+            _repo_url(owner, repo, '/pulls/{}/reviews'.format(number)),
+            headers=headers, cached=True)
+        if review['state'] == 'APPROVED']
+
+    return github_helper.reviews_satisfy_requests(
+        requested_users, approved_users)
+
+
+@metrics.instrument
+async def is_sha_green(owner, repo, sha):
+    response = await _cached_get(
+        _repo_url(owner, repo, '/commits/{}/status'.format(sha)))
+    return response.json()['state'] == 'success'
+
+
+@metrics.instrument
+async def get_merge_readiness(owner, repo, number, sha):
+    """Async version of github_helper.get_merge_readiness."""
+    response = await get_session().request(
+        'POST', github_helper.graphql_url(),
+        json={
+            'query': github_helper.MERGE_READINESS_QUERY,
+            'variables': {
+                'owner': owner,
+                'name': repo,
+                'number': number,
+                'sha': sha,
+            }})
+    response.raise_for_status()
+
+    return github_helper.parse_merge_readiness(response.json())
+
+
+@metrics.instrument
+async def squash_merge_pr(owner, repo, number, sha):
+    data = {
+        'sha': sha,
+        'merge_method': 'squash'
+    }
+
+    response = await get_session().request(
+        'PUT', _repo_url(owner, repo, '/pulls/{}/merge'.format(number)),
+        json=data)
+
+    response.raise_for_status()
+    github_helper.invalidate_pull_request(owner, repo, number)
+
+    return response.json()
+
+
+@metrics.instrument
+async def delete_branch(owner, repo, branch):
+    response = await get_session().request(
+        'DELETE', _repo_url(owner, repo, '/git/refs/heads/{}'.format(branch)))
+    response.raise_for_status()
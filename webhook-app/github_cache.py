@@ -0,0 +1,131 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A conditional-request cache for GitHub API reads.
+
+Responses are kept with their ETag and Last-Modified headers. Within the TTL
+a cached response is returned without touching the network; after it, the
+request is revalidated with If-None-Match/If-Modified-Since. GitHub doesn't
+count 304 responses against the rate limit, so revalidating is nearly free.
+"""
+
+from collections import namedtuple, OrderedDict
+import threading
+import time
+
+import metrics
+
+_Entry = namedtuple('_Entry', ['response', 'fetched_at'])
+
+
+class ConditionalCache(object):
+    """A bounded, thread-safe LRU of GET responses keyed by URL and headers."""
+
+    def __init__(self, name, max_entries=1024, ttl=0):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(url, headers):
+        return (url, tuple(sorted((headers or {}).items())))
+
+    def _lookup(self, key, ttl):
+        """Returns the entry for key, if any, and whether it's still fresh."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            self._entries.move_to_end(key)
+            if time.time() - entry.fetched_at < ttl:
+                metrics.CACHE_LOOKUPS.labels(self.name, 'hit').inc()
+                return entry, True
+        return entry, False
+
+    @staticmethod
+    def _conditional_headers(entry, headers):
+        request_headers = dict(headers or {})
+        if entry is not None:
+            etag = entry.response.headers.get('ETag')
+            last_modified = entry.response.headers.get('Last-Modified')
+            if etag:
+                request_headers['If-None-Match'] = etag
+            if last_modified:
+                request_headers['If-Modified-Since'] = last_modified
+        return request_headers
+
+    def _record(self, key, entry, response):
+        """Stores a fresh response, or refreshes entry on a 304. Returns the
+        response to hand back."""
+        with self._lock:
+            if response.status_code == 304 and entry is not None:
+                metrics.CACHE_LOOKUPS.labels(self.name, 'revalidated').inc()
+                self._store(key, _Entry(entry.response, time.time()))
+                return entry.response
+
+            metrics.CACHE_LOOKUPS.labels(self.name, 'miss').inc()
+            if response.status_code < 400 and (
+                    response.headers.get('ETag') or
+                    response.headers.get('Last-Modified')):
+                self._store(key, _Entry(response, time.time()))
+
+        return response
+
+    def get(self, session, url, headers=None, ttl=None):
+        """Performs a GET through session, using the cache when possible.
+
+        ttl overrides the cache's default for this call. A ttl of 0 always
+        revalidates.
+        """
+        if ttl is None:
+            ttl = self.ttl
+        key = self._key(url, headers)
+
+        entry, fresh = self._lookup(key, ttl)
+        if fresh:
+            return entry.response
+
+        response = session.get(
+            url, headers=self._conditional_headers(entry, headers))
+        return self._record(key, entry, response)
+
+    async def get_async(self, session, url, headers=None, ttl=None):
+        """Like get, for a session whose get is a coroutine."""
+        if ttl is None:
+            ttl = self.ttl
+        key = self._key(url, headers)
+
+        entry, fresh = self._lookup(key, ttl)
+        if fresh:
+            return entry.response
+
+        response = await session.get(
+            url, headers=self._conditional_headers(entry, headers))
+        return self._record(key, entry, response)
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, url_prefix=''):
+        """Drops every cached response whose URL starts with url_prefix."""
+        with self._lock:
+            for key in [
+                    key for key in self._entries
+                    if key[0].startswith(url_prefix)]:
+                del self._entries[key]
@@ -0,0 +1,80 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import prometheus_client
+
+import github_cache
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.ok = status_code < 400
+
+
+class FakeSession(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append((url, headers))
+        return self.responses.pop(0)
+
+
+def _lookups(result):
+    return prometheus_client.REGISTRY.get_sample_value(
+        'github_cache_lookups_total',
+        {'cache': 'test', 'result': result}) or 0
+
+
+def test_revalidates_with_etag():
+    first = FakeResponse(200, {'ETag': '"abc"'})
+    session = FakeSession(first, FakeResponse(304))
+    cache = github_cache.ConditionalCache('test')
+    misses, revalidations = _lookups('miss'), _lookups('revalidated')
+
+    assert cache.get(session, 'https://x/a') is first
+    assert cache.get(session, 'https://x/a') is first
+    assert session.requests[1][1] == {'If-None-Match': '"abc"'}
+    assert _lookups('miss') == misses + 1
+    assert _lookups('revalidated') == revalidations + 1
+
+
+def test_ttl_and_invalidation():
+    first = FakeResponse(200, {'ETag': '"abc"'})
+    second = FakeResponse(200, {'ETag': '"def"'})
+    session = FakeSession(first, second)
+    cache = github_cache.ConditionalCache('test', ttl=60)
+    hits = _lookups('hit')
+
+    assert cache.get(session, 'https://x/a/b') is first
+    assert cache.get(session, 'https://x/a/b') is first
+    assert _lookups('hit') == hits + 1
+
+    cache.invalidate('https://x/a/')
+    assert cache.get(session, 'https://x/a/b') is second
+    assert session.requests[1][1] == {}
+
+
+def test_lru_is_bounded():
+    session = FakeSession(*[
+        FakeResponse(200, {'ETag': str(n)}) for n in range(3)])
+    cache = github_cache.ConditionalCache('test', max_entries=2)
+
+    for url in ('a', 'b', 'c'):
+        cache.get(session, url)
+
+    assert [key[0] for key in cache._entries] == ['b', 'c']
@@ -14,10 +14,68 @@
 
 """Helpers for interacting with the GitHub API and hook events."""
 
+from collections import namedtuple
 import json
 import os
+import threading
 
 import github3
+from requests.adapters import HTTPAdapter
+from urllib3 import connectionpool
+from urllib3.util.retry import Retry
+
+import branch_protection
+import github_cache
+import metrics
+import permissions
+import rate_limiter
+
+
+# Count newly opened connections so we can tell how often the pool is
+# reusing a warm connection.
+class _CountingHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    def _new_conn(self):
+        metrics.GITHUB_CONNECTIONS.inc()
+        return super(_CountingHTTPConnectionPool, self)._new_conn()
+
+
+class _CountingHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    def _new_conn(self):
+        metrics.GITHUB_CONNECTIONS.inc()
+        return super(_CountingHTTPSConnectionPool, self)._new_conn()
+
+
+class _PooledAdapter(HTTPAdapter):
+    """A keep-alive adapter that retries transient failures, counts
+    connection reuse and sends every request through the rate limiter."""
+
+    def __init__(self, scheduler, **kwargs):
+        self.scheduler = scheduler
+        super(_PooledAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_PooledAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _CountingHTTPConnectionPool,
+            'https': _CountingHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        self.scheduler.acquire(
+            conditional=rate_limiter.is_conditional(request.headers))
+
+        response = super(_PooledAdapter, self).send(request, **kwargs)
+
+        self.scheduler.update(response)
+        metrics.GITHUB_RESPONSES.labels(
+            metrics.current_function(), response.status_code).inc()
+        return response
+
+
+def pull_repository(pr):
+    """Returns the owner and name of the repository a github3 PR is made
+    to. pr.repository isn't a tuple in newer github3 versions."""
+    return pr.base.repo
 
 
 def github_user():
@@ -25,13 +83,93 @@ def github_user():
     return os.environ['GITHUB_USER']
 
 
+_PUBLIC_API_URL = 'https://api.github.com'
+
+
+def api_url():
+    """Returns the base URL of the REST API.
+
+    Set GITHUB_API_URL to use a GitHub Enterprise instance, or a stand-in
+    server such as fake_github, which serve the API under /api/v3.
+    """
+    return os.environ.get('GITHUB_API_URL', _PUBLIC_API_URL).rstrip('/')
+
+
+def graphql_url():
+    """Returns the URL of the GraphQL API."""
+    if api_url() == _PUBLIC_API_URL:
+        return _PUBLIC_API_URL + '/graphql'
+    return api_url()[:-len('/v3')] + '/graphql'
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def _configure_session(session, token):
+    retries = Retry(
+        total=3, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504))
+    pool_size = int(os.environ.get('GITHUB_POOL_SIZE', 16))
+    adapter = _PooledAdapter(
+        rate_limiter.get_scheduler(rate_limiter.token_key(token)),
+        pool_connections=4, pool_maxsize=pool_size, max_retries=retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
 def get_client():
-    """Returns an authenticated github3 client."""
-    gh = github3.login(
-        github_user(), os.environ['GITHUB_ACCESS_TOKEN'])
-    return gh
+    """Returns the authenticated github3 client shared by this process.
+
+    The client's session keeps a pool of keep-alive connections and is safe
+    to use from multiple threads. A new client is created after a fork so
+    that worker processes never share sockets.
+    """
+    global _client, _client_pid
+    with _client_lock:
+        if _client is None or _client_pid != os.getpid():
+            token = os.environ['GITHUB_ACCESS_TOKEN']
+            if api_url() == _PUBLIC_API_URL:
+                gh = github3.login(github_user(), token)
+            else:
+                gh = github3.enterprise_login(
+                    github_user(), token, url=api_url()[:-len('/api/v3')])
+            _configure_session(gh.session, token)
+            _client = gh
+            _client_pid = os.getpid()
+        return _client
+
+
+_read_cache = github_cache.ConditionalCache(
+    'github_reads', max_entries=int(os.environ.get('GITHUB_CACHE_SIZE', 1024)))
+
+# How long, in seconds, a read may be served without revalidating it. Anything
+# a webhook event can change is always revalidated; revalidation is free
+# against the rate limit when nothing changed. Slow-changing settings are
+# cached in the local database instead, see branch_protection and
+# permissions.
+_REVALIDATE = 0
+
 
+def _cached_get(session, url, headers=None, ttl=_REVALIDATE):
+    return _read_cache.get(session, url, headers=headers, ttl=ttl)
 
+
+def invalidate_pull_request(owner, repo, number):
+    """Drops cached reads for a pull request."""
+    _read_cache.invalidate(
+        api_url() + '/repos/{}/{}/pulls/{}/'.format(
+            owner, repo, number))
+
+
+def invalidate_commit(owner, repo, sha):
+    """Drops cached statuses for a commit."""
+    _read_cache.invalidate(
+        api_url() + '/repos/{}/{}/commits/{}/'.format(
+            owner, repo, sha))
+
+
+@metrics.instrument
 def get_repository(gh, data):
     """Gets the repository from hook event data."""
     return gh.repository(
@@ -43,6 +181,7 @@ def is_pull_request(data):
     return data.get('issue', {}).get('pull_request') is not None
 
 
+@metrics.instrument
 def get_pull_request(gh, data):
     """Gets the pull request from hook event data."""
     return gh.pull_request(
@@ -50,13 +189,47 @@ def get_pull_request(gh, data):
         data['issue']['number'])
 
 
+_MAX_PER_PAGE = 100
+
+
+def iter_pages(session, url, headers=None, key=None, cached=False):
+    """Yields the items of a paginated list endpoint.
+
+    Pages are fetched only as they're consumed, with the largest page size
+    GitHub allows, by following the response's Link header. key names the
+    field holding the list for endpoints that return an object. cached reads
+    each page through the conditional-request cache.
+    """
+    url = '{}{}per_page={}'.format(
+        url, '&' if '?' in url else '?', _MAX_PER_PAGE)
+
+    while url:
+        if cached:
+            response = _cached_get(session, url, headers=headers)
+        else:
+            response = session.get(url, headers=headers)
+        response.raise_for_status()
+
+        items = response.json()
+        if key is not None:
+            items = items.get(key, [])
+
+        for item in items:
+            yield item
+
+        url = response.links.get('next', {}).get('url')
+
+
+@metrics.instrument
 def accept_all_invitations(gh):
     """Accepts all invitations and returns a list of repositories."""
     # Required to access the invitations API.
     headers = {'Accept': 'application/vnd.github.swamp-thing-preview+json'}
-    invitations = gh.session.get(
-        'https://api.github.com/user/repository_invitations',
-        headers=headers).json()
+    # Read every page before accepting anything. An accepted invitation
+    # drops out of the list, which would shift the later pages.
+    invitations = list(iter_pages(
+        gh.session, api_url() + '/user/repository_invitations',
+        headers=headers))
 
     for invitation in invitations:
         gh.session.patch(invitation['url'], headers=headers)
@@ -64,51 +237,96 @@ def accept_all_invitations(gh):
     return [invitation['repository'] for invitation in invitations]
 
 
+@metrics.instrument
 def get_pr_requested_reviewers(pr):
-    """Gets a list of all requested reviewers on a PR."""
+    """Yields all requested reviewers on a PR."""
     url = (
-        'https://api.github.com/repos/{}/{}/pulls/{}'
+        api_url() + '/repos/{}/{}/pulls/{}'
         '/requested_reviewers'.format(
-            pr.repository[0], pr.repository[1], pr.number))
+            *pull_repository(pr), pr.number))
 
-    reviewers = pr.session.get(url).json()
-
-    return reviewers.get('users', [])
+    yield from iter_pages(pr.session, url, key='users', cached=True)
 
 
+@metrics.instrument
 def get_pr_reviews(pr):
-    """Gets a list of all submitted reviews on a PR. Does not list requested
+    """Yields all submitted reviews on a PR. Does not list requested
     reviews."""
     # Required to access the PR review API.
     headers = {'Accept': 'application/vnd.github.black-cat-preview+json'}
-    reviews = pr.session.get(
-        'https://api.github.com/repos/{}/{}/pulls/{}/reviews'.format(
-            pr.repository[0], pr.repository[1], pr.number),
-        headers=headers).json()
-
-    return reviews
+    yield from iter_pages(
+        pr.session,
+        api_url() + '/repos/{}/{}/pulls/{}/reviews'.format(
+            *pull_repository(pr), pr.number),
+        headers=headers, cached=True)
+
+
+# The 404 messages meaning a branch has no required statuses. GitHub also
+# answers 404 when the token can't read the branch's protection, which must
+# not be mistaken for having none.
+_NO_REQUIRED_STATUSES_MESSAGES = (
+    'Branch not protected', 'Required status checks not enabled')
+
+
+def required_statuses_from_response(response):
+    """Reads the required contexts from a protection/required_status_checks
+    response. Unprotected branches have none; any other error is raised, so
+    that the PR isn't merged and nothing is cached."""
+    if response.status_code == 404:
+        try:
+            message = response.json().get('message')
+        except ValueError:
+            message = None
+        if message in _NO_REQUIRED_STATUSES_MESSAGES:
+            return []
+    response.raise_for_status()
+    return response.json()
 
 
+@metrics.instrument
 def get_pr_required_statuses(pr):
     """Gets a list off all of the required statuses for a PR to be merged."""
-    statuses = pr.session.get(
-        'https://api.github.com/repos/{}/{}/branches/{}/protection/'
-        'required_status_checks/contexts'.format(
-            pr.repository[0], pr.repository[1], pr.base.ref)).json()
+    repo_full_name = '/'.join(pull_repository(pr))
+    statuses = branch_protection.get(repo_full_name, pr.base.ref)
+
+    if statuses is None:
+        statuses = required_statuses_from_response(pr.session.get(
+            api_url() + '/repos/{}/{}/branches/{}/protection/'
+            'required_status_checks/contexts'.format(
+                *pull_repository(pr), pr.base.ref)))
+        branch_protection.put(repo_full_name, pr.base.ref, statuses)
 
     return statuses
 
 
+@metrics.instrument
 def get_pr_statuses(pr):
-    """Gets a list of currently reported statuses for the commit."""
-    statuses = pr.session.get(
-        'https://api.github.com/repos/{}/{}/commits/{}/'
+    """Yields the contexts of the statuses reported for the commit."""
+    statuses = iter_pages(
+        pr.session,
+        api_url() + '/repos/{}/{}/commits/{}/'
         'statuses'.format(
-            pr.repository[0], pr.repository[1], pr.head.sha)).json()
+            *pull_repository(pr), pr.head.sha),
+        cached=True)
 
-    return [status['context'] for status in statuses]
+    for status in statuses:
+        yield status['context']
 
 
+def statuses_cover_required(required, listed):
+    """True if every required status context has been reported."""
+    return set(required).issubset(set(listed))
+
+
+def reviews_satisfy_requests(requested_users, approved_users):
+    """True if the approvals match the outstanding review requests."""
+    if not len(requested_users):
+        return True
+
+    return set(approved_users) == set(requested_users)
+
+
+@metrics.instrument
 def has_required_statuses(pr):
     """Returns True if the PR has all the protected statuses present."""
 
@@ -117,14 +335,20 @@ def has_required_statuses(pr):
     if not len(required):
         return True
 
-    listed = get_pr_statuses(pr)
+    # Stop paging through the statuses once every required one was seen.
+    missing = set(required)
+    for context in get_pr_statuses(pr):
+        missing.discard(context)
+        if not missing:
+            return True
 
-    return set(required).issubset(set(listed))
+    return False
 
 
+@metrics.instrument
 def is_pr_approved(pr):
     """True if the PR has been completely approved."""
-    review_requests = get_pr_requested_reviewers(pr)
+    review_requests = list(get_pr_requested_reviewers(pr))
 
     if not len(review_requests):
         return True
@@ -137,29 +361,138 @@ def is_pr_approved(pr):
 
     requested_users = [user['login'] for user in review_requests]
 
-    return set(approved_users) == set(requested_users)
+    return reviews_satisfy_requests(requested_users, approved_users)
 
 
+@metrics.instrument
 def is_sha_green(repo, sha):
-    url = 'https://api.github.com/repos/{}/{}/commits/{}/status'.format(
+    url = api_url() + '/repos/{}/{}/commits/{}/status'.format(
         repo.owner.login, repo.name, sha)
-    result = repo.session.get(url).json()
+    result = _cached_get(repo.session, url).json()
 
     return result['state'] == 'success'
 
 
+MergeReadiness = namedtuple('MergeReadiness', [
+    'labels', 'required_statuses', 'statuses', 'state', 'requested_users',
+    'approved_users'])
+
+MERGE_READINESS_QUERY = """
+query($owner: String!, $name: String!, $number: Int!, $sha: GitObjectID!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      labels(first: 100) { nodes { name } }
+      baseRef { branchProtectionRule { requiredStatusCheckContexts } }
+      reviewRequests(first: 100) {
+        nodes { requestedReviewer { ... on User { login } } }
+      }
+      latestReviews(first: 100) { nodes { state author { login } } }
+    }
+    object(oid: $sha) {
+      ... on Commit { status { state contexts { context } } }
+    }
+  }
+}
+"""
+
+
+@metrics.instrument
+def get_merge_readiness(pr, sha):
+    """Fetches everything the automerge gate looks at in a single GraphQL
+    query: labels, required status contexts, the statuses reported for sha,
+    its combined state, outstanding review requests and approvals.
+
+    required_statuses is None when the base branch has no protection rule
+    the token can see; see parse_merge_readiness."""
+    owner, name = pull_repository(pr)
+    response = pr.session.post(
+        graphql_url(),
+        json={
+            'query': MERGE_READINESS_QUERY,
+            'variables': {
+                'owner': owner,
+                'name': name,
+                'number': pr.number,
+                'sha': sha,
+            }})
+    response.raise_for_status()
+
+    return parse_merge_readiness(response.json())
+
+
+def parse_merge_readiness(result):
+    """Builds a MergeReadiness from the result of MERGE_READINESS_QUERY.
+
+    A null branchProtectionRule means either that the branch isn't protected
+    or that the token can't read its protection, so required_statuses is
+    None then, for the caller to look up over REST. Only each reviewer's
+    latest review counts, so a later request for changes undoes an
+    approval."""
+    if result.get('errors'):
+        raise ValueError('GraphQL query failed: {}'.format(result['errors']))
+
+    repository = result['data']['repository']
+    pull = repository['pullRequest']
+
+    protection = (pull['baseRef'] or {}).get('branchProtectionRule')
+    status = (repository['object'] or {}).get('status') or {}
+
+    return MergeReadiness(
+        labels=[label['name'] for label in pull['labels']['nodes']],
+        required_statuses=None if protection is None else (
+            protection.get('requiredStatusCheckContexts') or []),
+        statuses=[
+            context['context'] for context in status.get('contexts', [])],
+        state=status.get('state', 'PENDING').lower(),
+        requested_users=[
+            node['requestedReviewer']['login']
+            for node in pull['reviewRequests']['nodes']
+            if (node['requestedReviewer'] or {}).get('login')],
+        approved_users=[
+            node['author']['login']
+            for node in pull['latestReviews']['nodes']
+            if node['state'] == 'APPROVED' and node['author']])
+
+
+@metrics.instrument
 def get_permission(gh, owner, repo, user):
+    permission = permissions.get(owner, repo, user, 'permission')
+    if permission is not None:
+        return permission
+
     # Required to access the collaborators API.
     headers = {'Accept': 'application/vnd.github.korra-preview'}
 
-    result = gh.session.get(
-        'https://api.github.com/repos/{}/{}/collaborators'
+    response = _cached_get(
+        gh.session,
+        api_url() + '/repos/{}/{}/collaborators'
         '/{}/permission'.format(owner, repo, user),
-        headers=headers).json()
+        headers=headers)
+    response.raise_for_status()
+    permission = response.json()['permission']
+
+    permissions.put(owner, repo, user, 'permission', permission)
+    return permission
+
+
+@metrics.instrument
+def is_collaborator(gh, owner, repo, user):
+    """True if the user is a collaborator on the repository."""
+    collaborator = permissions.get(owner, repo, user, 'collaborator')
+    if collaborator is not None:
+        return collaborator
+
+    response = gh.session.get(
+        api_url() + '/repos/{}/{}/collaborators/{}'.format(owner, repo, user))
+    if response.status_code not in (204, 404):
+        response.raise_for_status()
+    collaborator = response.status_code == 204
 
-    return result['permission']
+    permissions.put(owner, repo, user, 'collaborator', collaborator)
+    return collaborator
 
 
+@metrics.instrument
 def squash_merge_pr(pr, sha):
     data = {
         'sha': sha,
@@ -167,10 +500,11 @@ def squash_merge_pr(pr, sha):
     }
 
     response = pr.session.put(
-        'https://api.github.com/repos/{}/{}/pulls/{}/merge'.format(
-            pr.repository[0], pr.repository[1], pr.number),
+        api_url() + '/repos/{}/{}/pulls/{}/merge'.format(
+            *pull_repository(pr), pr.number),
         json=data)
 
     response.raise_for_status()
+    invalidate_pull_request(*pull_repository(pr), pr.number)
 
     return response.json()
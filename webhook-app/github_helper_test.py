@@ -0,0 +1,211 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import httpx
+import prometheus_client
+import requests
+import pytest
+
+import branch_protection
+import fake_github
+import github_async
+import github_helper
+import webhooks
+
+
+@pytest.fixture
+def api(monkeypatch, tmpdir):
+    api = fake_github.FakeGitHub(latency=0).start()
+    monkeypatch.setenv('GITHUB_API_URL', api.url)
+    monkeypatch.setenv('GITHUB_ACCESS_TOKEN', 'token')
+    monkeypatch.setenv('WEBHOOK_DB_PATH', str(tmpdir.join('test.db')))
+    yield api
+    api.stop()
+
+
+def _required_statuses():
+    async def get():
+        try:
+            return await github_async.get_pr_required_statuses(
+                'octo', 'repo', 'master')
+        finally:
+            await github_async.close_session()
+    return asyncio.run(get())
+
+
+@pytest.mark.parametrize('message', [
+    'Branch not protected', 'Required status checks not enabled'])
+def test_unprotected_branch_has_no_required_statuses(api, message):
+    api.required_statuses = (404, {'message': message})
+
+    assert _required_statuses() == []
+    assert branch_protection.get('octo/repo', 'master') == []
+
+
+def test_unreadable_branch_protection_fails_closed(api):
+    # What GitHub answers when the token can't read the protection.
+    api.required_statuses = (404, {'message': 'Not Found'})
+
+    with pytest.raises(httpx.HTTPStatusError):
+        _required_statuses()
+    assert branch_protection.get('octo/repo', 'master') is None
+
+    api.required_statuses = (200, ['ci'])
+    assert _required_statuses() == ['ci']
+    assert branch_protection.get('octo/repo', 'master') == ['ci']
+
+
+def _readiness_result(protection=None, reviews=(), errors=None):
+    result = {'data': {'repository': {
+        'pullRequest': {
+            'labels': {'nodes': [{'name': 'automerge'}]},
+            'baseRef': {'branchProtectionRule': protection},
+            'reviewRequests': {'nodes': []},
+            'latestReviews': {'nodes': [
+                {'state': state, 'author': {'login': login}}
+                for login, state in reviews]},
+        },
+        'object': {'status': {
+            'state': 'SUCCESS', 'contexts': [{'context': 'ci'}]}},
+    }}}
+    if errors:
+        result['errors'] = errors
+    return result
+
+
+def test_parse_merge_readiness_approved():
+    readiness = github_helper.parse_merge_readiness(_readiness_result(
+        protection={'requiredStatusCheckContexts': ['ci']},
+        reviews=[('alice', 'APPROVED'), ('bob', 'COMMENTED')]))
+
+    assert readiness.labels == ['automerge']
+    assert readiness.required_statuses == ['ci']
+    assert readiness.statuses == ['ci']
+    assert readiness.state == 'success'
+    assert readiness.approved_users == ['alice']
+
+
+def test_parse_merge_readiness_changes_requested_after_approval():
+    # latestReviews only has each reviewer's last review.
+    readiness = github_helper.parse_merge_readiness(_readiness_result(
+        protection={'requiredStatusCheckContexts': []},
+        reviews=[('alice', 'CHANGES_REQUESTED')]))
+
+    assert readiness.approved_users == []
+
+
+def test_parse_merge_readiness_unknown_protection():
+    readiness = github_helper.parse_merge_readiness(_readiness_result())
+
+    assert readiness.required_statuses is None
+
+
+def test_parse_merge_readiness_errors():
+    with pytest.raises(ValueError):
+        github_helper.parse_merge_readiness(_readiness_result(
+            errors=[{'type': 'FORBIDDEN', 'message': 'Resource not accessible'}]))
+
+
+@pytest.fixture
+def sync_client(api, monkeypatch):
+    monkeypatch.setenv('GITHUB_USER', 'dpebot')
+    monkeypatch.setattr(github_helper, '_client', None)
+    return github_helper.get_client()
+
+
+@pytest.mark.parametrize('backend', ['rest', 'graphql'])
+def test_merge_pull_request(api, sync_client, monkeypatch, backend):
+    monkeypatch.setenv('AUTOMERGE_READINESS_BACKEND', backend)
+    api.add_pull('octo', 'repo', 7, 'abc123')
+    repo = sync_client.repository('octo', 'repo')
+
+    webhooks.merge_pull_request(
+        repo, repo.pull_request(7), commit_sha='abc123')
+
+    assert api.calls['PUT /repos/{owner}/{name}/pulls/{number}/merge'] == 1
+
+
+def test_graphql_gate_fails_closed_on_hidden_protection(
+        api, sync_client, monkeypatch):
+    monkeypatch.setenv('AUTOMERGE_READINESS_BACKEND', 'graphql')
+    api.required_statuses = (404, {'message': 'Not Found'})
+    api.add_pull('octo', 'repo', 7, 'abc123')
+    repo = sync_client.repository('octo', 'repo')
+
+    with pytest.raises(requests.HTTPError):
+        webhooks.merge_pull_request(
+            repo, repo.pull_request(7), commit_sha='abc123')
+
+    assert api.calls['PUT /repos/{owner}/{name}/pulls/{number}/merge'] == 0
+
+
+@pytest.fixture
+def session(api):
+    session = requests.Session()
+    github_helper._configure_session(session, 'token')
+    yield session
+    session.close()
+
+
+_PULLS = '/repos/{owner}/{name}/pulls'
+
+
+def test_iter_pages_follows_next_links(api, session):
+    api.page_size = 2
+    for number in range(1, 6):
+        api.add_pull('octo', 'repo', number, 'abc123')
+
+    pulls = github_helper.iter_pages(session, api.url + '/repos/octo/repo/pulls')
+
+    assert [pull['number'] for pull in pulls] == [1, 2, 3, 4, 5]
+    assert api.calls['GET ' + _PULLS] == 3
+
+
+def test_iter_pages_stops_when_the_consumer_does(api, session):
+    api.page_size = 2
+    for number in range(1, 6):
+        api.add_pull('octo', 'repo', number, 'abc123')
+
+    for pull in github_helper.iter_pages(
+            session, api.url + '/repos/octo/repo/pulls'):
+        if pull['number'] == 2:
+            break
+
+    assert api.calls['GET ' + _PULLS] == 1
+
+
+def test_iter_pages_raises_for_error_pages(api, session):
+    api.required_statuses = (403, {'message': 'Forbidden'})
+
+    with pytest.raises(requests.HTTPError):
+        list(github_helper.iter_pages(
+            session, api.url + '/user/repository_invitations'))
+
+
+def _new_connections():
+    return prometheus_client.REGISTRY.get_sample_value(
+        'github_api_new_connections_total') or 0
+
+
+def test_session_reuses_pooled_connections(api, session):
+    before = _new_connections()
+
+    session.get(api.url + '/user').raise_for_status()
+    assert _new_connections() == before + 1
+
+    session.get(api.url + '/user').raise_for_status()
+    assert _new_connections() == before + 1
+    assert api.calls['GET /user'] == 2
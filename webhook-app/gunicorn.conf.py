@@ -1,3 +1,24 @@
+import os
+import shutil
+
 workers = 4
 worker_class = 'sync'
+if os.environ.get('WEBHOOK_ASYNC', '').lower() in ('1', 'true', 'yes'):
+    # main:app is then the ASGI app from asgi.py.
+    worker_class = 'uvicorn_worker.UvicornWorker'
 timeout = 30
+
+# Each worker writes its metrics here so /metrics can aggregate them. This
+# has to be set before the workers import prometheus_client.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/dpebot-metrics')
+
+
+def on_starting(server):
+    # Drop samples left over from a previous run.
+    shutil.rmtree(os.environ['PROMETHEUS_MULTIPROC_DIR'], ignore_errors=True)
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,115 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request handling shared by the Flask app (main.py) and the ASGI app
+(asgi.py).
+
+The two apps only read requests and write responses their own way; what a
+request does and what it's answered with is decided here. Responses are
+(body, status) pairs.
+"""
+
+import json
+import logging
+
+import delivery_queue
+import jobs
+import metrics
+import scheduler
+import webhook_helper
+# Registers the jobs the /cron/ routes run.
+(jobs,)
+
+IGNORED = {'status': 'ignored'}
+QUEUED = {'status': 'queued'}
+
+
+def hello():
+    """Return a friendly HTTP greeting."""
+    return 'Hello World!', 200
+
+
+def metrics_output():
+    collectors = []
+    if delivery_queue.enabled():
+        collectors.append(delivery_queue.DepthCollector())
+    return metrics.generate(collectors), 200
+
+
+def event_name(headers):
+    return headers.get('X-GitHub-Event', 'ping')
+
+
+def ignores(event):
+    """True if a delivery can be answered with IGNORED before its body is
+    read, because nothing listens to its event."""
+    return not webhook_helper.has_listeners(event)
+
+
+def accept_delivery(event, headers, body):
+    """Logs and records a verified delivery and, if the delivery queue is on,
+    queues it for the background workers.
+
+    Returns the response if the delivery was queued. Otherwise returns None
+    and the caller processes the payload, see parse_payload.
+    """
+    delivery = headers.get('X-GitHub-Delivery')
+    logging.info('Delivery: {}'.format(delivery))
+    webhook_helper.record_delivery(headers, body)
+
+    # Acknowledge right away and let the background workers do the rest.
+    if delivery_queue.enabled():
+        key = delivery_queue.coalesce_key(event, body)
+        delivery_queue.get_queue().enqueue(
+            event, body, delivery_id=delivery, coalesce_key=key,
+            delay=delivery_queue.coalesce_window() if key else 0)
+        return QUEUED, 202
+
+
+def parse_payload(body):
+    return json.loads(body)
+
+
+def cron_paths():
+    """Returns the /cron/ route of each job, by job name."""
+    return {
+        name: '/cron/{}'.format(name) for name in scheduler.job_names()}
+
+
+def run_cron_job(name, headers):
+    """Runs a job for a request to its /cron/ route."""
+    if scheduler.skips_cron_request(headers):
+        return 'skipped, run by the scheduler', 200
+    try:
+        scheduler.run(name)
+    except scheduler.AlreadyRunning:
+        return 'already running', 409
+    return 'done', 200
+
+
+def error_response(error):
+    """Returns the response to a request that raised error."""
+    if isinstance(error, webhook_helper.SignatureError):
+        logging.warning('Rejected delivery: {}'.format(error))
+        return 'Bad signature.', 401
+
+    if isinstance(error, webhook_helper.PayloadTooLarge):
+        logging.warning('Rejected delivery: {}'.format(error))
+        return 'Payload too large.', 413
+
+    logging.exception('An error occurred during a request.')
+    return """
+    An internal error occurred: <pre>{}</pre>
+    See logs for full stacktrace.
+    """.format(error), 500
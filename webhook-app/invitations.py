@@ -17,15 +17,17 @@
 import logging
 
 import github_helper
+import rate_limiter
 
 
+@rate_limiter.priority(rate_limiter.LOW)
 def accept_invitations():
+    """Accepts all pending invitations. Returns how many there were."""
     gh = github_helper.get_client()
 
-    invitations = gh.session.get(
-        'https://api.github.com/user/repository_invitations').json()
-
-    for invitation in invitations:
-        gh.session.patch(invitation['url'])
+    repositories = github_helper.accept_all_invitations(gh)
+    for repository in repositories:
         logging.info('Accepted invite to {}'.format(
-            invitation['repository']['full_name']))
+            repository['full_name']))
+
+    return len(repositories)
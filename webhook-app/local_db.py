@@ -0,0 +1,66 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for the SQLite database shared by all workers on this host."""
+
+import asyncio
+import functools
+import os
+import sqlite3
+import threading
+
+_local = threading.local()
+
+
+def database_path():
+    """Returns the path of the local database file."""
+    return os.environ.get('WEBHOOK_DB_PATH', '/tmp/dpebot.db')
+
+
+def connect(path=None):
+    """Opens a connection to the local database.
+
+    Connections are in autocommit mode; callers that need a transaction
+    should issue ``BEGIN IMMEDIATE`` themselves. SQLite connections can't be
+    shared between threads, so each thread should open its own.
+    """
+    connection = sqlite3.connect(
+        path or database_path(), timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    # WAL lets readers proceed while another worker holds the write lock.
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+def get_connection(path=None):
+    """Returns this thread's cached connection to the local database."""
+    path = path or database_path()
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    if path not in connections:
+        connections[path] = connect(path)
+    return connections[path]
+
+
+async def run_async(function, *args, **kwargs):
+    """Calls a function that uses the local database in a thread.
+
+    Coroutines use this rather than calling the function directly, since a
+    query can wait for another worker's write lock and would block the
+    event loop meanwhile.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(function, *args, **kwargs))
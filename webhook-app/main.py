@@ -14,13 +14,17 @@
 
 import logging
 
-from flask import Flask, jsonify, request
-
-import invitations
-import webhook_creator
+from flask import Flask, jsonify, request, Response
+
+import asgi
+import delivery_queue
+import handlers
+import jobs
+import metrics
+import scheduler
 import webhook_helper
 import webhooks
-(webhooks)
+(jobs, webhooks)
 
 logging.basicConfig(level=logging.INFO)
 logging.getLogger('github3').setLevel(level=logging.WARNING)
@@ -31,43 +35,63 @@ logging.getLogger('oauth2client').setLevel(level=logging.WARNING)
 
 app = Flask(__name__)
 
+if delivery_queue.enabled():
+    delivery_queue.start_workers()
+
+if scheduler.enabled():
+    scheduler.start()
+
 
 @app.route('/')
 def hello():
-    """Return a friendly HTTP greeting."""
-    return 'Hello World!'
+    return handlers.hello()
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    output, status = handlers.metrics_output()
+    return Response(output, status=status, mimetype=metrics.CONTENT_TYPE)
 
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    webhook_helper.check_signature(
-        request.headers['X-Hub-Signature'],
-        request.data)
-    logging.info('Delivery: {}'.format(
-        request.headers.get('X-GitHub-Delivery')))
-    result = webhook_helper.process(request)
+    # Drop events nothing listens to before reading the body.
+    event = handlers.event_name(request.headers)
+    if handlers.ignores(event):
+        return jsonify(handlers.IGNORED)
+
+    body = webhook_helper.read_verified_body(request)
+    response = handlers.accept_delivery(event, request.headers, body)
+    if response is not None:
+        payload, status = response
+        return jsonify(payload), status
+
+    result = webhook_helper.process_event(
+        event, handlers.parse_payload(body))
     return jsonify(result)
 
 
-@app.route('/cron/create_webhooks')
-def cron_create_webhooks():
-    webhook_creator.create_webhooks()
-    return 'done'
+def _cron_endpoint(name):
+    def run_job():
+        return handlers.run_cron_job(name, request.headers)
+    return run_job
 
 
-@app.route('/cron/accept_invitations')
-def cron_accept_invitations():
-    invitations.accept_invitations()
-    return 'done'
+for _name, _path in handlers.cron_paths().items():
+    app.add_url_rule(_path, 'cron_' + _name, _cron_endpoint(_name))
 
 
+@app.errorhandler(webhook_helper.SignatureError)
+@app.errorhandler(webhook_helper.PayloadTooLarge)
 @app.errorhandler(500)
-def server_error(e):
-    logging.exception('An error occurred during a request.')
-    return """
-    An internal error occurred: <pre>{}</pre>
-    See logs for full stacktrace.
-    """.format(e), 500
+def error(e):
+    return handlers.error_response(e)
+
+
+# In async serving mode gunicorn.conf.py runs uvicorn workers, which serve
+# main:app as ASGI.
+if asgi.enabled():
+    app = asgi.app
 
 
 if __name__ == '__main__':
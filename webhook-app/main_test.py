@@ -12,6 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import hmac
+
 import main
 
 
@@ -22,3 +25,74 @@ def test_index():
     r = client.get('/')
     assert r.status_code == 200
     assert 'Hello World' in r.data.decode('utf-8')
+
+
+def test_webhook_ignores_events_without_listeners():
+    main.app.testing = True
+    client = main.app.test_client()
+
+    r = client.post('/webhook', headers={'X-GitHub-Event': 'workflow_job'})
+    assert r.status_code == 200
+    assert r.get_json() == {'status': 'ignored'}
+
+
+def test_webhook_checks_sha256_signature(monkeypatch):
+    monkeypatch.setenv('GITHUB_WEBHOOK_SECRET', 'secret')
+    main.app.testing = True
+    client = main.app.test_client()
+    body = b'{"zen": "Keep it logically awesome."}'
+    signature = hmac.new(b'secret', body, hashlib.sha256).hexdigest()
+
+    r = client.post('/webhook', data=body, headers={
+        'X-GitHub-Event': 'ping',
+        'X-Hub-Signature-256': 'sha256=' + signature})
+    assert r.status_code == 200
+    assert r.get_json() == {'msg': 'pong'}
+
+    r = client.post('/webhook', data=body + b' ', headers={
+        'X-GitHub-Event': 'ping',
+        'X-Hub-Signature-256': 'sha256=' + signature})
+    assert r.status_code == 401
+
+    r = client.post('/webhook', data=body, headers={'X-GitHub-Event': 'ping'})
+    assert r.status_code == 401
+
+
+def test_webhook_rejects_large_payloads(monkeypatch):
+    monkeypatch.setenv('GITHUB_WEBHOOK_SECRET', 'secret')
+    monkeypatch.setenv('WEBHOOK_MAX_BODY_BYTES', '10')
+    main.app.testing = True
+    client = main.app.test_client()
+
+    r = client.post('/webhook', data=b'{"a": "too long"}', headers={
+        'X-GitHub-Event': 'ping', 'X-Hub-Signature-256': 'sha256=0'})
+    assert r.status_code == 413
+
+
+def test_metrics():
+    main.app.testing = True
+    client = main.app.test_client()
+
+    client.post('/webhook', headers={'X-GitHub-Event': 'workflow_job'})
+    r = client.get('/metrics')
+    assert r.status_code == 200
+    assert 'webhook_event_seconds' in r.data.decode('utf-8')
+
+
+def test_cron_skipped_when_scheduler_runs_jobs(monkeypatch):
+    runs = []
+    monkeypatch.setattr(main.scheduler, 'run', runs.append)
+    main.app.testing = True
+    client = main.app.test_client()
+    cron = {'X-Appengine-Cron': 'true'}
+
+    assert client.get('/cron/create_webhooks', headers=cron).status_code == 200
+    assert runs == ['create_webhooks']
+
+    monkeypatch.setenv('WEBHOOK_SCHEDULER', '1')
+    r = client.get('/cron/create_webhooks', headers=cron)
+    assert r.status_code == 200
+    assert runs == ['create_webhooks']
+
+    client.get('/cron/create_webhooks')
+    assert runs == ['create_webhooks', 'create_webhooks']
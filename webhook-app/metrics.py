@@ -0,0 +1,140 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prometheus metrics for the webhook app.
+
+Under gunicorn every worker is its own process. When
+PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it) each worker writes
+its samples there and /metrics aggregates all of them, whichever worker
+serves the scrape.
+"""
+
+import contextvars
+import functools
+import inspect
+import os
+import time
+
+import prometheus_client
+from prometheus_client import multiprocess
+
+EVENT_SECONDS = prometheus_client.Histogram(
+    'webhook_event_seconds', 'Time spent processing a webhook event.',
+    ['event'])
+LISTENER_SECONDS = prometheus_client.Histogram(
+    'webhook_listener_seconds', 'Time spent in each webhook listener.',
+    ['listener'])
+LISTENER_ERRORS = prometheus_client.Counter(
+    'webhook_listener_errors_total',
+    'Listener calls that raised or timed out.', ['listener', 'reason'])
+GITHUB_CALL_SECONDS = prometheus_client.Histogram(
+    'github_helper_call_seconds',
+    'Time spent in each github_helper function.', ['function'])
+GITHUB_RESPONSES = prometheus_client.Counter(
+    'github_api_responses_total',
+    'GitHub API responses by github_helper function and status code.',
+    ['function', 'status'])
+GITHUB_CONNECTIONS = prometheus_client.Counter(
+    'github_api_new_connections_total',
+    'Connections opened to the GitHub API. Compare with '
+    'github_api_responses_total to see how often connections are reused.')
+RATE_LIMIT_REMAINING = prometheus_client.Gauge(
+    'github_rate_limit_remaining',
+    'Requests left in the current rate limit window, as last reported.',
+    multiprocess_mode='mostrecent')
+CACHE_LOOKUPS = prometheus_client.Counter(
+    'github_cache_lookups_total',
+    'Cache lookups by cache and result (hit, revalidated or miss).',
+    ['cache', 'result'])
+
+_current_function = contextvars.ContextVar(
+    'github_helper_function', default='other')
+
+
+def current_function():
+    """The github_helper function making the current request, if any."""
+    return _current_function.get()
+
+
+def instrument(function):
+    """Decorator that times a github_helper function and labels the API
+    responses it receives with its name. Generators are timed until they are
+    exhausted or closed, coroutines until they return."""
+    name = function.__name__
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            # Run each step in our own context so the label sticks between
+            # steps without leaking into the caller.
+            context = contextvars.copy_context()
+            context.run(_current_function.set, name)
+            generator = context.run(function, *args, **kwargs)
+            start = time.time()
+            try:
+                while True:
+                    try:
+                        item = context.run(next, generator)
+                    except StopIteration:
+                        return
+                    yield item
+            finally:
+                generator.close()
+                GITHUB_CALL_SECONDS.labels(name).observe(time.time() - start)
+        return generator_wrapper
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def coroutine_wrapper(*args, **kwargs):
+            token = _current_function.set(name)
+            start = time.time()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                GITHUB_CALL_SECONDS.labels(name).observe(time.time() - start)
+                _current_function.reset(token)
+        return coroutine_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        token = _current_function.set(name)
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            GITHUB_CALL_SECONDS.labels(name).observe(time.time() - start)
+            _current_function.reset(token)
+    return wrapper
+
+
+def generate(collectors=()):
+    """Returns the metrics of every worker, plus those of collectors, in the
+    Prometheus text format."""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    output = prometheus_client.generate_latest(registry)
+
+    if collectors:
+        extra = prometheus_client.CollectorRegistry()
+        for collector in collectors:
+            extra.register(collector)
+        output += prometheus_client.generate_latest(extra)
+
+    return output
+
+
+CONTENT_TYPE = prometheus_client.CONTENT_TYPE_LATEST
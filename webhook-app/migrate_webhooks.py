@@ -0,0 +1,44 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Narrows the events of the bot's existing webhooks to the ones it listens
+to.
+
+Only needed after the listened-to events change. It goes through every
+repository the bot administers, so it's run by hand rather than served:
+
+    GITHUB_USER=dpebot GITHUB_ACCESS_TOKEN=... \\
+        GITHUB_WEBHOOK_URL=... GITHUB_WEBHOOK_SECRET=... \\
+        python migrate_webhooks.py
+"""
+
+import argparse
+import logging
+
+import webhook_helper
+# Registers the listeners, which decide the events.
+import webhooks
+(webhooks,)
+
+
+def main():
+    argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter).parse_args()
+    logging.basicConfig(level=logging.INFO)
+    print('Updated {} hook(s).'.format(webhook_helper.migrate_webhooks()))
+
+
+if __name__ == '__main__':
+    main()
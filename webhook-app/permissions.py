@@ -0,0 +1,106 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A cache of users' access to repositories.
+
+Answers are kept per (owner, repo, user) in the local database, shared by all
+workers, for PERMISSION_CACHE_MAX_AGE seconds. member events drop a user's
+entries for a repository; membership and organization events, which only
+organization hooks receive, drop them for the whole organization. At most
+PERMISSION_CACHE_SIZE entries are kept.
+"""
+
+import json
+import os
+import time
+
+import local_db
+import metrics
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS permissions (
+    owner TEXT NOT NULL,
+    repo TEXT NOT NULL,
+    user TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (owner, repo, user, kind)
+);
+CREATE INDEX IF NOT EXISTS permissions_fetched_at
+    ON permissions (fetched_at);
+"""
+
+_initialized_paths = set()
+
+
+def _connection(path=None):
+    connection = local_db.get_connection(path)
+    path = path or local_db.database_path()
+    if path not in _initialized_paths:
+        connection.executescript(_SCHEMA)
+        _initialized_paths.add(path)
+    return connection
+
+
+def _max_age():
+    return float(os.environ.get('PERMISSION_CACHE_MAX_AGE', 60 * 60))
+
+
+def _max_entries():
+    return int(os.environ.get('PERMISSION_CACHE_SIZE', 10000))
+
+
+def get(owner, repo, user, kind, path=None):
+    """Returns the cached answer of the given kind, or None."""
+    row = _connection(path).execute(
+        'SELECT value, fetched_at FROM permissions '
+        'WHERE owner = ? AND repo = ? AND user = ? AND kind = ?',
+        (owner.lower(), repo.lower(), user.lower(), kind)).fetchone()
+
+    if row is None or row['fetched_at'] < time.time() - _max_age():
+        metrics.CACHE_LOOKUPS.labels('permissions', 'miss').inc()
+        return None
+
+    metrics.CACHE_LOOKUPS.labels('permissions', 'hit').inc()
+    return json.loads(row['value'])
+
+
+def put(owner, repo, user, kind, value, path=None):
+    """Caches an answer, evicting the oldest ones beyond the size limit."""
+    connection = _connection(path)
+    connection.execute(
+        'INSERT OR REPLACE INTO permissions '
+        '(owner, repo, user, kind, value, fetched_at) '
+        'VALUES (?, ?, ?, ?, ?, ?)',
+        (owner.lower(), repo.lower(), user.lower(), kind, json.dumps(value),
+         time.time()))
+    connection.execute(
+        'DELETE FROM permissions WHERE rowid IN ('
+        'SELECT rowid FROM permissions ORDER BY fetched_at DESC '
+        'LIMIT -1 OFFSET ?)', (_max_entries(),))
+
+
+def invalidate(owner, repo=None, user=None, path=None):
+    """Drops the cached answers for an owner, optionally narrowed to a
+    repository and/or a user."""
+    query = 'DELETE FROM permissions WHERE owner = ?'
+    args = [owner.lower()]
+    if repo is not None:
+        query += ' AND repo = ?'
+        args.append(repo.lower())
+    if user is not None:
+        query += ' AND user = ?'
+        args.append(user.lower())
+    _connection(path).execute(query, args)
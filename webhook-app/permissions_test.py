@@ -0,0 +1,65 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import permissions
+import webhook_helper
+import webhooks
+
+
+@pytest.fixture(autouse=True)
+def database(tmpdir, monkeypatch):
+    monkeypatch.setenv('WEBHOOK_DB_PATH', str(tmpdir.join('test.db')))
+
+
+def test_member_event_invalidates_user(monkeypatch):
+    permissions.put('Octo', 'repo', 'jdoe', 'collaborator', True)
+    permissions.put('octo', 'repo', 'other', 'collaborator', False)
+    assert permissions.get('octo', 'Repo', 'JDoe', 'collaborator') is True
+    assert permissions.get('octo', 'repo', 'jdoe', 'permission') is None
+
+    webhooks.invalidate_collaborator_permissions({
+        'action': 'removed', 'member': {'login': 'jdoe'},
+        'repository': {'name': 'repo', 'owner': {'login': 'octo'}}})
+
+    assert permissions.get('octo', 'repo', 'jdoe', 'collaborator') is None
+    assert permissions.get('octo', 'repo', 'other', 'collaborator') is False
+
+
+def test_organization_event_invalidates_all_repositories():
+    permissions.put('octo', 'one', 'jdoe', 'permission', 'admin')
+    permissions.put('octo', 'two', 'jdoe', 'permission', 'write')
+    permissions.put('other', 'one', 'jdoe', 'permission', 'read')
+
+    webhooks.invalidate_organization_permissions({
+        'action': 'member_removed', 'organization': {'login': 'octo'},
+        'membership': {'user': {'login': 'jdoe'}}})
+
+    assert permissions.get('octo', 'one', 'jdoe', 'permission') is None
+    assert permissions.get('octo', 'two', 'jdoe', 'permission') is None
+    assert permissions.get('other', 'one', 'jdoe', 'permission') == 'read'
+    assert 'organization' not in webhook_helper.subscribed_events()
+
+
+def test_size_and_age_limits(monkeypatch):
+    monkeypatch.setenv('PERMISSION_CACHE_SIZE', '2')
+    for user in ('a', 'b', 'c'):
+        permissions.put('octo', 'repo', user, 'permission', 'read')
+
+    assert permissions.get('octo', 'repo', 'a', 'permission') is None
+    assert permissions.get('octo', 'repo', 'c', 'permission') == 'read'
+
+    monkeypatch.setenv('PERMISSION_CACHE_MAX_AGE', '-1')
+    assert permissions.get('octo', 'repo', 'c', 'permission') is None
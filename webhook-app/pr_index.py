@@ -0,0 +1,127 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An index from head commit SHA to the open PRs labeled automerge.
+
+Status events only tell us the commit, not the PR. This index is kept up to
+date from pull_request events so status events can find their PRs without
+going through the search API. A repository that has never been indexed, or
+whose index is older than PR_INDEX_MAX_AGE seconds, is rebuilt on demand.
+"""
+
+import logging
+import os
+import time
+
+import local_db
+
+AUTOMERGE_LABEL = 'automerge'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS automerge_prs (
+    repo TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    sha TEXT NOT NULL,
+    PRIMARY KEY (repo, number)
+);
+CREATE INDEX IF NOT EXISTS automerge_prs_sha ON automerge_prs (repo, sha);
+CREATE TABLE IF NOT EXISTS automerge_indexed_repos (
+    repo TEXT PRIMARY KEY,
+    built_at REAL NOT NULL
+);
+"""
+
+_initialized_paths = set()
+
+
+def _connection(path=None):
+    connection = local_db.get_connection(path)
+    path = path or local_db.database_path()
+    if path not in _initialized_paths:
+        connection.executescript(_SCHEMA)
+        _initialized_paths.add(path)
+    return connection
+
+
+def _max_age():
+    return float(os.environ.get('PR_INDEX_MAX_AGE', 24 * 60 * 60))
+
+
+def _is_automerge(pull_data):
+    return (
+        pull_data['state'] == 'open' and
+        AUTOMERGE_LABEL in [
+            label['name'] for label in pull_data.get('labels', [])])
+
+
+def update(repo_full_name, pull_data, path=None):
+    """Adds or removes a PR from the index given its API representation."""
+    connection = _connection(path)
+    if _is_automerge(pull_data):
+        connection.execute(
+            'INSERT OR REPLACE INTO automerge_prs (repo, number, sha) '
+            'VALUES (?, ?, ?)',
+            (repo_full_name, pull_data['number'], pull_data['head']['sha']))
+    else:
+        connection.execute(
+            'DELETE FROM automerge_prs WHERE repo = ? AND number = ?',
+            (repo_full_name, pull_data['number']))
+
+
+def find(repo_full_name, sha, path=None):
+    """Returns the numbers of the automerge PRs whose head is sha.
+
+    Returns None if the repository's index is missing or stale.
+    """
+    connection = _connection(path)
+    row = connection.execute(
+        'SELECT built_at FROM automerge_indexed_repos WHERE repo = ?',
+        (repo_full_name,)).fetchone()
+    if row is None or row['built_at'] < time.time() - _max_age():
+        return None
+
+    return [
+        row['number'] for row in connection.execute(
+            'SELECT number FROM automerge_prs WHERE repo = ? AND sha = ?',
+            (repo_full_name, sha))]
+
+
+def rebuild(repository, path=None):
+    """Re-indexes all open PRs in a github3 repository."""
+    repo_full_name = repository.full_name
+    logging.info('Rebuilding automerge PR index for {}.'.format(
+        repo_full_name))
+
+    pulls = [
+        pull.as_dict() for pull in repository.pull_requests(state='open')]
+    replace(repo_full_name, pulls, path=path)
+
+
+def replace(repo_full_name, pulls, path=None):
+    """Replaces a repository's index with the given open PRs, in their API
+    representation."""
+    connection = _connection(path)
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        connection.execute(
+            'DELETE FROM automerge_prs WHERE repo = ?', (repo_full_name,))
+        for pull_data in pulls:
+            update(repo_full_name, pull_data, path=path)
+        connection.execute(
+            'INSERT OR REPLACE INTO automerge_indexed_repos (repo, built_at) '
+            'VALUES (?, ?)', (repo_full_name, time.time()))
+        connection.execute('COMMIT')
+    except Exception:
+        connection.execute('ROLLBACK')
+        raise
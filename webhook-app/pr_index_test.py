@@ -0,0 +1,94 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+import pr_index
+import webhooks
+
+REPO = 'octo/repo'
+
+
+@pytest.fixture(autouse=True)
+def database(tmpdir, monkeypatch):
+    monkeypatch.setenv('WEBHOOK_DB_PATH', str(tmpdir.join('test.db')))
+
+
+def _pull(number, sha, state='open', labels=('automerge',)):
+    return {
+        'number': number,
+        'state': state,
+        'head': {'sha': sha},
+        'labels': [{'name': label} for label in labels],
+    }
+
+
+def _event(action, pull):
+    return {
+        'action': action,
+        'pull_request': pull,
+        'repository': {'full_name': REPO},
+    }
+
+
+def test_find_needs_an_indexed_repository():
+    pr_index.update(REPO, _pull(1, 'aaa'))
+    assert pr_index.find(REPO, 'aaa') is None
+
+    pr_index.replace(REPO, [])
+    assert pr_index.find(REPO, 'aaa') == []
+
+
+def test_find_by_head_sha_after_synchronize():
+    pr_index.replace(REPO, [_pull(1, 'aaa'), _pull(2, 'bbb')])
+    assert pr_index.find(REPO, 'aaa') == [1]
+
+    webhooks.index_automerge_pull_request(
+        _event('synchronize', _pull(1, 'ccc')))
+
+    assert pr_index.find(REPO, 'aaa') == []
+    assert pr_index.find(REPO, 'ccc') == [1]
+    assert pr_index.find(REPO, 'bbb') == [2]
+    assert pr_index.find('octo/other', 'ccc') is None
+
+
+@pytest.mark.parametrize('action,pull', [
+    ('closed', _pull(1, 'aaa', state='closed')),
+    ('unlabeled', _pull(1, 'aaa', labels=())),
+])
+def test_update_drops_pull_request(action, pull):
+    pr_index.replace(REPO, [_pull(1, 'aaa')])
+
+    webhooks.index_automerge_pull_request(_event(action, pull))
+
+    assert pr_index.find(REPO, 'aaa') == []
+
+
+def test_replace_drops_stale_rows():
+    pr_index.replace(REPO, [_pull(1, 'aaa'), _pull(2, 'bbb')])
+    pr_index.replace(REPO, [
+        _pull(2, 'ddd'), _pull(3, 'eee', labels=()),
+        _pull(4, 'fff', state='closed')])
+
+    assert pr_index.find(REPO, 'aaa') == []
+    assert pr_index.find(REPO, 'bbb') == []
+    assert pr_index.find(REPO, 'ddd') == [2]
+    assert pr_index.find(REPO, 'eee') == []
+    assert pr_index.find(REPO, 'fff') == []
+
+
+def test_index_expires(monkeypatch):
+    pr_index.replace(REPO, [_pull(1, 'aaa')])
+    monkeypatch.setenv('PR_INDEX_MAX_AGE', '-1')
+    assert pr_index.find(REPO, 'aaa') is None
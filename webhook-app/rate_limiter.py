@@ -0,0 +1,339 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Schedules GitHub API requests around the rate limit.
+
+Every request made through the shared clients waits for a slot here. The
+quota GitHub reports in X-RateLimit-* headers is kept per token in the local
+database, so all the workers on a host pace themselves against the same
+numbers, and every request sent is counted against it until the next
+response says otherwise.
+
+Requests go out right away while the quota is plentiful. Each priority keeps
+a reserve of the quota for more urgent work: once what's left above it falls
+under a tenth of the limit, requests are spread evenly over the time left
+until the quota resets, and once it's gone they wait for the reset, so merges
+can still go through when housekeeping can't. Retry-After responses pause
+everyone. Conditional requests aren't counted, since GitHub doesn't charge
+for the 304s they mostly get. Within a worker, waiting requests are served
+highest priority first.
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import hashlib
+import heapq
+import itertools
+import threading
+import time
+
+import local_db
+import metrics
+
+# Priorities, most urgent first.
+HIGH = 0
+NORMAL = 1
+LOW = 2
+
+# Fraction of the quota each priority leaves for more urgent work.
+_RESERVES = {HIGH: 0.0, NORMAL: 0.05, LOW: 0.2}
+
+# Requests are paced once less than this fraction of the quota is left above
+# their reserve.
+_PACING_FRACTION = 0.1
+
+# How often waiting requests check whether they can go.
+_POLL_INTERVAL = 1
+
+_priority = contextvars.ContextVar('github_request_priority', default=NORMAL)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rate_limits (
+    key TEXT PRIMARY KEY,
+    quota INTEGER,
+    remaining INTEGER,
+    reset_at REAL NOT NULL DEFAULT 0,
+    blocked_until REAL NOT NULL DEFAULT 0,
+    sent_at REAL NOT NULL DEFAULT 0
+);
+"""
+
+_initialized_paths = set()
+
+
+def _connection(path=None):
+    connection = local_db.get_connection(path)
+    path = path or local_db.database_path()
+    if path not in _initialized_paths:
+        connection.executescript(_SCHEMA)
+        _initialized_paths.add(path)
+    return connection
+
+
+@contextlib.contextmanager
+def priority(level):
+    """Makes GitHub requests in the block, or in the decorated function, use
+    the given priority."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority():
+    return _priority.get()
+
+
+def token_key(token):
+    """Returns the key requests made with an access token are scheduled
+    under. It's a digest so the token itself isn't stored."""
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def is_conditional(headers):
+    """True if a request's headers make it a conditional request."""
+    return bool(headers) and (
+        'If-None-Match' in headers or 'If-Modified-Since' in headers)
+
+
+def describe():
+    """Describes how requests are paced, for benchmark reports."""
+    return (
+        'paced under {:.0%} of the quota above their reserve, reserves '
+        'high {:.0%}, normal {:.0%}, low {:.0%}'.format(
+            _PACING_FRACTION, _RESERVES[HIGH], _RESERVES[NORMAL],
+            _RESERVES[LOW]))
+
+
+def _delay(state, level, conditional, now):
+    """Seconds a request has to wait given a token's quota state, or 0."""
+    if state['blocked_until'] > now:
+        return state['blocked_until'] - now
+
+    if (conditional or state['remaining'] is None or
+            state['reset_at'] <= now):
+        return 0
+
+    quota = state['quota'] or 0
+    available = state['remaining'] - quota * _RESERVES[level]
+    if available < 1:
+        return state['reset_at'] - now
+
+    if available < quota * _PACING_FRACTION:
+        interval = (state['reset_at'] - now) / available
+        return max(state['sent_at'] + interval - now, 0)
+
+    return 0
+
+
+class RateLimitScheduler(object):
+    """Schedules the requests made with one token. key identifies the token
+    in the local database."""
+
+    def __init__(self, key, path=None):
+        self.key = key
+        self.path = path
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        # (loop, asyncio.Event) pairs of the coroutines waiting in the queue.
+        self._wakeups = set()
+
+    def state(self):
+        """Returns the token's quota state as last recorded."""
+        row = _connection(self.path).execute(
+            'SELECT * FROM rate_limits WHERE key = ?', (self.key,)).fetchone()
+        if row is None:
+            return {
+                'quota': None, 'remaining': None, 'reset_at': 0,
+                'blocked_until': 0, 'sent_at': 0}
+        return dict(row)
+
+    def _try_take(self, level, conditional):
+        """Takes a slot if a request may be sent now. Returns 0 if it was
+        taken, or how long to wait before trying again."""
+        if conditional:
+            return _delay(self.state(), level, True, time.time())
+
+        connection = _connection(self.path)
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            delay = _delay(self.state(), level, False, now)
+            if not delay:
+                connection.execute(
+                    'INSERT INTO rate_limits (key, sent_at) VALUES (?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET '
+                    'remaining = remaining - 1, sent_at = excluded.sent_at',
+                    (self.key, now))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return delay
+
+    def _enqueue(self, level):
+        with self._condition:
+            entry = (level, next(self._sequence))
+            heapq.heappush(self._waiting, entry)
+            return entry
+
+    def _dequeue(self, entry):
+        with self._condition:
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+        self._notify()
+
+    def _notify(self):
+        """Wakes the waiting requests to check again."""
+        with self._condition:
+            self._condition.notify_all()
+            wakeups = list(self._wakeups)
+        for loop, wakeup in wakeups:
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def _queued(self):
+        with self._condition:
+            return bool(self._waiting)
+
+    def _poll(self, entry, conditional):
+        """Tries to take a slot for a queued request. Only the request at the
+        head of the queue may take one. Returns 0 if it did, or how long to
+        wait before trying again."""
+        with self._condition:
+            if self._waiting[0] != entry:
+                return _POLL_INTERVAL
+        return self._try_take(entry[0], conditional)
+
+    def acquire(self, level=None, conditional=False):
+        """Blocks until a request of the given priority may be sent.
+
+        Requests are never rejected; low priority ones just wait longer.
+        Conditional requests are neither counted nor queued.
+        """
+        if level is None:
+            level = current_priority()
+
+        if conditional:
+            delay = self._try_take(level, True)
+            while delay:
+                time.sleep(min(delay, _POLL_INTERVAL))
+                delay = self._try_take(level, True)
+            return
+
+        # Only queue up behind other requests when there's a wait.
+        if not self._queued() and not self._try_take(level, False):
+            return
+
+        entry = self._enqueue(level)
+        try:
+            delay = self._poll(entry, False)
+            while delay:
+                with self._condition:
+                    # Woken early when the queue or the quota changes.
+                    self._condition.wait(min(delay, _POLL_INTERVAL))
+                delay = self._poll(entry, False)
+        finally:
+            self._dequeue(entry)
+
+    async def acquire_async(self, level=None, conditional=False):
+        """Like acquire, for coroutines. The local database is read in a
+        thread and waits don't block the event loop."""
+        if level is None:
+            level = current_priority()
+        loop = asyncio.get_running_loop()
+
+        if conditional:
+            delay = await local_db.run_async(self._try_take, level, True)
+            while delay:
+                await asyncio.sleep(min(delay, _POLL_INTERVAL))
+                delay = await local_db.run_async(self._try_take, level, True)
+            return
+
+        if not self._queued() and not await local_db.run_async(
+                self._try_take, level, False):
+            return
+
+        entry = self._enqueue(level)
+        wakeup = asyncio.Event()
+        with self._condition:
+            self._wakeups.add((loop, wakeup))
+        try:
+            while True:
+                wakeup.clear()
+                delay = await local_db.run_async(self._poll, entry, False)
+                if not delay:
+                    break
+                try:
+                    await asyncio.wait_for(
+                        wakeup.wait(), min(delay, _POLL_INTERVAL))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._condition:
+                self._wakeups.discard((loop, wakeup))
+            self._dequeue(entry)
+
+    def update(self, response):
+        """Records the quota reported by a response."""
+        headers = response.headers
+        connection = _connection(self.path)
+
+        if 'X-RateLimit-Remaining' in headers:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            # A response can be overtaken by requests sent after it, so
+            # within a window the count only goes down.
+            connection.execute(
+                'INSERT INTO rate_limits (key, quota, remaining, reset_at) '
+                'VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+                'quota = excluded.quota, '
+                'remaining = CASE WHEN remaining IS NULL OR '
+                'excluded.reset_at > reset_at THEN excluded.remaining '
+                'ELSE MIN(remaining, excluded.remaining) END, '
+                'reset_at = MAX(reset_at, excluded.reset_at)',
+                (self.key, int(headers.get('X-RateLimit-Limit', 0)),
+                 remaining, float(headers.get('X-RateLimit-Reset', 0))))
+            metrics.RATE_LIMIT_REMAINING.set(remaining)
+
+        if response.status_code in (403, 429):
+            state = self.state()
+            blocked_until = None
+            if 'Retry-After' in headers:
+                blocked_until = time.time() + float(headers['Retry-After'])
+            elif state['remaining'] == 0:
+                blocked_until = state['reset_at']
+            if blocked_until is not None:
+                connection.execute(
+                    'INSERT INTO rate_limits (key, blocked_until) '
+                    'VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET '
+                    'blocked_until = MAX(blocked_until, '
+                    'excluded.blocked_until)',
+                    (self.key, blocked_until))
+
+        self._notify()
+
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(key):
+    """Returns this process's scheduler for a token. key identifies the
+    token, see token_key."""
+    with _schedulers_lock:
+        if key not in _schedulers:
+            _schedulers[key] = RateLimitScheduler(key)
+        return _schedulers[key]
@@ -0,0 +1,153 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import rate_limiter
+
+
+@pytest.fixture(autouse=True)
+def database(tmpdir, monkeypatch):
+    monkeypatch.setenv('WEBHOOK_DB_PATH', str(tmpdir.join('test.db')))
+
+
+class FakeResponse(object):
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def _quota(remaining, limit=100, reset_in=3600):
+    return FakeResponse(headers={
+        'X-RateLimit-Limit': str(limit),
+        'X-RateLimit-Remaining': str(remaining),
+        'X-RateLimit-Reset': str(int(time.time() + reset_in)),
+    })
+
+
+def test_sends_right_away_while_quota_is_plentiful():
+    scheduler = rate_limiter.RateLimitScheduler('token')
+    scheduler.update(_quota(5000, limit=5000))
+
+    start = time.time()
+    for _ in range(200):
+        scheduler.acquire()
+    assert time.time() - start < 5
+    assert scheduler.state()['remaining'] == 4800
+
+
+def test_reserves():
+    scheduler = rate_limiter.RateLimitScheduler('token')
+    scheduler.update(_quota(15))
+
+    # 20% is kept for merges and regular work, 5% for merges only.
+    assert scheduler._try_take(rate_limiter.LOW, False) > 3000
+    assert scheduler._try_take(rate_limiter.NORMAL, False) == 0
+    assert scheduler._try_take(rate_limiter.HIGH, False) == 0
+    assert scheduler.state()['remaining'] == 13
+
+
+def test_paces_what_is_left_until_the_reset():
+    scheduler = rate_limiter.RateLimitScheduler('token')
+    scheduler.update(_quota(6, limit=100, reset_in=50))
+
+    assert scheduler._try_take(rate_limiter.HIGH, False) == 0
+    # 5 requests left for 50 seconds.
+    assert 9 < scheduler._try_take(rate_limiter.HIGH, False) <= 10
+
+
+def test_conditional_requests_are_free():
+    scheduler = rate_limiter.RateLimitScheduler('token')
+    scheduler.update(_quota(0))
+
+    assert scheduler._try_take(rate_limiter.HIGH, False) > 0
+    assert scheduler._try_take(rate_limiter.LOW, True) == 0
+    assert scheduler.state()['remaining'] == 0
+    assert rate_limiter.is_conditional({'If-None-Match': '"abc"'})
+    assert not rate_limiter.is_conditional(None)
+
+
+def test_retry_after_pauses_everything():
+    scheduler = rate_limiter.RateLimitScheduler('token')
+    scheduler.update(FakeResponse(429, {'Retry-After': '30'}))
+
+    assert 29 < scheduler._try_take(rate_limiter.HIGH, False) <= 30
+    assert 29 < scheduler._try_take(rate_limiter.HIGH, True) <= 30
+
+
+def test_quota_is_shared_and_only_goes_down_within_a_window():
+    first = rate_limiter.RateLimitScheduler('token')
+    second = rate_limiter.RateLimitScheduler('token')
+    first.update(_quota(50))
+
+    second.acquire()
+    assert first.state()['remaining'] == 49
+
+    # A response sent before that request doesn't count it.
+    first.update(_quota(50))
+    assert second.state()['remaining'] == 49
+
+    # A new window does.
+    first.update(_quota(100, reset_in=7200))
+    assert second.state()['remaining'] == 100
+    assert rate_limiter.RateLimitScheduler('other').state()[
+        'remaining'] is None
+
+
+class RecordingScheduler(rate_limiter.RateLimitScheduler):
+    def __init__(self, *args, **kwargs):
+        super(RecordingScheduler, self).__init__(*args, **kwargs)
+        self.sent = []
+
+    def _try_take(self, level, conditional):
+        delay = super(RecordingScheduler, self)._try_take(level, conditional)
+        if not delay:
+            self.sent.append(level)
+        return delay
+
+
+def test_waiting_requests_go_highest_priority_first():
+    scheduler = RecordingScheduler('token')
+    scheduler.update(FakeResponse(429, {'Retry-After': '0.5'}))
+
+    threads = []
+    for level in (rate_limiter.LOW, rate_limiter.NORMAL, rate_limiter.HIGH,
+                  rate_limiter.NORMAL):
+        thread = threading.Thread(target=scheduler.acquire, args=(level,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.05)
+
+    for thread in threads:
+        thread.join(5)
+
+    assert scheduler.sent == [
+        rate_limiter.HIGH, rate_limiter.NORMAL, rate_limiter.NORMAL,
+        rate_limiter.LOW]
+
+
+def test_acquire_async_uses_the_context_priority():
+    scheduler = RecordingScheduler('token')
+    scheduler.update(_quota(15))
+
+    async def acquire():
+        with rate_limiter.priority(rate_limiter.HIGH):
+            await asyncio.wait_for(scheduler.acquire_async(), 5)
+
+    asyncio.run(acquire())
+    assert scheduler.sent == [rate_limiter.HIGH]
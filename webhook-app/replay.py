@@ -0,0 +1,244 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Replays recorded webhook deliveries to benchmark the app offline.
+
+Record deliveries by running the app with WEBHOOK_RECORD_DIR set, then:
+
+    python replay.py payloads/ --rate 50 --concurrency 8 --latency 0.1
+
+The deliveries are signed and posted to main.app in this process, with the
+GitHub API replaced by a fake_github server that answers after --latency
+seconds. Throughput, latency percentiles, the API calls made and the rate
+limit they were paced against are reported at the end. The fake API allows
+--rate-limit requests an hour; the default is high enough that the rate
+limiter never holds requests back, so only the app is measured. Environment variables configure the app as usual, so
+e.g. WEBHOOK_QUEUE=1 benchmarks queue mode, and WEBHOOK_ASYNC=1 serves the
+app with uvicorn to benchmark async mode.
+
+To benchmark an app running elsewhere, pass --target with its webhook URL.
+Start it with GITHUB_API_URL set to the fake API URL this prints, and with
+GITHUB_WEBHOOK_SECRET matching --secret.
+"""
+
+import argparse
+from collections import Counter
+import glob
+import hashlib
+import hmac
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+
+import fake_github
+import rate_limiter
+
+
+def load_deliveries(directory):
+    """Loads the deliveries recorded in directory, oldest first."""
+    paths = sorted(
+        glob.glob(os.path.join(directory, '*.json')), key=os.path.getmtime)
+    deliveries = []
+    for path in paths:
+        with open(path) as f:
+            deliveries.append(json.load(f))
+    return deliveries
+
+
+def _sign(secret, body):
+    return 'sha256=' + hmac.new(
+        secret.encode('utf-8'), body, hashlib.sha256).hexdigest()
+
+
+def _serve_asgi(app):
+    """Serves an ASGI app with uvicorn from a background thread and returns
+    its webhook URL."""
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(
+        app, host='127.0.0.1', port=0, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return 'http://127.0.0.1:{}/webhook'.format(port)
+
+
+def _in_process_sender():
+    import asgi
+    import main
+    if asgi.enabled():
+        return _http_sender(_serve_asgi(main.app))
+
+    local = threading.local()
+
+    def send(headers, body):
+        if not hasattr(local, 'client'):
+            local.client = main.app.test_client()
+        return local.client.post(
+            '/webhook', data=body, headers=headers).status_code
+    return send
+
+
+def _http_sender(target):
+    import requests
+    session = requests.Session()
+
+    def send(headers, body):
+        return session.post(target, data=body, headers=headers).status_code
+    return send
+
+
+def percentile(values, percent):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+
+def replay(deliveries, send, secret, rate=0, concurrency=4):
+    """Sends deliveries at rate per second (0 for as fast as possible) from
+    concurrency threads. Returns the latencies and status code counts."""
+    work = queue.Queue()
+    for index, delivery in enumerate(deliveries):
+        work.put((index, delivery))
+
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    start = time.time()
+
+    def worker():
+        while True:
+            try:
+                index, delivery = work.get_nowait()
+            except queue.Empty:
+                return
+
+            if rate:
+                delay = start + index / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            body = delivery['body'].encode('utf-8')
+            headers = dict(delivery['headers'])
+            headers['Content-Type'] = 'application/json'
+            headers['X-Hub-Signature-256'] = _sign(secret, body)
+
+            sent = time.time()
+            status = send(headers, body)
+            elapsed = time.time() - sent
+
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.time() - start, latencies, statuses
+
+
+def report(elapsed, latencies, statuses, api_calls, rate_limit=None):
+    print('Deliveries: {} in {:.2f}s ({:.1f}/s)'.format(
+        len(latencies), elapsed, len(latencies) / elapsed if elapsed else 0))
+    print('Latency: p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms'.format(
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        max(latencies or [0]) * 1000))
+    print('Responses: {}'.format(', '.join(
+        '{}: {}'.format(status, count)
+        for status, count in sorted(statuses.items()))))
+    print('GitHub API calls: {}'.format(sum(api_calls.values())))
+    for endpoint, count in api_calls.most_common():
+        print('  {:>6}  {}'.format(count, endpoint))
+    if rate_limit is not None:
+        print('Rate limit: {}'.format(rate_limit))
+
+
+def describe_rate_limit(api, token=None):
+    """Describes the rate limit the app was paced against. token is the
+    app's access token when it runs in this process, so what its limiter
+    recorded can be included."""
+    description = '{} requests an hour, {}'.format(
+        api.rate_limit, rate_limiter.describe())
+    if token is not None:
+        state = rate_limiter.get_scheduler(
+            rate_limiter.token_key(token)).state()
+        description += '; {} left at the end'.format(state['remaining'])
+    return description
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='Directory of recorded deliveries.')
+    parser.add_argument(
+        '--rate', type=float, default=0,
+        help='Deliveries per second. 0 sends as fast as possible.')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument(
+        '--latency', type=float, default=0.05,
+        help='Seconds the fake GitHub API waits before each response.')
+    parser.add_argument(
+        '--repeat', type=int, default=1,
+        help='Send the recorded deliveries this many times.')
+    parser.add_argument(
+        '--rate-limit', type=int, default=1000000,
+        help='Requests an hour the fake GitHub API allows. Lower it to '
+             'benchmark the rate limiter too.')
+    parser.add_argument('--target', help='Webhook URL of a running app.')
+    parser.add_argument('--secret', default='replay-secret')
+    args = parser.parse_args()
+
+    deliveries = load_deliveries(args.directory) * args.repeat
+    if not deliveries:
+        parser.error('No deliveries found in {}.'.format(args.directory))
+
+    user = os.environ.setdefault('GITHUB_USER', 'dpebot')
+    api = fake_github.FakeGitHub(
+        latency=args.latency, user=user, rate_limit=args.rate_limit).start()
+    api.seed(
+        (delivery['headers'].get('X-GitHub-Event'),
+         json.loads(delivery['body']))
+        for delivery in deliveries)
+    print('Fake GitHub API: {}'.format(api.url))
+
+    token = None
+    if args.target:
+        send = _http_sender(args.target)
+    else:
+        os.environ['GITHUB_API_URL'] = api.url
+        os.environ['GITHUB_WEBHOOK_SECRET'] = args.secret
+        token = os.environ.setdefault('GITHUB_ACCESS_TOKEN', 'replay-token')
+        os.environ.setdefault('WEBHOOK_DB_PATH', os.path.join(
+            tempfile.mkdtemp(), 'replay.db'))
+        send = _in_process_sender()
+
+    elapsed, latencies, statuses = replay(
+        deliveries, send, args.secret, rate=args.rate,
+        concurrency=args.concurrency)
+    report(elapsed, latencies, statuses, api.calls,
+           rate_limit=describe_rate_limit(api, token))
+    api.stop()
+
+
+if __name__ == '__main__':
+    main()
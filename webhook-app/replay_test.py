@@ -0,0 +1,90 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import pytest
+import requests
+
+import fake_github
+import replay
+import webhook_helper
+
+
+@pytest.fixture
+def api():
+    api = fake_github.FakeGitHub(latency=0).start()
+    yield api
+    api.stop()
+
+
+def test_fake_github_revalidates(api):
+    api.add_pull('octo', 'repo', 7, 'abc123')
+    url = api.url + '/repos/octo/repo/pulls/7'
+
+    response = requests.get(url)
+    assert response.status_code == 200
+    assert response.json()['head']['sha'] == 'abc123'
+
+    response = requests.get(
+        url, headers={'If-None-Match': response.headers['ETag']})
+    assert response.status_code == 304
+    assert api.calls['GET /repos/{owner}/{name}/pulls/{number}'] == 2
+
+
+def test_record_and_replay(tmpdir, monkeypatch):
+    monkeypatch.setenv('WEBHOOK_RECORD_DIR', str(tmpdir))
+    headers = {'X-GitHub-Event': 'ping', 'X-GitHub-Delivery': 'abc',
+               'X-Hub-Signature': 'sha1=secret'}
+    webhook_helper.record_delivery(headers, b'{"zen": "hi"}')
+
+    deliveries = replay.load_deliveries(str(tmpdir))
+    assert deliveries == [{
+        'headers': {'X-GitHub-Event': 'ping', 'X-GitHub-Delivery': 'abc'},
+        'body': '{"zen": "hi"}'}]
+
+    sent = []
+
+    def send(headers, body):
+        sent.append((headers, json.loads(body)))
+        return 200
+
+    elapsed, latencies, statuses = replay.replay(
+        deliveries * 3, send, 'secret', concurrency=2)
+
+    assert len(latencies) == 3
+    assert statuses == {200: 3}
+    assert sent[0][1] == {'zen': 'hi'}
+    assert sent[0][0]['X-Hub-Signature-256'] == replay._sign(
+        'secret', b'{"zen": "hi"}')
+
+
+def test_fake_github_rate_limit():
+    api = fake_github.FakeGitHub(latency=0, rate_limit=10).start()
+    try:
+        url = api.url + '/repos/octo/repo/pulls/7'
+        first = requests.get(url)
+        second = requests.get(
+            url, headers={'If-None-Match': first.headers['ETag']})
+        third = requests.get(url)
+    finally:
+        api.stop()
+
+    assert first.headers['X-RateLimit-Limit'] == '10'
+    assert first.headers['X-RateLimit-Remaining'] == '9'
+    # Revalidations are free, and the window doesn't move.
+    assert second.headers['X-RateLimit-Remaining'] == '9'
+    assert third.headers['X-RateLimit-Remaining'] == '8'
+    assert (first.headers['X-RateLimit-Reset'] ==
+            third.headers['X-RateLimit-Reset'])
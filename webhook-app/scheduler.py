@@ -0,0 +1,192 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Runs periodic jobs from inside the workers.
+
+Every worker on a host starts a thread per job, but only the worker holding
+the job's leader lock runs it; if that worker dies the OS drops the lock and
+another worker takes over. A job runs again after min_interval when it found
+work, and waits twice as long each time it didn't, up to max_interval, with
+some jitter. Each run holds the job's run lock, which the /cron/ routes take
+too, so runs never overlap.
+
+Locks are flock()ed files in WEBHOOK_LOCK_DIR. The next run time is kept in
+the local database so a new leader carries on the same schedule.
+"""
+
+import fcntl
+import logging
+import os
+import random
+import threading
+import time
+
+import checkpoints
+
+# Fraction of the interval runs are moved by at random.
+_JITTER = 0.1
+
+# How often workers that aren't a job's leader check whether it has gone.
+_ELECTION_INTERVAL = 30
+
+# How long the leader waits after failing to schedule a job, e.g. when the
+# local database is locked.
+_ERROR_BACKOFF = 30
+
+
+def enabled():
+    return os.environ.get(
+        'WEBHOOK_SCHEDULER', '').lower() in ('1', 'true', 'yes')
+
+
+def skips_cron_request(headers):
+    """True if a /cron/ request comes from App Engine cron (cron.yaml) while
+    the scheduler already runs the jobs, so it should do nothing. App Engine
+    drops X-Appengine-Cron from outside requests, so manual triggers still
+    run."""
+    return enabled() and headers.get('X-Appengine-Cron') == 'true'
+
+
+def _lock_path(name):
+    return os.path.join(
+        os.environ.get('WEBHOOK_LOCK_DIR', '/tmp'),
+        'dpebot-{}.lock'.format(name))
+
+
+class AlreadyRunning(Exception):
+    """The job is already running on this host."""
+
+
+class _FileLock(object):
+    """A non-blocking exclusive lock on a file, released if the process
+    dies."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def acquire(self):
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+    def release(self):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+class Job(object):
+    def __init__(self, name, function, min_interval, max_interval):
+        self.name = name
+        self.function = function
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def next_interval(self, interval, found_work):
+        """Runs again soon after finding work, and backs off while idle."""
+        if found_work:
+            return self.min_interval
+        return min(interval * 2, self.max_interval)
+
+
+_jobs = {}
+
+
+def register(name, function, min_interval=None, max_interval=None):
+    """Registers a job. function's return value tells whether it found
+    work."""
+    if min_interval is None:
+        min_interval = float(os.environ.get('SCHEDULER_MIN_INTERVAL', 60))
+    if max_interval is None:
+        max_interval = float(os.environ.get('SCHEDULER_MAX_INTERVAL', 900))
+    _jobs[name] = Job(name, function, min_interval, max_interval)
+
+
+def job_names():
+    """Returns the names of the registered jobs."""
+    return sorted(_jobs)
+
+
+def run(name):
+    """Runs a job now and returns its result. Raises AlreadyRunning if a
+    run of the job is in progress on this host."""
+    lock = _FileLock(_lock_path(name))
+    if not lock.acquire():
+        raise AlreadyRunning(name)
+    try:
+        return _jobs[name].function()
+    finally:
+        lock.release()
+
+
+def _next_run_checkpoint(job):
+    return 'scheduler.{}.next_run'.format(job.name)
+
+
+def _tick(job, interval):
+    """Runs the job if it's due. Returns the interval to use next time and
+    the seconds until the next run."""
+    next_run = float(checkpoints.load(_next_run_checkpoint(job)) or 0)
+    if next_run > time.time():
+        return interval, next_run - time.time()
+
+    try:
+        found_work = run(job.name)
+    except AlreadyRunning:
+        logging.info('{} is already running.'.format(job.name))
+        found_work = False
+    except Exception:
+        logging.exception('Scheduled job {} failed.'.format(job.name))
+        found_work = False
+
+    interval = job.next_interval(interval, found_work)
+    delay = interval * random.uniform(1 - _JITTER, 1 + _JITTER)
+    checkpoints.save(_next_run_checkpoint(job), repr(time.time() + delay))
+    return interval, delay
+
+
+def _schedule(job):
+    leader = _FileLock(_lock_path(job.name + '.leader'))
+    while not leader.acquire():
+        time.sleep(_ELECTION_INTERVAL)
+
+    logging.info('Scheduling {} from worker {}.'.format(
+        job.name, os.getpid()))
+    interval = job.min_interval
+    try:
+        while True:
+            try:
+                interval, delay = _tick(job, interval)
+            except Exception:
+                logging.exception('Scheduling {} failed.'.format(job.name))
+                delay = _ERROR_BACKOFF
+            time.sleep(delay)
+    finally:
+        # Let another worker take over if this thread dies anyway.
+        leader.release()
+
+
+def start():
+    """Starts a thread per job that runs it whenever this worker is its
+    leader."""
+    for job in _jobs.values():
+        threading.Thread(
+            target=_schedule, args=(job,), name='scheduler-' + job.name,
+            daemon=True).start()
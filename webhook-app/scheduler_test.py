@@ -0,0 +1,117 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+
+import pytest
+
+import scheduler
+
+
+@pytest.fixture
+def jobs(monkeypatch, tmpdir):
+    monkeypatch.setenv('WEBHOOK_LOCK_DIR', str(tmpdir))
+    monkeypatch.setenv('WEBHOOK_DB_PATH', str(tmpdir.join('test.db')))
+    jobs = {}
+    monkeypatch.setattr(scheduler, '_jobs', jobs)
+    return jobs
+
+
+def test_run_does_not_overlap(jobs):
+    results = []
+
+    def job():
+        with pytest.raises(scheduler.AlreadyRunning):
+            scheduler.run('job')
+        results.append('ran')
+        return 1
+
+    scheduler.register('job', job)
+
+    assert scheduler.run('job') == 1
+    assert results == ['ran']
+    # The lock is released afterwards.
+    assert scheduler.run('job') == 1
+
+
+def test_only_one_leader(jobs):
+    first = scheduler._FileLock(scheduler._lock_path('job.leader'))
+    second = scheduler._FileLock(scheduler._lock_path('job.leader'))
+
+    assert first.acquire()
+    assert not second.acquire()
+    first.release()
+    assert second.acquire()
+    second.release()
+
+
+def test_tick_adapts_interval(jobs):
+    found = [3, 0, 0, 0, 2]
+    scheduler.register(
+        'job', lambda: found.pop(0), min_interval=10, max_interval=30)
+    job = jobs['job']
+
+    intervals = []
+    interval = job.min_interval
+    for _ in range(5):
+        # Make the job due again.
+        scheduler.checkpoints.save(scheduler._next_run_checkpoint(job), '0')
+        interval, delay = scheduler._tick(job, interval)
+        assert interval * 0.9 <= delay <= interval * 1.1
+        intervals.append(interval)
+
+    assert intervals == [10, 20, 30, 30, 10]
+
+    # Not due yet: the job doesn't run.
+    interval, delay = scheduler._tick(job, interval)
+    assert interval == 10
+    assert 0 < delay <= 11
+
+
+class _Stop(Exception):
+    pass
+
+
+def test_schedule_survives_database_errors(jobs, monkeypatch):
+    runs = []
+    scheduler.register('job', lambda: runs.append('ran'))
+    job = jobs['job']
+
+    load = scheduler.checkpoints.load
+    failures = [sqlite3.OperationalError('database is locked')]
+
+    def flaky_load(name):
+        if failures:
+            raise failures.pop()
+        return load(name)
+
+    delays = []
+
+    def sleep(delay):
+        delays.append(delay)
+        if len(delays) == 2:
+            raise _Stop()
+
+    monkeypatch.setattr(scheduler.checkpoints, 'load', flaky_load)
+    monkeypatch.setattr(scheduler.time, 'sleep', sleep)
+
+    with pytest.raises(_Stop):
+        scheduler._schedule(job)
+
+    assert delays[0] == scheduler._ERROR_BACKOFF
+    assert runs == ['ran']
+    # Leadership is given up when the thread exits.
+    leader = scheduler._FileLock(scheduler._lock_path('job.leader'))
+    assert leader.acquire()
+    leader.release()
@@ -12,60 +12,117 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from concurrent import futures
+import contextvars
+import datetime
 import logging
+import os
 
 import github3
+
+import checkpoints
 import github_helper
+import rate_limiter
 import webhook_helper
 
+_SINCE_CHECKPOINT = 'create_webhooks.since'
+
+# How far back each run looks past the previous one's start, to cover clock
+# skew between this host and GitHub. Matching issues are closed once handled,
+# so seeing an issue twice is harmless.
+_SINCE_OVERLAP = datetime.timedelta(minutes=5)
+
+
+def _workers():
+    return int(os.environ.get('CREATE_WEBHOOKS_WORKERS', 4))
+
+
+def _wants_webhook(issue):
+    """Does someone want us to add the webhook?"""
+    return issue.title.lower() in ('add webhook', 'create webhook')
+
+
+def _handle_issue(gh, issue):
+    """Installs the webhook an issue asks for, if its author and the bot are
+    both admins of the repository."""
+    logging.info('Processing issue {}'.format(issue.url))
+
+    # Make sure the user who filed the issue is an admin.
+    permission = github_helper.get_permission(
+        gh, issue.repository[0],
+        issue.repository[1],
+        issue.user.login)
+
+    if permission != 'admin':
+        logging.info(
+            'Not installing webhook because {} is not an '
+            'admin.'.format(issue.user.login))
+        return
 
+    # Make sure we're an admin.
+    repo = gh.repository(*issue.repository)
+
+    if not repo.permissions['admin']:
+        logging.info(
+            'Not installing hook because depbot is not an admin')
+        # TODO: leave a comment?
+        return
+
+    # Create the webhook.
+    try:
+        webhook_helper.create_webhook(repo.owner, repo.name)
+        issue.create_comment('Webhook added!')
+    except github3.exceptions.UnprocessableEntity:
+        # Webhook already exists
+        logging.info('Hook already existed.')
+        issue.create_comment('Webhook is already here!')
+
+    issue.close()
+
+
+@rate_limiter.priority(rate_limiter.LOW)
 def create_webhooks():
     """Auto-creates webhooks
 
-    * Gets all open issues assigned to the bot.
+    * Gets the open issues assigned to the bot that were updated since the
+      last successful run.
     * Checks to see if the issue is title 'add webhook'.
     * Checks the creator and the bot are both admins.
     * Creates the hook and leaves a comment.
+
+    Matching issues are handled concurrently, by CREATE_WEBHOOKS_WORKERS
+    threads. Returns the number of matching issues.
     """
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    since = checkpoints.load(_SINCE_CHECKPOINT)
 
     gh = github_helper.get_client()
-    issues = gh.issues(filter='assigned', state='open')
-
-    for issue in issues:
-        # Does someone want us to add the webhook?
-        if issue.title.lower() not in ('add webhook', 'create webhook'):
-            return
-
-        logging.info('Processing issue {}'.format(issue.url))
-
-        # Make sure the user who filed the issue is an admin.
-        permission = github_helper.get_permission(
-            gh, issue.repository[0],
-            issue.repository[1],
-            issue.user.login)
-
-        if permission != 'admin':
-            logging.info(
-                'Not installing webhook because {} is not an '
-                'admin.'.format(issue.user.login))
-            return
-
-        # Make sure we're an admin.
-        repo = gh.repository(*issue.repository)
-
-        if not repo.permissions['admin']:
-            logging.info(
-                'Not installing hook because depbot is not an admin')
-            # TODO: leave a comment?
-            return
-
-        # Create the webhook.
-        try:
-            webhook_helper.create_webhook(repo.owner, repo.name)
-            issue.create_comment('Webhook added!')
-        except github3.exceptions.UnprocessableEntity:
-            # Webhook already exists
-            logging.info('Hook already existed.')
-            issue.create_comment('Webhook is already here!')
-
-        issue.close()
+    issues = [
+        issue for issue in gh.issues(
+            filter='assigned', state='open', since=since)
+        if _wants_webhook(issue)]
+
+    failed = False
+    with futures.ThreadPoolExecutor(max_workers=_workers()) as executor:
+        # Each issue is handled in a copy of our context so it keeps our
+        # request priority.
+        submitted = {
+            executor.submit(
+                contextvars.copy_context().run, _handle_issue, gh, issue):
+            issue for issue in issues}
+        for future in futures.as_completed(submitted):
+            try:
+                future.result()
+            except Exception:
+                logging.exception('Failed to process issue {}'.format(
+                    submitted[future].url))
+                failed = True
+
+    # Only move the checkpoint forward once every issue went through, so
+    # failed ones are retried on the next run.
+    if not failed:
+        checkpoints.save(
+            _SINCE_CHECKPOINT,
+            (started_at - _SINCE_OVERLAP).strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+    return len(issues)
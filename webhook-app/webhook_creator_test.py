@@ -0,0 +1,103 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import namedtuple
+
+import pytest
+
+import checkpoints
+import github_helper
+import webhook_creator
+import webhook_helper
+
+User = namedtuple('User', ['login'])
+
+
+class Issue(object):
+    def __init__(self, title, repository=('octo', 'repo')):
+        self.title = title
+        self.repository = repository
+        self.url = 'https://api.github.com/repos/{}/{}/issues/1'.format(
+            *repository)
+        self.user = User('admin')
+        self.comments = []
+        self.closed = False
+
+    def create_comment(self, body):
+        self.comments.append(body)
+
+    def close(self):
+        self.closed = True
+
+
+class Repository(object):
+    def __init__(self, owner, name):
+        self.owner = owner
+        self.name = name
+        self.permissions = {'admin': True}
+
+
+class GitHub(object):
+    def __init__(self, issues):
+        self._issues = issues
+        self.since = []
+
+    def issues(self, filter, state, since=None):
+        self.since.append(since)
+        return self._issues
+
+    def repository(self, owner, name):
+        return Repository(owner, name)
+
+
+@pytest.fixture
+def hooks(monkeypatch, tmpdir):
+    monkeypatch.setenv('WEBHOOK_DB_PATH', str(tmpdir.join('test.db')))
+    monkeypatch.setattr(
+        github_helper, 'get_permission', lambda gh, owner, repo, user: 'admin')
+    hooks = []
+    monkeypatch.setattr(
+        webhook_helper, 'create_webhook',
+        lambda owner, repo: hooks.append((owner, repo)))
+    return hooks
+
+
+def test_create_webhooks_skips_other_issues(hooks, monkeypatch):
+    issues = [
+        Issue('Fix the README'),
+        Issue('Add webhook', ('octo', 'one')),
+        Issue('create webhook', ('octo', 'two')),
+    ]
+    gh = GitHub(issues)
+    monkeypatch.setattr(github_helper, 'get_client', lambda: gh)
+
+    assert webhook_creator.create_webhooks() == 2
+
+    assert sorted(hooks) == [('octo', 'one'), ('octo', 'two')]
+    assert [issue.closed for issue in issues] == [False, True, True]
+
+    # The next run only asks for issues updated since this one.
+    webhook_creator.create_webhooks()
+    assert gh.since[0] is None
+    assert gh.since[1] == checkpoints.load(webhook_creator._SINCE_CHECKPOINT)
+
+
+def test_create_webhooks_keeps_checkpoint_on_failure(hooks, monkeypatch):
+    issue = Issue('Add webhook')
+    issue.close = lambda: 1 / 0
+    monkeypatch.setattr(github_helper, 'get_client', lambda: GitHub([issue]))
+
+    webhook_creator.create_webhooks()
+
+    assert checkpoints.load(webhook_creator._SINCE_CHECKPOINT) is None
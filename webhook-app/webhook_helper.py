@@ -14,13 +14,21 @@
 
 """Helpers for implementing GitHub webhooks."""
 
+import asyncio
 from collections import defaultdict
+from concurrent import futures
+import contextvars
 import hashlib
 import hmac
+import json
 import logging
 import os
+import time
+import uuid
 
 import github_helper
+import metrics
+import rate_limiter
 
 
 def webhook_secret():
@@ -31,38 +39,166 @@ def webhook_url():
     return os.environ['GITHUB_WEBHOOK_URL']
 
 
-def check_signature(header_signature, request_body):
+# Digest algorithms GitHub signs deliveries with. X-Hub-Signature-256 is
+# preferred; X-Hub-Signature (SHA-1) is kept for older hooks.
+_DIGESTS = {'sha1': hashlib.sha1, 'sha256': hashlib.sha256}
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class SignatureError(ValueError):
+    """The delivery is unsigned or its signature doesn't match."""
+
+
+class PayloadTooLarge(ValueError):
+    """The delivery is larger than WEBHOOK_MAX_BODY_BYTES."""
+
+
+def max_body_size():
+    # GitHub caps payloads at 25 MB.
+    return int(os.environ.get('WEBHOOK_MAX_BODY_BYTES', 25 * 1024 * 1024))
+
+
+def _new_hmac(header_signature):
+    """Parses a signature header into an HMAC and the expected digest."""
     if not header_signature:
-        raise ValueError('No X-Hub-Signature header.')
+        raise SignatureError('No X-Hub-Signature-256 header.')
+
+    algorithm, _, signature_digest = header_signature.partition('=')
 
-    algorithm, signature_digest = header_signature.split('=')
+    if algorithm not in _DIGESTS:
+        raise SignatureError(
+            'Unsupported digest algorithm {}.'.format(algorithm))
 
-    if algorithm != 'sha1':
-        raise ValueError('Unsupported digest algorithm {}.'.format(algorithm))
+    mac = hmac.new(webhook_secret(), digestmod=_DIGESTS[algorithm])
+    return mac, signature_digest
 
-    body_digest = hmac.new(
-        webhook_secret(), msg=request_body, digestmod=hashlib.sha1).hexdigest()
 
-    if not hmac.compare_digest(body_digest, signature_digest):
-        raise ValueError('Body digest did not match signature digest')
+def _check_digest(mac, signature_digest):
+    if not hmac.compare_digest(mac.hexdigest(), signature_digest):
+        raise SignatureError('Body digest did not match signature digest')
+
+
+def check_signature(header_signature, request_body):
+    mac, signature_digest = _new_hmac(header_signature)
+    mac.update(request_body)
+    _check_digest(mac, signature_digest)
 
     return True
 
 
+class _VerifiedBody(object):
+    """Buffers a delivery's body, hashing it chunk by chunk as it arrives.
+
+    Unsigned and oversized deliveries are rejected before any of the body is
+    read.
+    """
+
+    def __init__(self, headers, content_length):
+        self._mac, self._signature_digest = _new_hmac(
+            headers.get('X-Hub-Signature-256') or
+            headers.get('X-Hub-Signature'))
+
+        self._limit = max_body_size()
+        if content_length is not None and content_length > self._limit:
+            raise PayloadTooLarge(
+                'Body of {} bytes is over the limit of {}.'.format(
+                    content_length, self._limit))
+
+        self.body = bytearray()
+
+    def update(self, chunk):
+        self.body += chunk
+        if len(self.body) > self._limit:
+            raise PayloadTooLarge(
+                'Body is over the limit of {} bytes.'.format(self._limit))
+        self._mac.update(chunk)
+
+    def verify(self):
+        _check_digest(self._mac, self._signature_digest)
+        return self.body
+
+
+def read_verified_body(request):
+    """Reads a delivery's body from a Flask request and checks its
+    signature.
+
+    The body is hashed chunk by chunk as it's read from the request stream,
+    so it's only buffered once.
+    """
+    verified = _VerifiedBody(request.headers, request.content_length)
+
+    while True:
+        chunk = request.stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        verified.update(chunk)
+
+    return verified.verify()
+
+
+async def read_verified_body_async(headers, receive):
+    """Like read_verified_body, reading the body from an ASGI receive
+    callable."""
+    content_length = headers.get('Content-Length', type=int)
+    verified = _VerifiedBody(headers, content_length)
+
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ValueError('Client disconnected.')
+        verified.update(message.get('body', b''))
+        if not message.get('more_body'):
+            break
+
+    return verified.verify()
+
+
+def _hook_config():
+    return {
+        'url': webhook_url(),
+        'content_type': 'json',
+        'secret': webhook_secret().decode('utf-8')}
+
+
 def create_webhook(owner, repository):
     gh = github_helper.get_client()
     repo = gh.repository(owner, repository)
 
     hook = repo.create_hook(
         name='web',
-        config={
-            'url': webhook_url(),
-            'content_type': 'json',
-            'secret': webhook_secret().decode('utf-8')},
-        events=['*'])
+        config=_hook_config(),
+        events=subscribed_events())
 
     return hook
 
+
+@rate_limiter.priority(rate_limiter.LOW)
+def migrate_webhooks():
+    """Narrows the events of the bot's existing hooks to the ones it listens
+    to. Returns the number of hooks updated."""
+    gh = github_helper.get_client()
+    events = subscribed_events()
+    updated = 0
+
+    for repo in gh.repositories():
+        if not repo.permissions.get('admin'):
+            continue
+
+        for hook in repo.hooks():
+            if hook.config.get('url') != webhook_url():
+                continue
+            if sorted(hook.events) == events:
+                continue
+
+            logging.info('Updating events of hook on {} from {} to {}'.format(
+                repo.full_name, hook.events, events))
+            # The API doesn't return the secret, so send the whole config.
+            hook.edit(config=_hook_config(), events=events, active=hook.active)
+            updated += 1
+
+    return updated
+
 # Maps events to a list of functions to call for the webhook.
 _web_hook_event_map = defaultdict(list)
 
@@ -75,23 +211,262 @@ def listen(event):
     return inner
 
 
-def process(request):
-    """Calls all of the functions registered for a GitHub event."""
-    event = request.headers.get('X-GitHub-Event', 'ping')
-    functions = _web_hook_event_map[event]
+# Coroutine versions of listeners, run instead of them in async serving mode.
+_async_listeners = {}
 
-    data = request.get_json()
 
-    logging.info('Event: {}'.format(event))
+def listen_async(replaces):
+    """Decorator that registers a coroutine to run instead of the listener
+    replaces when serving asynchronously."""
+    def inner(f):
+        _async_listeners[replaces] = f
+        return f
+    return inner
 
-    # import json
-    # guid = request.headers['X-GitHub-Delivery']
-    # with open('payloads/{}.json'.format(guid), 'w') as f:
-    #     json.dump(data, f, indent=2)
 
-    for function in functions:
+def has_listeners(event):
+    """True if any function is registered for the event."""
+    return bool(_web_hook_event_map.get(event))
+
+
+# Events that only organization hooks can subscribe to.
+_ORGANIZATION_EVENTS = frozenset(['membership', 'organization'])
+
+
+def subscribed_events():
+    """Returns the events repository hooks should be subscribed to: every
+    event with a registered function, except those only organization hooks
+    get. GitHub sends ping regardless.
+
+    Functions are registered when their module is imported, so the modules
+    defining them must be imported before this is called.
+    """
+    return sorted(
+        event for event, functions in _web_hook_event_map.items()
+        if functions and event != 'ping' and
+        event not in _ORGANIZATION_EVENTS)
+
+
+# Headers needed to replay a recorded delivery. The signature isn't kept;
+# replay.py signs deliveries with its own secret.
+_RECORDED_HEADERS = (
+    'X-GitHub-Event', 'X-GitHub-Delivery', 'X-GitHub-Hook-ID',
+    'User-Agent', 'Content-Type')
+
+
+def record_delivery(headers, body):
+    """Saves a delivery to WEBHOOK_RECORD_DIR, if set, so replay.py can
+    replay it later."""
+    directory = os.environ.get('WEBHOOK_RECORD_DIR')
+    if not directory:
+        return
+
+    delivery = os.path.basename(
+        headers.get('X-GitHub-Delivery') or str(uuid.uuid4()))
+    record = {
+        'headers': {
+            name: headers[name] for name in _RECORDED_HEADERS
+            if headers.get(name)},
+        'body': bytes(body).decode('utf-8'),
+    }
+
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, '{}.json'.format(delivery)), 'w') as f:
+        json.dump(record, f, indent=2)
+
+
+class ListenerError(Exception):
+    """Raised when listeners failed while dispatching concurrently."""
+
+    def __init__(self, event, errors):
+        super(ListenerError, self).__init__(
+            '{} listener(s) failed for {}: {}'.format(
+                len(errors), event, ', '.join(
+                    '{}: {!r}'.format(name, error)
+                    for name, error in errors)))
+        self.errors = errors
+
+
+def _listener_name(function):
+    return '{}.{}'.format(function.__module__, function.__name__)
+
+
+def _concurrent_dispatch():
+    return os.environ.get(
+        'WEBHOOK_CONCURRENT_LISTENERS', '').lower() in ('1', 'true', 'yes')
+
+
+def _listener_timeout():
+    return float(os.environ.get('WEBHOOK_LISTENER_TIMEOUT', 60))
+
+
+_listener_executor = futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('WEBHOOK_LISTENER_WORKERS', 32)))
+
+
+def _timed(function, data):
+    """Calls a listener, recording how long it took and whether it
+    failed."""
+    name = _listener_name(function)
+    start = time.time()
+    try:
         result = function(data)
+    except Exception:
+        metrics.LISTENER_ERRORS.labels(name, 'exception').inc()
+        raise
+    finally:
+        metrics.LISTENER_SECONDS.labels(name).observe(time.time() - start)
+    return result
+
+
+def _dispatch_in_order(functions, data):
+    for function in functions:
+        result = _timed(function, data)
+        if result is not None:
+            return result
+
+
+def _dispatch_concurrently(event, functions, data, timeout):
+    """Runs every listener at once, each bounded by timeout.
+
+    A failing or slow listener doesn't affect the others. A listener that
+    times out is left to finish in the background and its result is
+    dropped. Returns the first non-None result in registration order, and
+    raises ListenerError afterwards if any listener raised.
+    """
+    submitted = [
+        (function, _listener_executor.submit(
+            contextvars.copy_context().run, _timed, function, data),
+         time.time())
+        for function in functions]
+
+    results = []
+    errors = []
+    for function, future, started in submitted:
+        name = _listener_name(function)
+        try:
+            results.append(future.result(
+                timeout=max(started + timeout - time.time(), 0)))
+        except futures.TimeoutError:
+            logging.error('Listener {} timed out after {}s on {}.'.format(
+                name, timeout, event))
+            metrics.LISTENER_ERRORS.labels(name, 'timeout').inc()
+        except Exception as e:
+            logging.exception('Listener {} failed on {}.'.format(name, event))
+            errors.append((name, e))
+
+    if errors:
+        raise ListenerError(event, errors)
+
+    for result in results:
+        if result is not None:
+            return result
+
+
+def process_event(event, data):
+    """Calls all of the functions registered for event with the hook data.
+
+    By default listeners run one after another until one returns a result.
+    With WEBHOOK_CONCURRENT_LISTENERS set they all run concurrently, each
+    with a timeout of WEBHOOK_LISTENER_TIMEOUT seconds.
+    """
+    functions = _web_hook_event_map.get(event, [])
+
+    logging.info('Event: {}'.format(event))
+
+    with metrics.EVENT_SECONDS.labels(event).time():
+        if _concurrent_dispatch() and len(functions) > 1:
+            result = _dispatch_concurrently(
+                event, functions, data, _listener_timeout())
+        else:
+            result = _dispatch_in_order(functions, data)
+
+    if result is not None:
+        return result
+
+    return {'status': 'OK'}
+
+
+async def _timed_async(function, data):
+    """Awaits a coroutine listener, recording how long it took and whether
+    it failed."""
+    name = _listener_name(function)
+    start = time.time()
+    try:
+        result = await function(data)
+    except Exception:
+        metrics.LISTENER_ERRORS.labels(name, 'exception').inc()
+        raise
+    finally:
+        metrics.LISTENER_SECONDS.labels(name).observe(time.time() - start)
+    return result
+
+
+async def _run_listener(function, data):
+    """Runs a listener's coroutine version on the event loop or, if it has
+    none, the listener itself in the listener thread pool."""
+    coroutine_function = _async_listeners.get(function)
+    if coroutine_function is not None:
+        return await _timed_async(coroutine_function, data)
+
+    return await asyncio.get_running_loop().run_in_executor(
+        _listener_executor, contextvars.copy_context().run, _timed,
+        function, data)
+
+
+async def _dispatch_concurrently_async(event, functions, data, timeout):
+    """Async version of _dispatch_concurrently. Coroutine listeners that
+    time out are cancelled."""
+    tasks = [
+        (function, asyncio.ensure_future(
+            asyncio.wait_for(_run_listener(function, data), timeout)))
+        for function in functions]
+
+    results = []
+    errors = []
+    for function, task in tasks:
+        name = _listener_name(function)
+        try:
+            results.append(await task)
+        except asyncio.TimeoutError:
+            logging.error('Listener {} timed out after {}s on {}.'.format(
+                name, timeout, event))
+            metrics.LISTENER_ERRORS.labels(name, 'timeout').inc()
+        except Exception as e:
+            logging.exception('Listener {} failed on {}.'.format(name, event))
+            errors.append((name, e))
+
+    if errors:
+        raise ListenerError(event, errors)
+
+    for result in results:
         if result is not None:
             return result
 
+
+async def process_event_async(event, data):
+    """process_event for async serving mode.
+
+    Listeners with a coroutine version registered with listen_async run on
+    the event loop; the others run in the listener thread pool. Dispatch
+    otherwise works as in process_event.
+    """
+    functions = _web_hook_event_map.get(event, [])
+
+    logging.info('Event: {}'.format(event))
+
+    result = None
+    with metrics.EVENT_SECONDS.labels(event).time():
+        if _concurrent_dispatch() and len(functions) > 1:
+            result = await _dispatch_concurrently_async(
+                event, functions, data, _listener_timeout())
+        else:
+            for function in functions:
+                result = await _run_listener(function, data)
+                if result is not None:
+                    break
+
+    if result is not None:
+        return result
+
     return {'status': 'OK'}
@@ -0,0 +1,176 @@
+# Copyright 2018 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from collections import defaultdict
+import threading
+
+import prometheus_client
+import pytest
+
+import webhook_helper
+
+
+@pytest.fixture
+def event_map(monkeypatch):
+    event_map = defaultdict(list)
+    monkeypatch.setattr(webhook_helper, '_web_hook_event_map', event_map)
+    monkeypatch.setattr(webhook_helper, '_async_listeners', {})
+    return event_map
+
+
+def test_process_event_in_order(event_map):
+    calls = []
+
+    @webhook_helper.listen('test')
+    def first(data):
+        calls.append('first')
+        return {'msg': 'first'}
+
+    @webhook_helper.listen('test')
+    def second(data):
+        calls.append('second')
+
+    assert webhook_helper.process_event('test', {}) == {'msg': 'first'}
+    assert calls == ['first']
+    assert webhook_helper.process_event('other', {}) == {'status': 'OK'}
+    assert 'other' not in event_map
+
+
+def test_process_event_concurrently(event_map, monkeypatch):
+    monkeypatch.setenv('WEBHOOK_CONCURRENT_LISTENERS', '1')
+    monkeypatch.setenv('WEBHOOK_LISTENER_TIMEOUT', '0.1')
+    release = threading.Event()
+    calls = []
+
+    @webhook_helper.listen('test')
+    def slow(data):
+        release.wait(5)
+
+    @webhook_helper.listen('test')
+    def failing(data):
+        raise RuntimeError('boom')
+
+    @webhook_helper.listen('test')
+    def fast(data):
+        calls.append('fast')
+
+    with pytest.raises(webhook_helper.ListenerError) as excinfo:
+        webhook_helper.process_event('test', {})
+    release.set()
+
+    assert calls == ['fast']
+    assert [name for name, _ in excinfo.value.errors] == [
+        'webhook_helper_test.failing']
+    assert prometheus_client.REGISTRY.get_sample_value(
+        'webhook_listener_errors_total',
+        {'listener': 'webhook_helper_test.slow', 'reason': 'timeout'}) >= 1
+
+
+def test_subscribed_events(event_map):
+    webhook_helper.listen('ping')(lambda data: None)
+    webhook_helper.listen('status')(lambda data: None)
+    webhook_helper.listen('issue_comment')(lambda data: None)
+
+    assert webhook_helper.subscribed_events() == ['issue_comment', 'status']
+    assert webhook_helper.has_listeners('status')
+    assert not webhook_helper.has_listeners('push')
+
+
+def test_process_event_async(event_map):
+    threads = []
+
+    @webhook_helper.listen('test')
+    def sync(data):
+        threads.append(threading.current_thread())
+
+    @webhook_helper.listen('test')
+    def replaced(data):
+        raise AssertionError('Replaced by a coroutine.')
+
+    @webhook_helper.listen_async(replaces=replaced)
+    async def replacement(data):
+        return {'msg': data['msg']}
+
+    result = asyncio.run(
+        webhook_helper.process_event_async('test', {'msg': 'hi'}))
+
+    assert result == {'msg': 'hi'}
+    assert threads and threads[0] is not threading.current_thread()
+
+
+class FakeHook(object):
+    def __init__(self, url, events):
+        self.config = {'url': url, 'content_type': 'json'}
+        self.events = events
+        self.active = True
+        self.edits = []
+
+    def edit(self, **kwargs):
+        self.edits.append(kwargs)
+        self.events = kwargs['events']
+
+
+class FakeRepository(object):
+    def __init__(self, full_name, hooks, admin=True):
+        self.full_name = full_name
+        self.permissions = {'admin': admin}
+        self._hooks = hooks
+
+    def hooks(self):
+        return iter(self._hooks)
+
+
+def test_migrate_webhooks(event_map, monkeypatch):
+    monkeypatch.setenv('GITHUB_WEBHOOK_URL', 'https://bot.example/webhook')
+    monkeypatch.setenv('GITHUB_WEBHOOK_SECRET', 'secret')
+    webhook_helper.listen('status')(lambda data: None)
+    webhook_helper.listen('pull_request')(lambda data: None)
+
+    url = 'https://bot.example/webhook'
+    everything = FakeHook(url, ['*'])
+    up_to_date = FakeHook(url, ['pull_request', 'status'])
+    other = FakeHook('https://ci.example/hook', ['*'])
+    not_admin = FakeHook(url, ['*'])
+    repositories = [
+        FakeRepository('octo/repo', [everything, other]),
+        FakeRepository('octo/done', [up_to_date]),
+        FakeRepository('octo/fork', [not_admin], admin=False),
+    ]
+
+    class FakeClient(object):
+        def repositories(self):
+            return iter(repositories)
+
+    monkeypatch.setattr(
+        webhook_helper.github_helper, 'get_client', FakeClient)
+
+    assert webhook_helper.migrate_webhooks() == 1
+
+    assert everything.edits == [{
+        'config': {
+            'url': url, 'content_type': 'json', 'secret': 'secret'},
+        'events': ['pull_request', 'status'],
+        'active': True,
+    }]
+    assert up_to_date.edits == []
+    assert other.edits == []
+    assert not_admin.edits == []
+
+
+def test_migrate_webhooks_is_not_served():
+    import main
+
+    assert '/cron/migrate_webhooks' not in {
+        rule.rule for rule in main.app.url_map.iter_rules()}
@@ -15,40 +15,92 @@
 """This module contains functions that are called whenever a particular
 GitHub webhook is received."""
 
-import time
+import asyncio
+from concurrent import futures
+import contextvars
 import logging
-import re
+import os
 
+import bot_commands
+import branch_protection
+import github_async
 import github_helper
+import local_db
+import permissions
+import pr_index
+import rate_limiter
 import webhook_helper
 
 
+def _repository_names(data):
+    """Returns the owner and name of an event's repository."""
+    return data['repository']['owner']['login'], data['repository']['name']
+
+
 @webhook_helper.listen('ping')
 def pong(data):
     return {'msg': 'pong'}
 
 
+@webhook_helper.listen('status')
+@webhook_helper.listen('pull_request')
+@webhook_helper.listen('pull_request_review')
+def invalidate_cached_reads(data):
+    """Drops cached API reads made stale by the event."""
+    owner, name = _repository_names(data)
+
+    if 'sha' in data:
+        github_helper.invalidate_commit(owner, name, data['sha'])
+    if 'pull_request' in data:
+        github_helper.invalidate_pull_request(
+            owner, name, data['pull_request']['number'])
+
+
+@webhook_helper.listen('branch_protection_rule')
+@webhook_helper.listen('repository')
+def invalidate_branch_protection(data):
+    """Drops the cached branch protection settings of the repository.
+    Rules can match several branches, so all of them are dropped."""
+    branch_protection.invalidate(data['repository']['full_name'])
+
+
+@webhook_helper.listen('member')
+def invalidate_collaborator_permissions(data):
+    """Drops the cached access of a collaborator added to, removed from or
+    changed on the repository."""
+    permissions.invalidate(
+        data['repository']['owner']['login'],
+        repo=data['repository']['name'], user=data['member']['login'])
+
+
+@webhook_helper.listen('membership')
+@webhook_helper.listen('organization')
+def invalidate_organization_permissions(data):
+    """Drops the cached access of a user whose team or organization
+    membership changed, to every repository in the organization. Only
+    organization hooks receive these events."""
+    member = data.get('member') or (data.get('membership') or {}).get('user')
+    permissions.invalidate(
+        data['organization']['login'],
+        user=member['login'] if member else None)
+
+
+_SATISFACTION = (
+    r'\b(pass|passes|green|approv(e|al|es|ed)|happy|satisfied)')
+_CI_TOOL = r'\b(travis|tests|statuses|kokoro|ci)\b'
+_MERGE_ACTION = r'\bmerge\b'
+
+bot_commands.register('automerge', [
+    r'{}.+({}.+)?{}'.format(_MERGE_ACTION, _CI_TOOL, _SATISFACTION),
+    r'{}.+{},.+{}'.format(_CI_TOOL, _SATISFACTION, _MERGE_ACTION),
+    'lgtm',
+])
+
+
 def check_for_auto_merge_trigger(text):
     """Checks the text for the phrases that should trigger an automerge."""
     # The comment must address @dpebot directly, on the same line
-    comment = re.search(
-        r'@{}\s+\b(.+)'.format(github_helper.github_user()), text, re.I)
-    if not comment:
-        return False
-    else:
-        # Just get the meat of the command
-        comment = comment.group(1).strip()
-
-    satisfaction = r'\b(pass|passes|green|approv(e|al|es|ed)|happy|satisfied)'
-    ci_tool = r'\b(travis|tests|statuses|kokoro|ci)\b'
-    merge_action = r'\bmerge\b'
-    triggers = (
-        r'{}.+({}.+)?{}'.format(merge_action, ci_tool, satisfaction),
-        r'{}.+{},.+{}'.format(ci_tool, satisfaction, merge_action),
-        'lgtm',
-    )
-
-    return any(re.search(trigger, comment, re.I) for trigger in triggers)
+    return 'automerge' in bot_commands.parse(text, github_helper.github_user())
 
 
 @webhook_helper.listen('issue_comment')
@@ -75,9 +127,10 @@ def acknowledge_merge_on_travis(data):
 
     # If user is a collaborator.
     gh = github_helper.get_client()
-    repository = github_helper.get_repository(gh, data)
 
-    if not repository.is_collaborator(data['sender']['login']):
+    if not github_helper.is_collaborator(
+            gh, data['repository']['owner']['login'],
+            data['repository']['name'], data['sender']['login']):
         logging.info(
             '{} is not an owner and is trying to tell me what to do.'.format(
                 data['sender']['login']))
@@ -91,6 +144,37 @@ def acknowledge_merge_on_travis(data):
     pr.issue().assign(github_helper.github_user())
 
 
+def _status_may_complete_merge(data):
+    """True if a status event can make an automerge PR mergeable."""
+    # TODO: Idea - if automerge has been triggered and the status fails,
+    # nag the committer to fix?
+
+    # If it's not successful don't even bother.
+    if data['state'] != 'success':
+        logging.info('Status not successful, returning.')
+        return False
+    return True
+
+
+def _review_may_complete_merge(data):
+    """True if a review event can make its PR mergeable."""
+    # If it's not successful don't even bother.
+    if data['review']['state'] != 'approved':
+        logging.info('Not approved, returning.')
+        return False
+
+    # If the PR is closed, don't bother
+    if data['pull_request']['state'] != 'open':
+        logging.info('Closed, returning.')
+        return False
+    return True
+
+
+def _log_heads(commit_sha, pulls):
+    logging.info('Commit {} is the head of PRs: {}'.format(
+        commit_sha, pulls))
+
+
 @webhook_helper.listen('status')
 def commit_status_complete_merge_on_travis(data):
     """When all statuses on a PR are green, this hook will automatically
@@ -99,53 +183,75 @@ def commit_status_complete_merge_on_travis(data):
     Status data reference:
     https://developer.github.com/v3/activity/events/types/#statusevent
     """
-    # TODO: Idea - if automerge has been triggered and the status fails,
-    # nag the committer to fix?
-
-    # If it's not successful don't even bother.
-    if data['state'] != 'success':
-        logging.info('Status not successful, returning.')
+    if not _status_may_complete_merge(data):
         return
 
-    # NOTE: I'm not sure if there's a better way to do this. But, it seems
-    # the status change message doesn't tell you which PR the commit is
-    # from. Indeed, it's possible for a commit to actually be in multiple
-    # PRs. Anyways, the idea here is to get all open PRs with the
-    # tag 'automerge' and this commit in the PR.
+    # The status event doesn't tell you which PR the commit is from, so look
+    # up the open automerge PRs whose head is this commit in the index.
     commit_sha = data['commit']['sha']
+    repo_full_name = data['repository']['full_name']
     gh = github_helper.get_client()
     repository = github_helper.get_repository(gh, data)
 
-    # Sleep for about 15 seconds. Github's search index needs a few seconds
-    # before it'll find the results.
-    time.sleep(15)
-
-    query = '{} type:pr label:automerge is:open repo:{}'.format(
-            commit_sha, data['repository']['full_name'])
-    logging.info('Querying with: {}'.format(query))
-    results = gh.search_issues(query=query)
-
-    # Covert to pull requests so we can get the commits.
-    pulls = [result.issue.pull_request() for result in results]
-    logging.info('Found {} potential PRs: {}'.format(
-        len(pulls), pulls))
-
-    # See if this commit is in the PR.
-    # this check isn't actually strictly necessary as the search above will
-    # only return PRs that are 'green' which means we can safely merge all
-    # of them. But, whatever, I'll leave it here for now anyway.
-    pulls = [
-        pull for pull in pulls
-        if commit_sha in [commit.sha for commit in pull.commits()]]
-
-    logging.info('Commit {} is present in PRs: {}'.format(
-        commit_sha, pulls))
+    numbers = pr_index.find(repo_full_name, commit_sha)
+    if numbers is None:
+        pr_index.rebuild(repository)
+        numbers = pr_index.find(repo_full_name, commit_sha)
+
+    # Guard against the index being behind a push.
+    pulls = [repository.pull_request(number) for number in numbers]
+    pulls = [pull for pull in pulls if pull.head.sha == commit_sha]
+
+    _log_heads(commit_sha, pulls)
 
     # Merge!
     for pull in pulls:
         merge_pull_request(repository, pull, commit_sha=commit_sha)
 
 
+@webhook_helper.listen_async(replaces=commit_status_complete_merge_on_travis)
+async def commit_status_complete_merge_on_travis_async(data):
+    """commit_status_complete_merge_on_travis for async serving mode."""
+    if not _status_may_complete_merge(data):
+        return
+
+    commit_sha = data['commit']['sha']
+    repo_full_name = data['repository']['full_name']
+    owner, name = _repository_names(data)
+
+    # The index is a local SQLite lookup; only rebuilding it hits the API.
+    numbers = await local_db.run_async(
+        pr_index.find, repo_full_name, commit_sha)
+    if numbers is None:
+        pulls = await github_async.list_open_pull_requests(owner, name)
+        await local_db.run_async(pr_index.replace, repo_full_name, pulls)
+        numbers = await local_db.run_async(
+            pr_index.find, repo_full_name, commit_sha)
+
+    # Guard against the index being behind a push.
+    pulls = await asyncio.gather(*[
+        github_async.get_pull_request(owner, name, number)
+        for number in numbers])
+    pulls = [pull for pull in pulls if pull['head']['sha'] == commit_sha]
+
+    _log_heads(commit_sha, [pull['number'] for pull in pulls])
+
+    await asyncio.gather(*[
+        merge_pull_request_async(owner, name, pull, commit_sha)
+        for pull in pulls])
+
+
+@webhook_helper.listen('pull_request')
+def index_automerge_pull_request(data):
+    """Keeps the index of open automerge PRs up to date as PRs are opened,
+    pushed to, labeled and closed.
+
+    Pull request data reference:
+    https://developer.github.com/v3/activity/events/types/#pullrequestevent
+    """
+    pr_index.update(data['repository']['full_name'], data['pull_request'])
+
+
 @webhook_helper.listen('pull_request_review')
 def pull_request_review_merge_on_travis(data):
     """When all approvers approve and statuses pass, this hook will
@@ -154,48 +260,135 @@ def pull_request_review_merge_on_travis(data):
     Status data reference:
     https://developer.github.com/v3/activity/events/types/#pullrequestreviewevent
     """
-    # If it's not successful don't even bother.
-    if data['review']['state'] != 'approved':
-        logging.info('Not approved, returning.')
-        return
-
-    # If the PR is closed, don't bother
-    if data['pull_request']['state'] != 'open':
-        logging.info('Closed, returning.')
+    if not _review_may_complete_merge(data):
         return
 
     gh = github_helper.get_client()
 
-    repo = gh.repository(
-        data['repository']['owner']['login'],
-        data['repository']['name'])
+    repo = gh.repository(*_repository_names(data))
     pr = repo.pull_request(data['pull_request']['number'])
 
     merge_pull_request(repo, pr, commit_sha=pr.head.sha)
 
 
-def merge_pull_request(repo, pull, commit_sha=None):
-    """Merges a pull request."""
-
-    # only merge pulls that are labeled automerge
-    labels = [label.name for label in pull.issue().labels()]
-    if 'automerge' not in labels:
-        logging.info('Not merging {}, not labeled automerge'.format(pull))
+@webhook_helper.listen_async(replaces=pull_request_review_merge_on_travis)
+async def pull_request_review_merge_on_travis_async(data):
+    """pull_request_review_merge_on_travis for async serving mode."""
+    if not _review_may_complete_merge(data):
         return
 
-    # only merge if all required status are reported
-    if not github_helper.has_required_statuses(pull):
-        logging.info('Not merging {}, missing required status'.format(pull))
-        return
+    owner, name = _repository_names(data)
+    pull = await github_async.get_pull_request(
+        owner, name, data['pull_request']['number'])
+
+    await merge_pull_request_async(
+        owner, name, pull, commit_sha=pull['head']['sha'])
+
+
+def _readiness_backend():
+    return os.environ.get('AUTOMERGE_READINESS_BACKEND', 'rest')
+
+
+# Runs the independent REST merge checks concurrently.
+_gate_executor = futures.ThreadPoolExecutor(
+    max_workers=int(os.environ.get('AUTOMERGE_GATE_WORKERS', 16)))
+
+
+def _first_failed_check(checks):
+    """Runs (reason, check) pairs concurrently and returns the reason of the
+    first check to return False, without waiting for the others. Returns None
+    if every check passes."""
+    # Each check runs in a copy of our context so it keeps our request
+    # priority.
+    pending = {
+        _gate_executor.submit(contextvars.copy_context().run, check): reason
+        for reason, check in checks}
+    try:
+        while pending:
+            done, _ = futures.wait(
+                pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                reason = pending.pop(future)
+                if not future.result():
+                    return reason
+    finally:
+        # Checks that already started finish in the background; their
+        # results are ignored.
+        for future in pending:
+            future.cancel()
+
+
+_NOT_LABELED = 'not labeled automerge'
+
+
+def _rest_checks(has_required_statuses, is_green, is_approved):
+    """Pairs the REST merge checks, in either serving mode's form, with the
+    reason a PR failing them can't be merged. They're independent, so they
+    run concurrently once the PR is known to be labeled."""
+    return [
+        # only merge if all required status are reported
+        ('missing required status', has_required_statuses),
+        # only merge pulls that have all green statuses
+        ('not green.', is_green),
+        # Only merge pulls that have been approved!
+        ('not approved.', is_approved),
+    ]
+
+
+def _rest_not_ready_reason(repo, pull, commit_sha):
+    """Checks the PR with one REST call per check. Returns why it can't be
+    merged, or None if it can."""
+    # only merge pulls that are labeled automerge. Most PRs aren't, so this
+    # one call saves the others.
+    if 'automerge' not in [label.name for label in pull.issue().labels()]:
+        return _NOT_LABELED
+
+    return _first_failed_check(_rest_checks(
+        lambda: github_helper.has_required_statuses(pull),
+        lambda: github_helper.is_sha_green(repo, commit_sha),
+        lambda: github_helper.is_pr_approved(pull)))
+
+
+def _graphql_not_ready_reason(pull, commit_sha):
+    """Same checks as _rest_not_ready_reason, evaluated on the result of a
+    single GraphQL query."""
+    readiness = github_helper.get_merge_readiness(pull, commit_sha)
+    if readiness.required_statuses is None:
+        # The branch isn't protected or its protection is hidden from us;
+        # the REST API tells which.
+        required = github_helper.get_pr_required_statuses(pull)
+        readiness = readiness._replace(required_statuses=required)
+    return _readiness_not_ready_reason(readiness)
+
+
+def _readiness_not_ready_reason(readiness):
+    if 'automerge' not in readiness.labels:
+        return _NOT_LABELED
+
+    if not github_helper.statuses_cover_required(
+            readiness.required_statuses, readiness.statuses):
+        return 'missing required status'
+
+    if readiness.state != 'success':
+        return 'not green.'
+
+    if not github_helper.reviews_satisfy_requests(
+            readiness.requested_users, readiness.approved_users):
+        return 'not approved.'
+
+
+# Merges go ahead of housekeeping when the rate limit is tight.
+@rate_limiter.priority(rate_limiter.HIGH)
+def merge_pull_request(repo, pull, commit_sha=None):
+    """Merges a pull request."""
 
-    # only merge pulls that have all green statuses
-    if not github_helper.is_sha_green(repo, commit_sha):
-        logging.info('Not merging {}, not green.'.format(pull))
-        return
+    if _readiness_backend() == 'graphql':
+        reason = _graphql_not_ready_reason(pull, commit_sha)
+    else:
+        reason = _rest_not_ready_reason(repo, pull, commit_sha)
 
-    # Only merge pulls that have been approved!
-    if not github_helper.is_pr_approved(pull):
-        logging.info('Not merging {}, not approved.'.format(pull))
+    if reason is not None:
+        logging.info('Not merging {}, {}'.format(pull, reason))
         return
 
     # By supplying the sha here, it ensures that the PR will only be
@@ -203,7 +396,69 @@ def merge_pull_request(repo, pull, commit_sha=None):
     logging.info('Merging {}.'.format(pull))
     github_helper.squash_merge_pr(pull, sha=commit_sha)
 
-    # Delete the branch if it's in this repo. ALSO DON'T DELETE MASTER.
-    if (pull.head.ref != 'master' and
-            '/'.join(pull.head.repo) == repo.full_name):
+    if _deletes_branch(pull.head.ref, '/'.join(pull.head.repo),
+                       repo.full_name):
         repo.ref('heads/{}'.format(pull.head.ref)).delete()
+
+
+def _deletes_branch(head_ref, head_repo_full_name, repo_full_name):
+    """True if a merged PR's branch should be deleted."""
+    # Delete the branch if it's in this repo. ALSO DON'T DELETE MASTER.
+    return head_ref != 'master' and head_repo_full_name == repo_full_name
+
+
+async def _first_failed_check_async(checks):
+    """Async version of _first_failed_check. checks are (reason, coroutine)
+    pairs; the checks still running when one fails are cancelled."""
+    tasks = {
+        asyncio.ensure_future(check): reason for reason, check in checks}
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.result():
+                    return tasks[task]
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def merge_pull_request_async(owner, name, pull, commit_sha=None):
+    """merge_pull_request for async serving mode. pull is the PR's API
+    representation."""
+    # Set inside the coroutine: a decorator would only cover creating it.
+    with rate_limiter.priority(rate_limiter.HIGH):
+        if _readiness_backend() == 'graphql':
+            readiness = await github_async.get_merge_readiness(
+                owner, name, pull['number'], commit_sha)
+            if readiness.required_statuses is None:
+                required = await github_async.get_pr_required_statuses(
+                    owner, name, pull['base']['ref'])
+                readiness = readiness._replace(required_statuses=required)
+            reason = _readiness_not_ready_reason(readiness)
+        elif not _is_labeled_automerge(pull):
+            reason = _NOT_LABELED
+        else:
+            reason = await _first_failed_check_async(_rest_checks(
+                github_async.has_required_statuses(owner, name, pull),
+                github_async.is_sha_green(owner, name, commit_sha),
+                github_async.is_pr_approved(owner, name, pull['number'])))
+
+        if reason is not None:
+            logging.info('Not merging {}, {}'.format(pull['html_url'], reason))
+            return
+
+        logging.info('Merging {}.'.format(pull['html_url']))
+        await github_async.squash_merge_pr(
+            owner, name, pull['number'], commit_sha)
+
+        head_repo = pull['head'].get('repo') or {}
+        if _deletes_branch(pull['head']['ref'], head_repo.get('full_name'),
+                           '{}/{}'.format(owner, name)):
+            await github_async.delete_branch(owner, name, pull['head']['ref'])
+
+
+def _is_labeled_automerge(pull):
+    return 'automerge' in [label['name'] for label in pull['labels']]